@@ -1,63 +1,84 @@
 import logging
-import socket
-from rlmodelbuilder import RLModelBuilder
 import config
-from keras.models import Model
 import time
 # import tensorflow as tf
-import utils
-from tqdm import tqdm
-from mcts import MCTS
+import transport
+import backends
+from backends import InferenceBackend
+from mcts import MCTS, EvaluationCache
 # from tensorflow.keras.models import load_model
-import json
 import numpy as np
 import chess
+from concurrent.futures import Future
 
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
 class Agent:
-    def __init__(self, local_predictions: bool = False, model_path = None, state=chess.STARTING_FEN):
+    def __init__(self, local_predictions: bool = False, model_path = None, state=chess.STARTING_FEN, model_id: str = config.MODEL_ID,
+                 backend: InferenceBackend = None, priority: str = config.REQUEST_PRIORITY):
         """
         An agent is an object that can play chessmoves on the environment.
         Based on the parameters, it can play with a local model, or send its input to a server.
+        When using the server, model_id selects which of the server's models answers the predictions,
+        and priority is the priority class of the requests (interactive, evaluation, selfplay or reanalysis).
+        A backend can also be given directly (e.g. to share it between agents), see backends.py.
         It holds an MCTS object that is used to run MCTS simulations to build a tree.
         """
-        if local_predictions and model_path is not None:
-            logging.info("Using local predictions")
-            from tensorflow.python.ops.numpy_ops import np_config
-            import tensorflow as tf
-            from tensorflow.keras.models import load_model
-            self.model = load_model(model_path)
-            self.local_predictions = True
-            np_config.enable_numpy_behavior()
-        else:
-            logging.info("Using server predictions")
-            self.local_predictions = False
-            # connect to the server to do predictions
-            try: 
-                self.socket_to_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket_to_server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                server = os.environ.get("SOCKET_HOST", "localhost")
-                port = int(os.environ.get("SOCKET_PORT", 5000))
-                self.socket_to_server.connect((server, port))
-            except Exception as e:
-                print(f"Agent could not connect to the server at {server}:{port}: ", e)
-                exit(1)
-            logging.info(f"Agent connected to server {server}:{port}")
+        self.model_id = model_id
+        backend_given = backend is not None
+        if backend is None:
+            name = config.INFERENCE_BACKEND
+            if name == "auto":
+                name = backends.backend_for_path(model_path) if local_predictions and model_path is not None else "server"
+            if name == "server":
+                # connect to the server to do predictions
+                try:
+                    backend = backends.create_backend(name, model_id=model_id, priority=priority)
+                except OSError as e:
+                    # the caller decides whether to retry (e.g. the self-play orchestrator) or to stop
+                    raise ConnectionError(f"Agent could not connect to the server at {transport.server_address()[1]}: {e}") from e
+                logging.info(f"Agent connected to server {transport.server_address()[1]} ({config.SOCKET_TRANSPORT})")
+            else:
+                backend = backends.create_backend(name, model_path, model_id)
+        self.backend = backend
+        self.local_predictions = backend.name != "server"
+        # the model file of a local backend (the server's model is found by its id)
+        self.model_path = model_path if self.local_predictions else None
+        # predictions requested ahead of time by the MCTS (see PREFETCH_CHILDREN)
+        self.evaluations = EvaluationCache(config.PREFETCH_CACHE_SIZE)
+        # a synchronous backend would predict the prefetched children right away, while the search waits
+        self.prefetch_children = config.PREFETCH_CHILDREN if backend.asynchronous else 0
+        if config.PREFETCH_CHILDREN and not backend.asynchronous:
+            logging.warning(f"PREFETCH_CHILDREN is disabled: the {backend.name} backend predicts synchronously")
+        # searches of opening positions, shared between games (see opening_cache.py). An agent with a given
+        # backend doesn't know which model it is, and doesn't use the cache
+        self.opening_cache = None
+        if config.OPENING_CACHE and not backend_given:
+            from opening_cache import OpeningCache
+            self.opening_cache = OpeningCache(config.OPENING_CACHE_FILE, self.model_version())
 
         self.mcts = MCTS(self, state=state)
         
 
-    def build_model(self) -> Model:
+    def build_model(self) -> "Model":
         """
         Build a new model based on the configuration in config.py
         """
+        # keras is only imported when a model is built or loaded locally
+        from rlmodelbuilder import RLModelBuilder
         model_builder = RLModelBuilder(config.INPUT_SHAPE, config.OUTPUT_SHAPE)
         model = model_builder.build_model()
         return model
 
+    def model_version(self) -> str:
+        """
+        The version of the agent's model (see MODEL_VERSION).
+        """
+        from utils import model_version
+        return model_version(self.model_path, self.model_id)
+
     def run_simulations(self, n: int = 1):
         """
         Run n simulations of the MCTS algorithm. This function gets called every move.
@@ -67,43 +88,35 @@ class Agent:
 
     def save_model(self, timestamped: bool = False):
         """
-        Save the current model to a file
+        Save the current model to a file. Only the keras backend has a model that can be saved.
         """
         if timestamped:
-            self.model.save(f"{config.MODEL_FOLDER}/model-{time.time()}.h5")
+            self.backend.save(f"{config.MODEL_FOLDER}/model-{time.time()}.h5")
         else:
-            self.model.save(f"{config.MODEL_FOLDER}/model.h5")
+            self.backend.save(f"{config.MODEL_FOLDER}/model.h5")
 
     def predict(self, data):
         """
-        Predict locally or using the server, depending on the configuration
+        Predict one input with the backend. Returns the policy and the value
         """
-        if self.local_predictions:
-            # use tf.function
-            import local_prediction
-            p, v = local_prediction.predict_local(self.model, data)
-            return p.numpy(), v[0][0]
-        return self.predict_server(data)
-
-    def predict_server(self, data: np.ndarray):
-        """
-        Send data to the server and get the prediction
-        """
-        # send data to server
-        self.socket_to_server.send(f"{len(data.flatten()):010d}".encode('ascii'))
-        self.socket_to_server.send(data)
-        # get msg length
-        data_length = self.socket_to_server.recv(10)
-        data_length = int(data_length.decode("ascii"))
-        # get prediction
-        response = utils.recvall(self.socket_to_server, data_length)
-        # decode response
-        response = response.decode("ascii")
-        # json to dict
-        response = json.loads(response)
-        # unpack dictionary to tuple
-        return np.array(response["prediction"]), response["value"]
-
+        return self.backend.predict(data)
 
+    def predict_async(self, data, priority: str = None) -> Future:
+        """
+        Start a prediction and return a future for its result (the policy and the value).
+        With the server, many predictions can be in flight at the same time, and a different
+        priority class than the agent's can be given. Local predictions are done immediately.
+        """
+        return self.backend.predict_async(data, priority)
 
+    def predict_batch(self, inputs: np.ndarray):
+        """
+        Predict a batch of inputs. Returns the policies and the values
+        """
+        return self.backend.predict_batch(inputs)
 
+    def predict_values(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        Only the values of a batch of inputs (for scoring positions): the policy head is skipped
+        """
+        return self.backend.predict_values(inputs)
@@ -0,0 +1,318 @@
+# Inference backends: every way to get predictions from a model has the same interface,
+# so the agents (and the MCTS) don't need to know where the predictions come from.
+#   * keras:  a local Keras model (.h5)
+#   * tflite: a local TFLite model (see export_model.py)
+#   * numpy:  a local NumPy model (.npz, see numpy_prediction.py)
+#   * server: the prediction server (see server.py)
+#   * mock:   deterministic predictions without a model, for testing
+# The backend is selected with INFERENCE_BACKEND (default: auto, based on the model path).
+import logging
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from queue import Empty, Queue
+from typing import Tuple
+
+import numpy as np
+
+import config
+
+
+class InferenceBackend:
+    """
+    Base class of the backends. Subclasses implement predict_batch, and predict_batch_async
+    if they can have multiple predictions in flight.
+    """
+    name = "backend"
+    # whether predict_async returns before the prediction is made (so the caller can do other work meanwhile)
+    asynchronous = False
+
+    def predict_batch(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Predict a batch of inputs, shape (N, 8, 8, 19). Returns the policies (N, 4672) and values (N,).
+        """
+        raise NotImplementedError
+
+    def predict_batch_async(self, inputs: np.ndarray) -> Future:
+        """
+        Start predicting a batch, returns a future for the result of predict_batch.
+        By default the batch is predicted immediately.
+        """
+        future = Future()
+        try:
+            future.set_result(self.predict_batch(inputs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def predict_values(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        Only the values (N,) of a batch of inputs, for scoring positions.
+        Backends that can skip the policy head override this.
+        """
+        return self.predict_batch(inputs)[1]
+
+    def predict_values_async(self, inputs: np.ndarray) -> Future:
+        future = Future()
+        try:
+            future.set_result(self.predict_values(inputs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def predict(self, data: np.ndarray) -> Tuple[np.ndarray, float]:
+        """
+        Predict one input, shape (1, 8, 8, 19) or (8, 8, 19). Returns the policy (4672,) and the value.
+        """
+        return self.predict_async(data).result()
+
+    def predict_async(self, data: np.ndarray, priority: str = None) -> Future:
+        """
+        The priority class only matters for the server backend, local predictions are made immediately.
+        """
+        future = Future()
+        batch_future = self.predict_batch_async(data.reshape(1, *config.INPUT_SHAPE))
+        def done(batch_future: Future):
+            if batch_future.exception() is not None:
+                future.set_exception(batch_future.exception())
+                return
+            policies, values = batch_future.result()
+            future.set_result((policies[0], float(values[0])))
+        batch_future.add_done_callback(done)
+        return future
+
+    def save(self, path: str):
+        """
+        Save the backend's model (only Keras models can be saved, e.g. after training).
+        """
+        raise NotImplementedError(f"The {self.name} backend has no Keras model to save")
+
+    def close(self):
+        pass
+
+
+class KerasBackend(InferenceBackend):
+    name = "keras"
+
+    def __init__(self, model_path: str):
+        # tensorflow is only imported when a Keras model is used
+        from tensorflow.keras.models import load_model
+        from local_prediction import BucketedPredictor
+        self.model = load_model(model_path)
+        # no warm-up: only the buckets this process uses get traced (a plain agent only predicts single inputs)
+        self.predictor = BucketedPredictor(self.model)
+
+    def predict_batch(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        policies, values = self.predictor.predict(np.asarray(inputs, dtype=bool).reshape(-1, *config.INPUT_SHAPE))
+        return policies, values.reshape(-1)
+
+    def predict_values(self, inputs: np.ndarray) -> np.ndarray:
+        return self.predictor.predict_values(np.asarray(inputs, dtype=bool).reshape(-1, *config.INPUT_SHAPE)).reshape(-1)
+
+    def save(self, path: str):
+        self.model.save(path)
+
+
+class PredictorBackend(InferenceBackend):
+    """
+    A backend around a predictor with a predict(inputs) -> (policies, values) method.
+    """
+    def __init__(self, predictor):
+        self.predictor = predictor
+
+    def predict_batch(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        policies, values = self.predictor.predict(inputs)
+        return policies, values.reshape(-1)
+
+
+class TFLiteBackend(PredictorBackend):
+    name = "tflite"
+
+    def __init__(self, model_path: str):
+        from tflite_prediction import TFLitePredictor
+        super().__init__(TFLitePredictor(model_path))
+
+
+class NumpyBackend(PredictorBackend):
+    name = "numpy"
+
+    def __init__(self, model_path: str):
+        from numpy_prediction import NumpyPredictor
+        super().__init__(NumpyPredictor(model_path))
+
+    def predict_values(self, inputs: np.ndarray) -> np.ndarray:
+        return self.predictor.predict_values(inputs).reshape(-1)
+
+
+class ServerBackend(InferenceBackend):
+    name = "server"
+    asynchronous = True
+
+    def __init__(self, model_id: str = config.MODEL_ID, client=None, priority: str = config.REQUEST_PRIORITY,
+                 deadline: int = config.REQUEST_DEADLINE):
+        """
+        Predictions by the prediction server. Every position is a separate request:
+        the server batches the requests of all clients.
+        The priority class (and optional deadline in milliseconds) is sent with every request.
+        """
+        import transport
+        from framing import PRIORITIES
+        self.model_id = model_id
+        self.client = client if client is not None else transport.create_client()
+        self.priority = PRIORITIES[priority]
+        self.deadline = deadline
+
+    def predict_async(self, data: np.ndarray, priority: str = None) -> Future:
+        from framing import PRIORITIES
+        priority = self.priority if priority is None else PRIORITIES[priority]
+        return self.client.predict_async(np.asarray(data, dtype=bool), self.model_id, priority, self.deadline)
+
+    def predict_batch_async(self, inputs: np.ndarray) -> Future:
+        inputs = np.asarray(inputs, dtype=bool).reshape(-1, *config.INPUT_SHAPE)
+        futures = [self.client.predict_async(position, self.model_id, self.priority, self.deadline) for position in inputs]
+        future = Future()
+        def collect(_):
+            if future.done() or not all(f.done() for f in futures):
+                return
+            try:
+                results = [f.result() for f in futures]
+            except Exception as e:
+                future.set_exception(e)
+                return
+            future.set_result((np.stack([p for p, _ in results]), np.array([v for _, v in results], dtype=np.float32)))
+        for f in futures:
+            f.add_done_callback(collect)
+        return future
+
+    def predict_batch(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return self.predict_batch_async(inputs).result()
+
+    def predict_values_async(self, inputs: np.ndarray) -> Future:
+        # value requests carry many positions, and the responses only one float per position
+        return self.client.predict_values_async(np.asarray(inputs, dtype=bool).reshape(-1, *config.INPUT_SHAPE),
+                                                self.model_id, self.priority, self.deadline)
+
+    def predict_values(self, inputs: np.ndarray) -> np.ndarray:
+        return self.predict_values_async(inputs).result()
+
+    def close(self):
+        self.client.close()
+
+
+class BatchingBackend(InferenceBackend):
+    asynchronous = True
+
+    def __init__(self, backend: InferenceBackend, max_batch_size: int = config.MAX_BATCH_SIZE,
+                 timeout: float = config.BATCH_TIMEOUT):
+        """
+        Batches the single predictions of multiple threads (e.g. concurrent games) for a local backend,
+        like the prediction server does for its clients: a thread predicts the queued inputs together
+        when max_batch_size inputs are waiting, or when the oldest waited for timeout seconds.
+        """
+        self.backend = backend
+        self.name = backend.name
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        # (input, future) pairs, None stops the thread
+        self.queue: Queue = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def predict_async(self, data: np.ndarray, priority: str = None) -> Future:
+        future = Future()
+        self.queue.put((np.asarray(data, dtype=bool).reshape(config.INPUT_SHAPE), future))
+        return future
+
+    def predict_batch(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return self.backend.predict_batch(inputs)
+
+    def predict_values(self, inputs: np.ndarray) -> np.ndarray:
+        return self.backend.predict_values(inputs)
+
+    def save(self, path: str):
+        self.backend.save(path)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.perf_counter() + self.timeout
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+            try:
+                policies, values = self.backend.predict_batch(np.stack([data for data, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), p, v in zip(batch, policies, values):
+                future.set_result((p, float(v)))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.backend.close()
+
+
+class MockBackend(InferenceBackend):
+    name = "mock"
+
+    def __init__(self, seed: int = 0):
+        """
+        Deterministic predictions without a model: the output only depends on the position
+        (and the seed), not on the batch it is in. Useful to test the search and the pipelines.
+        """
+        self.seed = seed
+
+    def predict_position(self, position: np.ndarray) -> Tuple[np.ndarray, float]:
+        rng = np.random.default_rng(zlib.crc32(np.packbits(position.astype(bool)).tobytes()) ^ self.seed)
+        return rng.random(config.OUTPUT_SHAPE[0], dtype=np.float32), float(rng.uniform(-1, 1))
+
+    def predict_batch(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        results = [self.predict_position(position) for position in inputs.reshape(-1, *config.INPUT_SHAPE)]
+        return np.stack([p for p, _ in results]), np.array([v for _, v in results], dtype=np.float32)
+
+
+BACKENDS = {backend.name: backend for backend in (KerasBackend, TFLiteBackend, NumpyBackend, ServerBackend, MockBackend)}
+
+
+def backend_for_path(model_path: str) -> str:
+    """
+    The local backend for a model file, based on its extension.
+    """
+    if model_path.endswith(".tflite"):
+        return "tflite"
+    if model_path.endswith(".npz"):
+        return "numpy"
+    return "keras"
+
+
+def create_backend(name: str = config.INFERENCE_BACKEND, model_path: str = None, model_id: str = config.MODEL_ID,
+                   priority: str = config.REQUEST_PRIORITY) -> InferenceBackend:
+    """
+    Create a backend by name. With 'auto', a local backend is chosen if a model path is given,
+    otherwise the prediction server is used (with the given priority class).
+    """
+    if name == "auto":
+        name = backend_for_path(model_path) if model_path is not None else "server"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {name} (choose from auto, {', '.join(BACKENDS)})")
+    logging.info(f"Using the {name} inference backend")
+    if name == "server":
+        return ServerBackend(model_id, priority=priority)
+    if name == "mock":
+        return MockBackend()
+    if model_path is None:
+        raise ValueError(f"The {name} backend needs a model path")
+    return BACKENDS[name](model_path)
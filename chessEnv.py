@@ -7,8 +7,6 @@ import numpy as np
 import time
 import logging
 
-logging.basicConfig(level=logging.INFO, format=' %(message)s')
-
 
 class ChessEnv:
     def __init__(self, fen: str = chess.STARTING_FEN):
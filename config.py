@@ -12,9 +12,35 @@ C_init = 2
 
 DIRICHLET_NOISE = 0.3
 
+# speculative prefetch: after expanding a node, request the predictions of its k children
+# with the highest prior ahead of time (0: disabled). Only used with the asynchronous backends (server, or
+# batched local predictions in the arena), where the predictions are made while the MCTS waits for other leaves.
+PREFETCH_CHILDREN = int(os.environ.get("PREFETCH_CHILDREN", 0))
+# priority class of the prefetch requests, so they don't delay the predictions the search waits for
+PREFETCH_PRIORITY = os.environ.get("PREFETCH_PRIORITY", "reanalysis")
+# amount of prefetched predictions kept per agent
+PREFETCH_CACHE_SIZE = int(os.environ.get("PREFETCH_CACHE_SIZE", 4096))
+
 # limit the amount of moves played in a game
 MAX_PUZZLE_MOVES = 4
 MAX_GAME_MOVES = 200
+# self-play with one agent for both colors: one model and one search tree, whose root advances
+# one ply per move, so the search of the opponent's moves is reused
+SELFPLAY_SHARED_TREE = os.environ.get("SELFPLAY_SHARED_TREE", "false") == "true"
+# playout cap randomization: only a fraction of the self-play moves get a full search
+# (SIMULATIONS_PER_MOVE), and only their policies are training targets. The other moves
+# get a fast search of FAST_SIMULATIONS without noise, which only plays the game faster
+PLAYOUT_CAP_RANDOMIZATION = os.environ.get("PLAYOUT_CAP_RANDOMIZATION", "false") == "true"
+FULL_SEARCH_FRACTION = float(os.environ.get("FULL_SEARCH_FRACTION", 0.25))
+FAST_SIMULATIONS = int(os.environ.get("FAST_SIMULATIONS", max(SIMULATIONS_PER_MOVE // 8, 1)))
+# how the winner of a game that reaches the move limit is estimated:
+#   material: piece values (see ChessEnv.estimate_winner)
+#   value:    the model's value of the final position (a value-only prediction)
+ADJUDICATION = os.environ.get("ADJUDICATION", "material")
+# with value adjudication, a side wins if the value is beyond this threshold
+ADJUDICATION_THRESHOLD = float(os.environ.get("ADJUDICATION_THRESHOLD", 0.5))
+# how adjudicated arena games (see evaluate.py) are scored: "draw", or "win" for the side that is ahead
+ARENA_ADJUDICATION = os.environ.get("ARENA_ADJUDICATION", "draw")
 
 # ============= NEURAL NETWORK INPUTS =============
 # 2 players, 6 pieces, 8x8 board
@@ -55,6 +81,11 @@ AMOUNT_OF_RESIDUAL_BLOCKS = 19
 
 # where to save the model
 MODEL_FOLDER = os.environ.get("MODEL_FOLDER" ,'./models')
+# threads used by local TFLite models (see export_model.py)
+TFLITE_THREADS = int(os.environ.get("TFLITE_THREADS", os.cpu_count() or 1))
+# where predictions come from: auto, keras, tflite, numpy, server or mock (see backends.py)
+# auto: the local model if a model path is given (by its extension), otherwise the server
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "auto")
 
 # ============= TRAINING PARAMETERS =============
 BATCH_SIZE = 64
@@ -62,7 +93,101 @@ LOSS_PLOTS_FOLDER="./plots"
 
 # ============= MEMORY CONFIGURATION =============
 MEMORY_DIR = os.environ.get("MEMORY_FOLDER", "./memory")
-MAX_REPLAY_MEMORY = 1000000
+# the replay buffer keeps (at least) the latest MAX_REPLAY_MEMORY positions, in shards of REPLAY_SHARD_SIZE positions
+MAX_REPLAY_MEMORY = int(os.environ.get("MAX_REPLAY_MEMORY", 1000000))
+REPLAY_SHARD_SIZE = int(os.environ.get("REPLAY_SHARD_SIZE", 50000))
+# how self-play games are saved: "replay" (the replay buffer, see replay_buffer.py) or "npy" (a pickled array per game)
+REPLAY_FORMAT = os.environ.get("REPLAY_FORMAT", "replay")
+# compress the games in replay files (zlib): about 3x smaller, but they can't be memory-mapped
+REPLAY_COMPRESSION = os.environ.get("REPLAY_COMPRESSION", "false") == "true"
+# streaming training (see training_pipeline.py): the processes that decode batches (0: in the trainer),
+# the batches decoded ahead, and every how many batches the replay games are indexed again
+TRAINING_WORKERS = int(os.environ.get("TRAINING_WORKERS", max((os.cpu_count() or 2) - 1, 1)))
+TRAINING_PREFETCH = int(os.environ.get("TRAINING_PREFETCH", 8))
+TRAINING_INDEX_REFRESH = int(os.environ.get("TRAINING_INDEX_REFRESH", 500))
+
+# ============= RESIGNATION =============
+# self-play games are resigned when the search's value of the side to move stays below the threshold
+# for RESIGN_CONSECUTIVE moves of that side
+RESIGNATION = os.environ.get("RESIGNATION", "false") == "true"
+RESIGN_THRESHOLD = float(os.environ.get("RESIGN_THRESHOLD", -0.9))
+RESIGN_CONSECUTIVE = int(os.environ.get("RESIGN_CONSECUTIVE", 3))
+# this fraction of the games is played out without resigning, to measure the false resignation rate
+RESIGN_PLAYOUT_FRACTION = float(os.environ.get("RESIGN_PLAYOUT_FRACTION", 0.1))
+# the threshold is calibrated on the played out games, to keep the false resignation rate below this
+# (once there are RESIGN_MIN_PLAYOUTS positions that would have resigned)
+RESIGN_FALSE_RATE = float(os.environ.get("RESIGN_FALSE_RATE", 0.05))
+RESIGN_MIN_PLAYOUTS = int(os.environ.get("RESIGN_MIN_PLAYOUTS", 20))
+# the results of the played out games, shared by all self-play processes using the same memory folder
+RESIGN_PLAYOUTS_FILE = os.environ.get("RESIGN_PLAYOUTS_FILE", os.path.join(MEMORY_DIR, "resign_playouts.jsonl"))
+
+# ============= OPENING CACHE =============
+# persistent cache of the root searches of the first OPENING_CACHE_PLIES plies (see opening_cache.py),
+# shared by all processes that use the same file. Entries are kept per model version (see MODEL_VERSION)
+OPENING_CACHE = os.environ.get("OPENING_CACHE", "false") == "true"
+OPENING_CACHE_FILE = os.environ.get("OPENING_CACHE_FILE", os.path.join(MEMORY_DIR, "opening_cache.sqlite"))
+OPENING_CACHE_PLIES = int(os.environ.get("OPENING_CACHE_PLIES", 8))
+# simulations added to a cached search every time it is used, until it has OPENING_CACHE_MAX_SIMULATIONS
+OPENING_CACHE_TOP_UP = int(os.environ.get("OPENING_CACHE_TOP_UP", 50))
+OPENING_CACHE_MAX_SIMULATIONS = int(os.environ.get("OPENING_CACHE_MAX_SIMULATIONS", 4 * SIMULATIONS_PER_MOVE))
 
 # ============= SOCKET CONFIGURATION =============
-SOCKET_BUFFER_SIZE = 8192
\ No newline at end of file
+SOCKET_BUFFER_SIZE = 8192
+SOCKET_HOST = os.environ.get("SOCKET_HOST", "localhost")
+SOCKET_PORT = int(os.environ.get("SOCKET_PORT", 5000))
+# multiple prediction servers (tcp): comma separated host:port pairs, defaults to SOCKET_HOST:SOCKET_PORT
+SOCKET_HOSTS = [
+    (address.rsplit(":", 1)[0], int(address.rsplit(":", 1)[1]))
+    for address in os.environ.get("SOCKET_HOSTS", f"{SOCKET_HOST}:{SOCKET_PORT}").split(",")
+]
+# how requests are spread over multiple servers: "least-loaded" or "hash" (consistent hashing on the position)
+SHARDING = os.environ.get("SHARDING", "least-loaded")
+# seconds between attempts to reconnect to servers that are down
+HEALTH_CHECK_INTERVAL = float(os.environ.get("HEALTH_CHECK_INTERVAL", 5))
+# how agents reach the server: "tcp", "unix" (unix domain socket at SOCKET_PATH)
+# or "shm" (shared memory ring buffer, signalled over the unix socket SOCKET_PATH.shm)
+SOCKET_TRANSPORT = os.environ.get("SOCKET_TRANSPORT", "tcp")
+# the server also listens on this unix socket (and on SOCKET_PATH.shm), unless it is set to an empty string.
+# The default depends on SOCKET_PORT, so servers on different ports of a host don't share the path
+SOCKET_PATH = os.environ.get("SOCKET_PATH", f"/tmp/chess-rl-{SOCKET_PORT}.sock")
+# amount of slots in a shared memory ring buffer (= max requests in flight per connection)
+SHM_SLOTS = int(os.environ.get("SHM_SLOTS", 8))
+# the server refuses shared memory clients that ask for more slots
+SHM_MAX_SLOTS = int(os.environ.get("SHM_MAX_SLOTS", 256))
+# amount of connections every agent opens to the server
+SERVER_CONNECTIONS = int(os.environ.get("SERVER_CONNECTIONS", 1))
+# every request carries the id of the model that should answer it (padded to this length)
+MODEL_ID_LENGTH = 32
+# the model the agents ask the server for: MODEL_FOLDER/<MODEL_ID>.h5
+MODEL_ID = os.environ.get("MODEL_ID", "model")
+# the version of the model, stored with cached searches and replay games: by default a hash of the model file.
+# Set it if the model file is not available to the client
+MODEL_VERSION = os.environ.get("MODEL_VERSION", "")
+# priority class of this client's requests: interactive, evaluation, selfplay or reanalysis
+REQUEST_PRIORITY = os.environ.get("REQUEST_PRIORITY", "selfplay")
+# milliseconds the server may queue a request before dropping it (0: no deadline)
+REQUEST_DEADLINE = int(os.environ.get("REQUEST_DEADLINE", 0))
+
+# ============= SERVER CONFIGURATION =============
+# models to load at startup (comma separated ids), other models are loaded on first request
+SERVED_MODELS = os.environ.get("SERVED_MODELS", "model").split(",")
+# seconds between checks of the model folder for updated models
+MODEL_RELOAD_INTERVAL = float(os.environ.get("MODEL_RELOAD_INTERVAL", 10))
+# requests from all clients are predicted in batches of up to MAX_BATCH_SIZE inputs,
+# a batch is predicted when it is full or when its oldest request waited BATCH_TIMEOUT seconds
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 64))
+# batch sizes the model functions are traced for at startup, batches are padded to the nearest one
+BATCH_BUCKETS = [int(size) for size in os.environ.get("BATCH_BUCKETS", "1,2,4,8,16,32,64,128,256").split(",")]
+# inference worker processes (0: predict in the server process), see inference_worker.py
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 0))
+# tensorflow thread pools per worker (0: the default, or one intra-op thread per pinned core)
+INTRA_OP_THREADS = int(os.environ.get("INTRA_OP_THREADS", 0))
+INTER_OP_THREADS = int(os.environ.get("INTER_OP_THREADS", 0))
+# cores per worker: auto (split the cores evenly), none, or core lists like "0-3;4-7"
+WORKER_CPUS = os.environ.get("WORKER_CPUS", "auto")
+BATCH_TIMEOUT = float(os.environ.get("BATCH_TIMEOUT", 0.001))
+# amount of predictions the server keeps in its LRU cache (0 = disabled)
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 0))
+# live stats are served on localhost:STATS_PORT, or on the unix socket STATS_SOCKET if it is set
+STATS_PORT = int(os.environ.get("STATS_PORT", 5001))
+STATS_SOCKET = os.environ.get("STATS_SOCKET", "")
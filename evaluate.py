@@ -1,54 +1,290 @@
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+
+import backends
+import config
 from agent import Agent
+from backends import InferenceBackend
 from chessEnv import ChessEnv
 from game import Game
 
+# the default opening suite (moves in UCI notation): every opening is played with both colors,
+# so deterministic searches still play different games
+OPENINGS = [
+	"e2e4 e7e5 g1f3 b8c6 f1b5",
+	"e2e4 e7e5 g1f3 b8c6 f1c4",
+	"e2e4 e7e5 g1f3 b8c6 d2d4 e5d4",
+	"e2e4 e7e5 g1f3 g8f6",
+	"e2e4 e7e5 f2f4 e5f4",
+	"e2e4 c7c5 g1f3 d7d6",
+	"e2e4 c7c5 b1c3 b8c6",
+	"e2e4 e7e6 d2d4 d7d5",
+	"e2e4 c7c6 d2d4 d7d5",
+	"e2e4 d7d5 e4d5 d8d5",
+	"e2e4 g8f6 e4e5 f6d5",
+	"e2e4 d7d6 d2d4 g8f6 b1c3 g7g6",
+	"d2d4 d7d5 c2c4 e7e6",
+	"d2d4 d7d5 c2c4 d5c4",
+	"d2d4 d7d5 c2c4 c7c6",
+	"d2d4 d7d5 c1f4 g8f6",
+	"d2d4 g8f6 c2c4 g7g6 b1c3 f8g7",
+	"d2d4 g8f6 c2c4 e7e6 b1c3 f8b4",
+	"d2d4 g8f6 c2c4 e7e6 g1f3 b7b6",
+	"d2d4 g8f6 c2c4 c7c5 d4d5 b7b5",
+	"d2d4 f7f5 g2g3 g8f6",
+	"c2c4 e7e5 b1c3 g8f6",
+	"c2c4 c7c5 g1f3 g8f6",
+	"g1f3 d7d5 g2g3 g8f6",
+]
+
+
+def load_openings(path: str = None) -> list[str]:
+	"""
+	The starting positions (FEN) of the opening suite. A file has one opening per line:
+	a FEN, or moves in UCI notation from the starting position.
+	"""
+	lines = OPENINGS
+	if path is not None:
+		with open(path) as f:
+			lines = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+	openings = []
+	for line in lines:
+		if "/" in line:
+			openings.append(chess.Board(line).fen())
+			continue
+		board = chess.Board()
+		for move in line.split():
+			board.push_uci(move)
+		openings.append(board.fen())
+	return openings
+
+
+def expected_score(elo: float) -> float:
+	return 1 / (1 + 10 ** (-elo / 400))
+
+
+def elo_difference(score: float) -> float:
+	"""
+	The Elo difference for an expected score, infinite for a score of 0 or 1.
+	"""
+	if score <= 0:
+		return -math.inf
+	if score >= 1:
+		return math.inf
+	return 400 * math.log10(score / (1 - score))
+
+
+class SPRT:
+	def __init__(self, elo0: float, elo1: float, alpha: float = 0.05, beta: float = 0.05):
+		"""
+		Sequential probability ratio test of H0: the Elo difference is elo0, against H1: it is elo1.
+		The log-likelihood ratio uses the normal approximation of the score (like fishtest):
+		after every game, the test accepts H1 if the LLR is above log((1 - beta) / alpha),
+		H0 if it is below log(beta / (1 - alpha)), or continues.
+		"""
+		self.elo0, self.elo1 = elo0, elo1
+		self.lower = math.log(beta / (1 - alpha))
+		self.upper = math.log((1 - beta) / alpha)
+		self.wins, self.draws, self.losses = 0, 0, 0
+
+	@property
+	def games(self) -> int:
+		return self.wins + self.draws + self.losses
+
+	def add(self, score: float):
+		"""
+		Add a game result: 1 (win), 0.5 (draw) or 0 (loss).
+		"""
+		if score == 1:
+			self.wins += 1
+		elif score == 0:
+			self.losses += 1
+		else:
+			self.draws += 1
+
+	def score(self) -> tuple[float, float]:
+		"""
+		The mean score and its variance per game. Half a win and half a loss are added as prior,
+		so the variance is not 0 when all games have the same result.
+		"""
+		wins, draws, losses = self.wins + 0.5, self.draws, self.losses + 0.5
+		n = wins + draws + losses
+		mean = (wins + draws / 2) / n
+		variance = (wins * (1 - mean) ** 2 + draws * (0.5 - mean) ** 2 + losses * mean ** 2) / n
+		return mean, variance
+
+	def llr(self) -> float:
+		if not self.games:
+			return 0.0
+		mean, variance = self.score()
+		s0, s1 = expected_score(self.elo0), expected_score(self.elo1)
+		return self.games * (s1 - s0) * (2 * mean - s0 - s1) / (2 * variance)
+
+	def status(self) -> str:
+		"""
+		'H1' (elo1 accepted), 'H0' (elo0 accepted) or None (continue).
+		"""
+		llr = self.llr()
+		if llr >= self.upper:
+			return "H1"
+		if llr <= self.lower:
+			return "H0"
+		return None
+
+	def elo(self, z: float = 1.96) -> tuple[float, float, float]:
+		"""
+		The estimated Elo difference and its confidence interval (95% by default).
+		"""
+		mean, variance = self.score()
+		margin = z * math.sqrt(variance / max(self.games, 1))
+		return elo_difference(mean), elo_difference(mean - margin), elo_difference(mean + margin)
+
+
 class Evaluation:
-	def __init__(self, model_1_path: str, model_2_path: str):
+	def __init__(self, model_1_path: str, model_2_path: str, local_predictions: bool = True, concurrency: int = 8,
+				 openings: str = None):
+		"""
+		Evaluate two models against each other in an arena: games are played concurrently (in threads),
+		from the positions of an opening suite, with both colors. Without local predictions, both models
+		are served by the prediction server: the model id is the file name without extension.
+		Locally, the predictions of every model are batched across the games.
+		"""
 		self.model_1 = model_1_path
 		self.model_2 = model_2_path
+		self.local_predictions = local_predictions
+		self.concurrency = concurrency
+		self.openings = load_openings(openings)
+		self.lock = threading.Lock()
+		self.stopped = False
 
+	def create_backend(self, model_path: str) -> InferenceBackend:
+		if self.local_predictions:
+			backend = backends.create_backend(backends.backend_for_path(model_path), model_path)
+			return backends.BatchingBackend(backend, max_batch_size=self.concurrency)
+		model_id = os.path.splitext(os.path.basename(model_path))[0]
+		try:
+			return backends.create_backend("server", model_id=model_id, priority="evaluation")
+		except OSError as e:
+			raise ConnectionError(f"Could not connect to the prediction server: {e}") from e
 
-	def evaluate(self, n: int):
+	def play_game(self, opening: str, white: InferenceBackend, black: InferenceBackend):
 		"""
-		For n games, let the two models play each other and keep a score
+		Play one game from the opening, deterministically. Every game has its own agents (and search trees).
+		Returns the result for white (1, 0.5 or 0), the amount of moves and whether the game was adjudicated,
+		or None if the arena stopped.
 		"""
-		score = {
-			"model_1": 0,
-			"model_2": 0,
-			"amount_of_draws": 0
-		}
-		agent_1 = Agent(local_predictions=True, model_path=self.model_1)
-		agent_2 = Agent(local_predictions=True, model_path=self.model_2)
-		for i in range(n):
-			print(f"{'*'*10}\nPlaying match {i+1}/{n}\n{'*'*10}")
-			game = Game(ChessEnv(), agent_1, agent_2)
-			# play deterministally
+		if self.stopped:
+			return None
+		game = Game(ChessEnv(opening), Agent(backend=white), Agent(backend=black))
+		# arena games are not training data, and are played to the end
+		game.save_games = False
+		game.resignation = None
+		try:
 			result = game.play_one_game(stochastic=False)
-			if result == 0: score["amount_of_draws"] += 1
-			elif result == 1: score["model_1"] += 1
-			else: score["model_2"] += 1
-			# turn around the colors
-			game = Game(ChessEnv(), agent_2, agent_1)
-			result = game.play_one_game(stochastic=False)
-			if result == 0: score["amount_of_draws"] += 1
-			elif result == 1: score["model_2"] += 1
-			else: score["model_1"] += 1
-		
+		finally:
+			game.close()
+		# without resignation, a game that isn't over was adjudicated (move limit or repetition):
+		# it is a draw, or a win for the side that is ahead (see ARENA_ADJUDICATION)
+		adjudicated = not game.env.board.is_game_over()
+		if adjudicated and config.ARENA_ADJUDICATION != "win":
+			result = 0
+		score = 1 if result > 0 else 0 if result < 0 else 0.5
+		return score, len(game.env.board.move_stack), adjudicated
+
+	def evaluate(self, n: int, sprt: SPRT = None):
+		"""
+		Play up to n game pairs (every model plays both colors of an opening), and keep a score.
+		With an SPRT, the arena stops as soon as the test is decided: the games in progress are finished,
+		the others are not played.
+		Raises ConnectionError if the connection to the prediction server is lost: the arena is aborted.
+		"""
+		backend_1 = self.create_backend(self.model_1)
+		backend_2 = self.create_backend(self.model_2)
+		sprt = sprt or SPRT(0, 0)
+		start_time = time.time()
+		moves, adjudicated, status, connection_error = 0, 0, None, None
+		def finished(future, model_1_white: bool):
+			nonlocal moves, adjudicated, status, connection_error
+			if isinstance(future.exception(), ConnectionError):
+				with self.lock:
+					if connection_error is None:
+						logging.error(f"Arena game failed, stopping the arena: {future.exception()}")
+						connection_error = future.exception()
+						self.stopped = True
+				return
+			if future.exception() is not None:
+				logging.warning(f"Arena game failed: {future.exception()}")
+				return
+			if future.result() is None:
+				return
+			score, game_moves, game_adjudicated = future.result()
+			with self.lock:
+				sprt.add(score if model_1_white else 1 - score)
+				moves += game_moves
+				adjudicated += game_adjudicated
+				logging.info(f"Arena: {sprt.games} games, +{sprt.wins} ={sprt.draws} -{sprt.losses}, "
+							 f"LLR {sprt.llr():.2f} [{sprt.lower:.2f}, {sprt.upper:.2f}]")
+				if status is None and sprt.elo0 != sprt.elo1:
+					status = sprt.status()
+					if status is not None:
+						logging.info(f"SPRT decided ({status}), finishing the games in progress")
+						self.stopped = True
+		with ThreadPoolExecutor(self.concurrency) as executor:
+			for i in range(n):
+				opening = self.openings[i % len(self.openings)]
+				for model_1_white in (True, False):
+					white, black = (backend_1, backend_2) if model_1_white else (backend_2, backend_1)
+					future = executor.submit(self.play_game, opening, white, black)
+					future.add_done_callback(lambda future, model_1_white=model_1_white: finished(future, model_1_white))
+		backend_1.close()
+		backend_2.close()
+		if connection_error is not None:
+			raise ConnectionError(f"Arena aborted after {sprt.games} games: {connection_error}") from connection_error
+
+		elo, elo_low, elo_high = sprt.elo()
+		skipped = 2 * n - sprt.games
+		average_moves = moves / sprt.games if sprt.games else 0
+		decision = {"H1": f"model 1 is stronger (elo1 = {sprt.elo1})", "H0": f"model 1 is not stronger (elo0 = {sprt.elo0})",
+					None: "undecided"}[status]
 		return f"Evaluated these models: Model 1 = {self.model_1}, Model 2 = {self.model_2}\n" + \
-		f"The results: \nModel 1: {score['model_1']} \nModel 2: {score['model_2']} \nDraws: {score['amount_of_draws']}"
+		f"The results: \nModel 1: {sprt.wins} \nModel 2: {sprt.losses} \nDraws: {sprt.draws}\n" + \
+		f"Games played: {sprt.games}/{2 * n} in {time.time() - start_time:.0f}s ({self.concurrency} concurrent, {len(self.openings)} openings)\n" + \
+		f"Adjudicated: {adjudicated} games (scored as {'a win for the side ahead' if config.ARENA_ADJUDICATION == 'win' else 'draws'})\n" + \
+		f"SPRT: {decision}, LLR {sprt.llr():.2f}\n" + \
+		f"Saved: {skipped} games ({skipped / (2 * n):.0%}), about {skipped * average_moves * config.SIMULATIONS_PER_MOVE:.0f} evaluations\n" + \
+		f"Elo difference (model 1 - model 2): {elo:+.0f} (95% confidence interval: {elo_low:+.0f} to {elo_high:+.0f})"
 
 
 if __name__ == "__main__":
+	logging.basicConfig(level=logging.INFO, format=' %(message)s')
 	# get args
 	import argparse
 	parser = argparse.ArgumentParser(description="Evaluate two models")
 	parser.add_argument("model_1", help="Path to model 1", type=str)
 	parser.add_argument("model_2", help="Path to model 2", type=str)
-	parser.add_argument("nr_games", help="Number of games to play (x2: every model plays both white and black)", type=int)
+	parser.add_argument("nr_games", help="Maximum number of games to play (x2: every model plays both white and black)", type=int)
+	parser.add_argument("--server", action="store_true", help="Let the prediction server serve both models (they must be in its model folder)")
+	parser.add_argument("--concurrency", type=int, default=8, help="Amount of games played at the same time")
+	parser.add_argument("--openings", type=str, default=None, help="Opening suite: a file with a FEN or UCI moves per line")
+	parser.add_argument("--elo0", type=float, default=0, help="SPRT: Elo difference of H0")
+	parser.add_argument("--elo1", type=float, default=50, help="SPRT: Elo difference of H1 (equal to elo0: no early stopping)")
+	parser.add_argument("--alpha", type=float, default=0.05, help="SPRT: false positive rate")
+	parser.add_argument("--beta", type=float, default=0.05, help="SPRT: false negative rate")
 	args = parser.parse_args()
 
 	# args to dict
 	args = vars(args)
-	
-	evaluation = Evaluation(args["model_1"], args["model_2"])
-	print(evaluation.evaluate(int(args["nr_games"])))
\ No newline at end of file
+
+	evaluation = Evaluation(args["model_1"], args["model_2"], local_predictions=not args["server"],
+							concurrency=args["concurrency"], openings=args["openings"])
+	try:
+		print(evaluation.evaluate(int(args["nr_games"]), SPRT(args["elo0"], args["elo1"], args["alpha"], args["beta"])))
+	except ConnectionError as e:
+		print(e)
+		exit(1)
@@ -0,0 +1,204 @@
+# Export a trained Keras model for fast CPU inference:
+#   * a frozen graph (.pb): all variables converted to constants
+#   * a TFLite model (.tflite), optionally quantized:
+#       - dynamic: weights in int8, activations in float
+#       - int8:    weights and activations in int8, calibrated on positions from the replay memory
+#       - float16: weights in float16
+#   * NumPy weights (.npz) for numpy_prediction.py: BatchNorm folded into the
+#     convolutions, kernels reshaped for im2col, so no tensorflow is needed to predict
+# After exporting, the accuracy drift against the original model and the
+# CPU throughput of both models can be reported.
+import argparse
+import logging
+import os
+import time
+from typing import Tuple
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+
+import config
+from chessEnv import ChessEnv
+import replay
+from rlmodelbuilder import RLModelBuilder
+
+logging.basicConfig(level=logging.INFO, format=' %(message)s')
+
+
+def save_frozen_graph(model, path: str):
+    """
+    Save the model as a frozen graph (GraphDef with constants instead of variables).
+    """
+    frozen = RLModelBuilder.freeze_model(model)
+    folder, name = os.path.split(path)
+    tf.io.write_graph(frozen.graph.as_graph_def(), folder or ".", name, as_text=False)
+    logging.info(f"Frozen graph saved to {path}")
+
+
+def load_calibration_positions(memory_folder: str, amount: int) -> np.ndarray:
+    """
+    Load random positions from the replay memory, converted to model inputs.
+    """
+    files = [f for f in os.listdir(memory_folder) if f.endswith((".npy", ".rpl"))]
+    np.random.shuffle(files)
+    inputs, count = [], 0
+    for file in files:
+        if file.endswith(".rpl"):
+            positions = replay.read_replay(os.path.join(memory_folder, file)).positions
+            inputs.append(replay.decode_inputs(positions))
+        else:
+            game = np.load(os.path.join(memory_folder, file), allow_pickle=True)
+            inputs.append(np.concatenate([ChessEnv.state_to_input(position[0]) for position in game]))
+        count += len(inputs[-1])
+        if count >= amount:
+            break
+    if not count:
+        raise ValueError(f"No positions found in {memory_folder}")
+    inputs = np.concatenate(inputs)
+    np.random.shuffle(inputs)
+    return inputs[:amount]
+
+
+def export_tflite(model, path: str, quantization: str = "none", calibration: np.ndarray = None):
+    """
+    Convert the model to TFLite. Inputs and outputs stay float32, so the exported model
+    is a drop-in replacement no matter how it is quantized.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == "dynamic":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if calibration is None:
+            raise ValueError("int8 quantization needs calibration positions")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([position[np.newaxis].astype(np.float32)] for position in calibration)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization != "none":
+        raise ValueError(f"Unknown quantization: {quantization}")
+    tflite_model = converter.convert()
+    with open(path, "wb") as f:
+        f.write(tflite_model)
+    logging.info(f"TFLite model ({quantization}) saved to {path}: {len(tflite_model) / 1e6:.1f} MB")
+
+
+def fold_batch_norm(conv, batch_norm) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fold the (inference mode) BatchNorm into the preceding convolution.
+    Returns the kernel as a (in_channels*kh*kw, filters) matrix and the bias.
+    """
+    kernel = conv.kernel.numpy()
+    bias = conv.bias.numpy() if conv.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    scale = batch_norm.gamma.numpy() / np.sqrt(batch_norm.moving_variance.numpy() + batch_norm.epsilon)
+    # (kh, kw, in, out) => (in, kh, kw, out): the order of the im2col patches
+    kernel = (kernel * scale).transpose(2, 0, 1, 3).reshape(-1, kernel.shape[-1])
+    bias = (bias - batch_norm.moving_mean.numpy()) * scale + batch_norm.beta.numpy()
+    return kernel.astype(np.float32), bias.astype(np.float32)
+
+
+def export_npz(model, path: str):
+    """
+    Save the weights of the model for the NumPy forward pass (see numpy_prediction.py).
+    """
+    convs = [layer for layer in model.layers if isinstance(layer, tf.keras.layers.Conv2D)]
+    batch_norms = [layer for layer in model.layers if isinstance(layer, tf.keras.layers.BatchNormalization)]
+    weights = {"residual_blocks": np.array((len(convs) - 1) // 2)}
+    for i, (conv, batch_norm) in enumerate(zip(convs, batch_norms)):
+        weights[f"trunk_w_{i}"], weights[f"trunk_b_{i}"] = fold_batch_norm(conv, batch_norm)
+    for name in ("policy", "value"):
+        head = model.get_layer(f"{name}_head")
+        conv, batch_norm = head.layers[0], head.layers[1]
+        weights[f"{name}_conv_w"], weights[f"{name}_conv_b"] = fold_batch_norm(conv, batch_norm)
+    policy_dense = [layer for layer in model.get_layer("policy_head").layers if isinstance(layer, tf.keras.layers.Dense)]
+    value_dense = [layer for layer in model.get_layer("value_head").layers if isinstance(layer, tf.keras.layers.Dense)]
+    weights["policy_dense_w"], weights["policy_dense_b"] = policy_dense[0].get_weights()
+    for i, layer in enumerate(value_dense, start=1):
+        weights[f"value_dense_{i}_w"], weights[f"value_dense_{i}_b"] = layer.get_weights()
+    np.savez(path, **weights)
+    logging.info(f"NumPy weights saved to {path}: {os.path.getsize(path) / 1e6:.1f} MB")
+
+
+def normalize(policies: np.ndarray) -> np.ndarray:
+    policies = np.maximum(policies.astype(np.float64), 1e-12)
+    return policies / policies.sum(axis=1, keepdims=True)
+
+
+def measure_throughput(predict, positions: np.ndarray, batch_size: int, repeats: int = 3) -> float:
+    """
+    Positions per second when predicting in batches of the given size.
+    """
+    batches = [positions[i:i + batch_size] for i in range(0, len(positions) - batch_size + 1, batch_size)]
+    # warm up
+    predict(batches[0])
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        for batch in batches:
+            predict(batch)
+    return repeats * len(batches) * batch_size / (time.perf_counter() - start_time)
+
+
+def compare(reference, candidate, positions: np.ndarray, batch_sizes: Tuple[int, ...] = (1, 32)) -> dict:
+    """
+    Compare a candidate predict function against the reference:
+    the drift of the outputs (policy KL divergence, value MSE) and the throughput of both.
+    """
+    p_ref, v_ref = reference(positions)
+    p_cand, v_cand = candidate(positions)
+    p_ref, p_cand = normalize(np.asarray(p_ref)), normalize(np.asarray(p_cand))
+    report = {
+        "positions": len(positions),
+        "policy_kl": float(np.mean(np.sum(p_ref * np.log(p_ref / p_cand), axis=1))),
+        "policy_top1_agreement": float(np.mean(p_ref.argmax(axis=1) == p_cand.argmax(axis=1))),
+        "value_mse": float(np.mean((np.asarray(v_ref) - np.asarray(v_cand)) ** 2)),
+    }
+    for batch_size in batch_sizes:
+        if batch_size > len(positions):
+            continue
+        report[f"reference_positions_per_second@{batch_size}"] = measure_throughput(reference, positions, batch_size)
+        report[f"candidate_positions_per_second@{batch_size}"] = measure_throughput(candidate, positions, batch_size)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a model for fast CPU inference")
+    parser.add_argument("model", type=str, help="Path to the Keras model (.h5)")
+    parser.add_argument("--output", type=str, default=None, help="Output path (default: the model path with the new extension)")
+    parser.add_argument("--format", type=str, default="tflite", choices=("tflite", "frozen", "npz"), help="Export format")
+    parser.add_argument("--quantization", type=str, default="none", choices=("none", "dynamic", "float16", "int8"), help="TFLite quantization")
+    parser.add_argument("--memory-folder", type=str, default=config.MEMORY_DIR, help="Replay memory to take calibration/comparison positions from")
+    parser.add_argument("--positions", type=int, default=256, help="Amount of positions for calibration and comparison")
+    parser.add_argument("--compare", action="store_true", help="Report accuracy drift and throughput against the original model")
+    args = parser.parse_args()
+    args = vars(args)
+
+    model = load_model(args["model"])
+    extension = {"tflite": ".tflite", "frozen": ".pb", "npz": ".npz"}[args["format"]]
+    output = args["output"] or os.path.splitext(args["model"])[0] + extension
+
+    positions = None
+    if args["quantization"] == "int8" or args["compare"]:
+        positions = load_calibration_positions(args["memory_folder"], args["positions"])
+
+    if args["format"] == "frozen":
+        save_frozen_graph(model, output)
+        predictor = None
+    elif args["format"] == "npz":
+        export_npz(model, output)
+        from numpy_prediction import NumpyPredictor
+        predictor = NumpyPredictor(output)
+    else:
+        export_tflite(model, output, args["quantization"], positions)
+        from tflite_prediction import TFLitePredictor
+        predictor = TFLitePredictor(output)
+
+    if args["compare"] and predictor is not None:
+        from local_prediction import BucketedPredictor
+        keras_predictor = BucketedPredictor(model)
+        keras_predictor.warm_up()
+        for key, value in compare(keras_predictor.predict, predictor.predict, positions).items():
+            print(f"{key}: {value}")
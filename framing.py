@@ -0,0 +1,163 @@
+# Message framing between the agents and the prediction server (tcp and unix transports).
+#
+# request:  header (payload length, request id, kind, priority, deadline, model id) + the input: 1216 booleans
+#           the deadline is in milliseconds after the server received the request (0: no deadline)
+#           a value request (kind 1) carries up to MAX_VALUE_POSITIONS inputs
+# response: header (payload length, request id, status) + the output: float32 policy and value,
+#           or the float32 values of a value request (or an utf-8 error message if the status is not OK)
+#
+# Messages are read with recv_into into preallocated buffers and sent with sendmsg
+# (scatter/gather), so no Python-level copies are made of the inputs and outputs.
+import socket
+import struct
+from typing import Tuple
+
+import numpy as np
+
+import config
+
+# the input is sent as booleans: 19x8x8 bytes
+INPUT_SIZE = int(np.prod(config.INPUT_SHAPE))
+# the output is sent as little-endian float32: the policy followed by the value
+OUTPUT_DTYPE = np.dtype("<f4")
+OUTPUT_SIZE = (config.OUTPUT_SHAPE[0] + 1) * OUTPUT_DTYPE.itemsize
+
+REQUEST_HEADER = struct.Struct(f"!IIBBI{config.MODEL_ID_LENGTH}s")
+RESPONSE_HEADER = struct.Struct("!IIB")
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# request kinds: a full prediction of one input, or only the values of a batch of inputs
+KIND_PREDICT = 0
+KIND_VALUES = 1
+# fewer values than a policy, so a response's length tells its kind
+MAX_VALUE_POSITIONS = 1024
+
+# priority classes: the server predicts requests with a lower number first
+PRIORITIES = {"interactive": 0, "evaluation": 1, "selfplay": 2, "reanalysis": 3}
+DEFAULT_PRIORITY = PRIORITIES[config.REQUEST_PRIORITY]
+
+
+def recv_into_exact(sock: socket.socket, view: memoryview) -> bool:
+    """
+    Fill the whole view with data from the socket. Returns False if the socket was closed.
+    """
+    received, count = 0, len(view)
+    while received < count:
+        n = sock.recv_into(view[received:], count - received)
+        if n == 0:
+            return False
+        received += n
+    return True
+
+
+def recv_exact(sock: socket.socket, count: int) -> bytes:
+    """
+    Receive exactly count bytes (for small messages). Returns an empty bytes object if the socket was closed.
+    """
+    buffer = bytearray(count)
+    if not recv_into_exact(sock, memoryview(buffer)):
+        return b''
+    return bytes(buffer)
+
+
+def send_all(sock: socket.socket, buffers: list):
+    """
+    Send all buffers with as few system calls as possible, without joining them first.
+    """
+    views = [memoryview(buffer).cast("B") for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        # drop the buffers that were sent completely, and the sent part of the next one
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+
+class BufferPool:
+    def __init__(self, size: int):
+        """
+        Pool of reusable buffers of the same size.
+        """
+        self.size = size
+        self.free: list[bytearray] = []
+
+    def get(self) -> bytearray:
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buffer: bytearray):
+        self.free.append(buffer)
+
+
+class FrameReader:
+    def __init__(self, sock: socket.socket, header: struct.Struct):
+        """
+        Reads frames from a socket, the header is read into a preallocated buffer.
+        """
+        self.sock = sock
+        self.header = header
+        self.header_buffer = bytearray(header.size)
+        self.header_view = memoryview(self.header_buffer)
+
+    def read_header(self):
+        """
+        Read the next header, returns None if the socket was closed.
+        """
+        if not recv_into_exact(self.sock, self.header_view):
+            return None
+        return self.header.unpack_from(self.header_buffer)
+
+    def read_payload(self, buffer) -> bool:
+        return recv_into_exact(self.sock, memoryview(buffer).cast("B"))
+
+
+def send_request(sock: socket.socket, request_id: int, model_id: str, data: np.ndarray,
+                 priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE, kind: int = KIND_PREDICT):
+    header = REQUEST_HEADER.pack(data.nbytes, request_id, kind, priority, deadline, model_id.encode("ascii"))
+    send_all(sock, [header, np.ascontiguousarray(data)])
+
+
+def send_response(sock: socket.socket, request_id: int, policy: np.ndarray, value: float):
+    policy = np.asarray(policy, dtype=OUTPUT_DTYPE)
+    value = np.asarray([value], dtype=OUTPUT_DTYPE)
+    header = RESPONSE_HEADER.pack(policy.nbytes + value.nbytes, request_id, STATUS_OK)
+    send_all(sock, [header, policy, value])
+
+
+def send_values(sock: socket.socket, request_id: int, values: np.ndarray):
+    values = np.asarray(values, dtype=OUTPUT_DTYPE)
+    send_all(sock, [RESPONSE_HEADER.pack(values.nbytes, request_id, STATUS_OK), values])
+
+
+def send_error(sock: socket.socket, request_id: int, message: str):
+    message = message.encode("utf-8")
+    send_all(sock, [RESPONSE_HEADER.pack(len(message), request_id, STATUS_ERROR), message])
+
+
+def read_response(reader: FrameReader):
+    """
+    Read a response. Returns (request id, (policy, value)), (request id, values) for a value request
+    or (request id, error message), or None if the socket was closed.
+    The output is read straight into a new array: the policy is a view on it.
+    """
+    header = reader.read_header()
+    if header is None:
+        return None
+    length, request_id, status = header
+    if status != STATUS_OK:
+        message = bytearray(length)
+        if not reader.read_payload(message):
+            return None
+        return request_id, message.decode("utf-8")
+    output = np.empty(length // OUTPUT_DTYPE.itemsize, dtype=OUTPUT_DTYPE)
+    if not reader.read_payload(output):
+        return None
+    if length != OUTPUT_SIZE:
+        return request_id, output
+    return request_id, (output[:-1], float(output[-1]))
@@ -8,9 +8,15 @@ import config
 from chess.pgn import Game as ChessGame
 from edge import Edge
 from mcts import MCTS
+from resignation import Resignation, search_value
+from replay_buffer import ReplayBuffer, ReplayWriter
 import uuid
-import pandas as pd
+import chess
 import numpy as np
+from typing import TYPE_CHECKING, Sequence
+
+if TYPE_CHECKING:
+    from puzzle_index import Puzzle
 
 class Game:
     def __init__(self, env: ChessEnv, white: Agent, black: Agent):
@@ -22,6 +28,14 @@ class Game:
         self.black = black
 
         self.memory = []
+        # set to end the current game after the current move (it is adjudicated and saved)
+        self.adjourn = False
+        # value-based resignation (see resignation.py)
+        self.resignation = Resignation() if config.RESIGNATION else None
+        # writes the games to the replay buffer in the background (see REPLAY_FORMAT), created when needed
+        self.writer: ReplayWriter = None
+        # set to False to not save the played games (e.g. evaluation games, which are no training data)
+        self.save_games = True
 
         self.reset()
 
@@ -34,22 +48,41 @@ class Game:
         return 1 if result == "1-0" else - 1 if result == "0-1" else 0
 
 
+    def adjudicate(self) -> float:
+        """
+        Estimate the winner of an unfinished game (see ADJUDICATION).
+        Like the material estimate, a win is scored as 0.25 for white or -0.25 for black.
+        """
+        if config.ADJUDICATION != "value":
+            return ChessEnv.estimate_winner(self.env.board)
+        # the value is from white's perspective
+        value = float(self.white.predict_values(ChessEnv.state_to_input(self.env.board.fen()))[0])
+        logging.debug(f"Value of the final position: {value}")
+        if abs(value) > config.ADJUDICATION_THRESHOLD:
+            return 0.25 if value > 0 else -0.25
+        return 0
+
     @utils.time_function
     def play_one_game(self, stochastic: bool = True) -> int:
         """
         Play one game from the starting position, and save it to memory.
         Keep playing moves until either the game is over, or it has reached the move limit.
         If the move limit is reached, the winner is estimated.
+        With resignation enabled, a side can resign when its search's value is hopeless.
         """
         # reset everything
         self.reset()
         # add a new memory entry
         self.memory.append([])
+        if self.resignation is not None:
+            self.resignation.new_game()
         # show the board
         logging.info(f"\n{self.env.board}")
         # counter to check amount of moves played. if above limit, estimate winner
-        counter, previous_edges, full_game = 0, (None, None), True
+        counter, previous_edges, full_game, resigned = 0, (None, None), True, None
         while not self.env.board.is_game_over():
+            # the side that plays this move
+            color = self.turn
             # play one move (previous move is used for updating the MCTS tree)
             previous_edges = self.play_move(stochastic=stochastic, previous_moves=previous_edges)
             logging.info(f"\n{self.env.board}")
@@ -59,12 +92,25 @@ class Game:
                 self.GUI.gameboard.board.set_fen(self.env.board.fen()) 
                 self.GUI.draw()
 
+            if self.resignation is not None:
+                value = search_value((self.white if color == chess.WHITE else self.black).mcts)
+                if self.resignation.update(color, value):
+                    resigned = color
+                    winner = -1 if color == chess.WHITE else 1
+                    logging.info(f"{'White' if color == chess.WHITE else 'Black'} resigns (value {value:.3f}, "
+                                 f"threshold {self.resignation.threshold:.3f}). Result: {winner}")
+                    full_game = False
+                    break
+
             # end if the game drags on too long
             counter += 1
-            if counter > config.MAX_GAME_MOVES or self.env.board.is_repetition(3):
-                # estimate the winner based on piece values
-                winner = ChessEnv.estimate_winner(self.env.board)
-                logging.info(f"Game over by move limit ({config.MAX_GAME_MOVES}). Result: {winner}")
+            if counter > config.MAX_GAME_MOVES or self.env.board.is_repetition(3) or self.adjourn:
+                # estimate the winner based on piece values or the model's value
+                winner = self.adjudicate()
+                if self.adjourn:
+                    logging.info(f"Game adjourned after {counter} moves. Result: {winner}")
+                else:
+                    logging.info(f"Game over by move limit ({config.MAX_GAME_MOVES}). Result: {winner}")
                 full_game = False
                 break
         if full_game:
@@ -73,11 +119,17 @@ class Game:
             logging.info(f"Game over. Result: {winner}")
         # save game result to memory for all games
         for index, element in enumerate(self.memory[-1]):
-            self.memory[-1][index] = (element[0], element[1], winner)
+            self.memory[-1][index] = (element[0], element[1], winner, *element[3:])
+        if self.resignation is not None:
+            # played out games that ended in a real result calibrate the resign threshold
+            self.resignation.finish(winner, full_game)
 
         game = ChessGame()
         # set starting position
         game.setup(self.env.fen)
+        if resigned is not None:
+            game.headers["Result"] = "0-1" if resigned == chess.WHITE else "1-0"
+            game.headers["Termination"] = f"{'White' if resigned == chess.WHITE else 'Black'} resigns"
         # add moves
         node = game.add_variation(self.env.board.move_stack[0])
         for move in self.env.board.move_stack[1:]:
@@ -86,7 +138,10 @@ class Game:
         logging.info(game)
 
         # save memory to file
-        self.save_game(name="game", full_game=full_game)
+        if self.save_games and resigned is not None:
+            self.save_game(name="resigned", resigned="white" if resigned == chess.WHITE else "black")
+        elif self.save_games:
+            self.save_game(name="game", full_game=full_game)
 
         return winner
 
@@ -96,11 +151,20 @@ class Game:
         Otherwise, the move is chosen based on the highest N (deterministically).
         The previous moves are used to reuse the MCTS tree (if possible): the root node is set to the
         node found after playing the previous moves in the current tree.
+        If both colors are played by the same agent, they share the tree: the root is the node after the previous move.
         """
         # whose turn is it
         current_player = self.white if self.turn else self.black
 
-        if previous_moves[0] is None or previous_moves[1] is None:
+        if self.white is self.black and previous_moves[1] is not None:
+            # one tree for both sides: advance the root one ply, keeping the search of the opponent's move
+            node = previous_moves[1].output_node
+            if node.state == self.env.board.fen():
+                current_player.mcts.root = node
+            else:
+                logging.warning("WARN: Node does not exist in tree, continuing with new tree...")
+                current_player.mcts = MCTS(current_player, state=self.env.board.fen(), stochastic=stochastic)
+        elif previous_moves[0] is None or previous_moves[1] is None:
             # create new tree with root node == current board
             current_player.mcts = MCTS(current_player, state=self.env.board.fen(), stochastic=stochastic)
         else:
@@ -113,12 +177,33 @@ class Game:
                 logging.warning("WARN: Node does not exist in tree, continuing with new tree...")
                 current_player.mcts = MCTS(current_player, state=self.env.board.fen(), stochastic=stochastic)
         # play n simulations from the root node
-        current_player.run_simulations(n=config.SIMULATIONS_PER_MOVE)
+        simulations = config.SIMULATIONS_PER_MOVE
+        # with playout cap randomization, most self-play moves only get a fast search (without noise)
+        full_search = not (stochastic and config.PLAYOUT_CAP_RANDOMIZATION) or np.random.random() < config.FULL_SEARCH_FRACTION
+        if not full_search:
+            simulations = config.FAST_SIMULATIONS
+        current_player.mcts.stochastic = stochastic and full_search
+        # the search of an opening position can be cached (see OPENING_CACHE)
+        cache = current_player.opening_cache
+        if len(self.env.board.move_stack) >= config.OPENING_CACHE_PLIES:
+            cache = None
+        entry = cache.get(self.env.board) if cache is not None else None
+        if entry is not None and entry.simulations > current_player.mcts.root.N:
+            # continue the cached search instead of searching from zero
+            current_player.mcts.root = entry.to_node()
+            simulations = cache.simulations(entry, simulations)
+            logging.info(f"Opening cache: {entry.simulations} cached simulations, running {simulations} more")
+        elif self.white is self.black:
+            # the visits of the shared tree's root count towards the simulations of this move
+            simulations = max(simulations - current_player.mcts.root.N, 1)
+        current_player.run_simulations(n=simulations)
+        if cache is not None and simulations:
+            cache.put(self.env.board, current_player.mcts.root)
 
         moves = current_player.mcts.root.edges
 
         if save_moves:
-            self.save_to_memory(self.env.board.fen(), moves)
+            self.save_to_memory(self.env.board.fen(), moves, full_search=full_search)
 
         sum_move_visits = sum(e.N for e in moves)
         probs = [e.N / sum_move_visits for e in moves]
@@ -141,41 +226,63 @@ class Game:
         # return the previous move and the new move
         return (previous_moves[1], best_move)
 
-    def save_to_memory(self, state, moves) -> None:
+    def save_to_memory(self, state, moves, full_search: bool = True) -> None:
         """
         Append the current state and move probabilities to the internal memory.
+        The last field marks if the probabilities come from a full search (and are a policy target).
         """
         sum_move_visits = sum(e.N for e in moves)
         # create dictionary of moves and their probabilities
         search_probabilities = {
             e.action.uci(): e.N / sum_move_visits for e in moves}
         # winner gets added after game is over
-        self.memory[-1].append((state, search_probabilities, None))
+        self.memory[-1].append((state, search_probabilities, None, full_search))
 
-    def save_game(self, name: str = "game", full_game: bool = False) -> None:
+    def save_game(self, name: str = "game", full_game: bool = False, resigned: str = None) -> None:
         """
-        Save the internal memory to a .npy file.
+        Save the internal memory: add it to the replay buffer (in the background), or save it to a .npy file
+        (see REPLAY_FORMAT). In the replay buffer, whether the game was played to the end or resigned is
+        stored with the game. The .npy files of these games are listed in full_games.txt and resigned_games.txt.
         """
         # the game id consist of game + datetime
         game_id = f"{name}-{str(uuid.uuid4())[:8]}"
-        if full_game:
-            # if the game result was not estimated, save the game id to a seperate file (to look at later)
-            with open("full_games.txt", "a") as f:
-                f.write(f"{game_id}.npy\n")
-        np.save(os.path.join(config.MEMORY_DIR, game_id), self.memory[-1])
-        logging.info(
-            f"Game saved to {os.path.join(config.MEMORY_DIR, game_id)}.npy")
+        if config.REPLAY_FORMAT == "replay":
+            if self.writer is None:
+                self.writer = ReplayWriter(ReplayBuffer(config.MEMORY_DIR))
+            meta = {"game_id": game_id, "model": self.white.model_version(), "full_game": full_game,
+                    "resigned": resigned, "result": self.memory[-1][0][2] if self.memory[-1] else None,
+                    "time": time.time()}
+            self.writer.put(self.memory[-1], meta)
+        else:
+            np.save(os.path.join(config.MEMORY_DIR, game_id), self.memory[-1])
+            logging.info(
+                f"Game saved to {os.path.join(config.MEMORY_DIR, game_id)}.npy")
+            if full_game:
+                # if the game result was not estimated, save the game id to a seperate file (to look at later)
+                with open("full_games.txt", "a") as f:
+                    f.write(f"{game_id}.npy\n")
+            if resigned is not None:
+                with open("resigned_games.txt", "a") as f:
+                    f.write(f"{game_id}.npy {resigned}\n")
         logging.info(f"Memory size: {len(self.memory)}")
 
 
+    def close(self) -> None:
+        """
+        Wait until the saved games are written.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
     @utils.time_function
-    def train_puzzles(self, puzzles: pd.DataFrame):
+    def train_puzzles(self, puzzles: Sequence["Puzzle"]):
         """
         Create positions from puzzles (fen strings) and let the MCTS figure out how to solve them.
         The saved positions can be used to train the neural network.
         """
         logging.info(f"Training on {len(puzzles)} puzzles")
-        for puzzle in puzzles.itertuples():
+        for puzzle in puzzles:
             self.env.fen = puzzle.fen
             self.env.reset()
             # play the first move
@@ -202,7 +309,7 @@ class Game:
             # save game result to memory for all games
             winner = Game.get_winner(self.env.board.result())
             for index, element in enumerate(self.memory[-1]):
-                self.memory[-1][index] = (element[0], element[1], winner)
+                self.memory[-1][index] = (element[0], element[1], winner, *element[3:])
 
             game = ChessGame()
             # set starting position
@@ -219,20 +326,14 @@ class Game:
             self.save_game(name="puzzle")
 
     @staticmethod
-    def create_puzzle_set(filename: str, type: str = "mateIn2") -> pd.DataFrame:
+    def create_puzzle_set(filename: str, type: str = "mateIn2", min_rating: int = None,
+                          max_rating: int = None) -> Sequence["Puzzle"]:
         """
-        Load the puzzles from a csv file. The type of puzzle can be specified.
-        Return the puzzles as a Pandas DataFrame.
+        Load the puzzles of a type (theme) and rating band from a puzzle index folder (see puzzle_index.py),
+        or by streaming a Lichess puzzle csv file.
         """
+        from puzzle_index import load_puzzles
         start_time = time.time()
-        puzzles: pd.DataFrame = pd.read_csv(filename, header=None)
-        # drop unnecessary columns
-        puzzles = puzzles.drop(columns=[0, 4, 5, 6, 8])
-        # set column names
-        puzzles.columns = ["fen", "moves", "rating", "type"]
-        # only keep puzzles where type contains "mate"
-        puzzles = puzzles[puzzles["type"].str.contains(type)]
-        logging.info(f"Created puzzles in {time.time() - start_time} seconds")
+        puzzles = load_puzzles(filename, type, min_rating, max_rating)
+        logging.info(f"Created {len(puzzles)} puzzles in {time.time() - start_time} seconds")
         return puzzles
-
-    
\ No newline at end of file
@@ -0,0 +1,201 @@
+# Inference worker processes for the prediction server (INFERENCE_WORKERS > 0).
+# Every worker loads the served models in its own process, with its own intra-op and
+# inter-op thread pools, pinned to its own set of CPU cores. The server's inference threads
+# (one per worker) take batches from the batching queue and hand them to their worker:
+# the inputs and outputs go through shared memory, a pipe carries the commands.
+import logging
+import multiprocessing
+import os
+import threading
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional, Tuple
+
+import numpy as np
+
+import config
+
+POLICY_SIZE = config.OUTPUT_SHAPE[0]
+
+
+def parse_cpus(spec: str) -> list[int]:
+    """
+    Parse a list of cores like "0-3,8,10-11".
+    """
+    cpus = []
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return cpus
+
+
+def cpu_sets(workers: int, spec: str = config.WORKER_CPUS) -> list[Optional[list[int]]]:
+    """
+    The cores every worker is pinned to:
+    * auto: the available cores are split in equal, contiguous groups
+    * none: workers are not pinned
+    * an explicit core list per worker, separated by semicolons: "0-3;4-7"
+    """
+    if spec == "none" or not hasattr(os, "sched_getaffinity"):
+        return [None] * workers
+    if spec == "auto":
+        available = sorted(os.sched_getaffinity(0))
+        size = max(1, len(available) // workers)
+        return [available[(i * size) % len(available):][:size] for i in range(workers)]
+    sets = [parse_cpus(part) for part in spec.split(";")]
+    if len(sets) != workers:
+        raise ValueError(f"WORKER_CPUS has {len(sets)} core lists for {workers} workers")
+    return sets
+
+
+def configure_threads(intra_op_threads: int, inter_op_threads: int):
+    """
+    Set the sizes of TensorFlow's thread pools (0 keeps the default).
+    Must be called before TensorFlow runs its first operation.
+    """
+    import tensorflow as tf
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def buffers(shm: SharedMemory, max_batch_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The inputs, policies and values of a batch in the worker's shared memory.
+    """
+    inputs = np.ndarray((max_batch_size, *config.INPUT_SHAPE), dtype=bool, buffer=shm.buf)
+    offset = inputs.nbytes
+    policies = np.ndarray((max_batch_size, POLICY_SIZE), dtype=np.float32, buffer=shm.buf, offset=offset)
+    offset += policies.nbytes
+    values = np.ndarray((max_batch_size, 1), dtype=np.float32, buffer=shm.buf, offset=offset)
+    return inputs, policies, values
+
+
+def worker_main(connection, shm_name: str, max_batch_size: int, folder: str,
+                intra_op_threads: int, inter_op_threads: int, cpus: Optional[list[int]]):
+    """
+    The worker process: load models and predict batches on request.
+    Commands: ("load", model_id), ("predict", model_id, batch size) and ("predict_values", model_id, batch size).
+    Replies: ("ok",) or ("error", message).
+    """
+    logging.basicConfig(level=logging.INFO, format=' %(message)s')
+    # pin the process before tensorflow creates its threads, they inherit the affinity
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    configure_threads(intra_op_threads, inter_op_threads)
+    from model_registry import ModelRegistry
+
+    shm = SharedMemory(name=shm_name)
+    inputs, policies, values = buffers(shm, max_batch_size)
+    registry = ModelRegistry(folder)
+    while True:
+        try:
+            command = connection.recv()
+        except EOFError:
+            break
+        try:
+            if command[0] == "load":
+                registry.load(command[1])
+            elif command[0] == "predict":
+                _, model_id, batch_size = command
+                p, v = registry.get(model_id).predict(inputs[:batch_size])
+                policies[:batch_size], values[:batch_size] = p, v
+            elif command[0] == "predict_values":
+                _, model_id, batch_size = command
+                values[:batch_size] = registry.get(model_id).predict_values(inputs[:batch_size])
+            connection.send(("ok",))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+    del inputs, policies, values
+    shm.close()
+
+
+class InferenceWorker:
+    def __init__(self, index: int, folder: str = config.MODEL_FOLDER, max_batch_size: int = config.MAX_BATCH_SIZE,
+                 intra_op_threads: int = config.INTRA_OP_THREADS, inter_op_threads: int = config.INTER_OP_THREADS,
+                 cpus: Optional[list[int]] = None):
+        """
+        Handle to a worker process. Calls are serialized: one batch (or model load) at a time.
+        With pinned cores and no intra-op thread count, the worker uses one thread per core.
+        """
+        self.index = index
+        self.folder = folder
+        self.max_batch_size = max_batch_size
+        self.intra_op_threads = intra_op_threads or (len(cpus) if cpus else 0)
+        self.inter_op_threads = inter_op_threads
+        self.cpus = cpus
+        size = max_batch_size * (int(np.prod(config.INPUT_SHAPE)) + (POLICY_SIZE + 1) * 4)
+        self.shm = SharedMemory(create=True, size=size)
+        self.inputs, self.policies, self.values = buffers(self.shm, max_batch_size)
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        # spawn: the worker must not inherit the server's threads (or tensorflow's state)
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=worker_main, name=f"inference-worker-{self.index}", daemon=True,
+            args=(child_connection, self.shm.name, self.max_batch_size, self.folder,
+                  self.intra_op_threads, self.inter_op_threads, self.cpus))
+        self.process.start()
+        child_connection.close()
+        logging.info(f"Started inference worker {self.index} (pid {self.process.pid}, cores {self.cpus or 'all'}, "
+                     f"{self.intra_op_threads or 'default'} intra-op / {self.inter_op_threads or 'default'} inter-op threads)")
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def restart(self):
+        """
+        Start a new process after the worker died. Models are loaded again when they are used.
+        """
+        logging.warning(f"Inference worker {self.index} died (exit code {self.process.exitcode}), restarting it...")
+        self.connection.close()
+        self.start()
+
+    def call(self, *command):
+        with self.lock:
+            self.connection.send(command)
+            reply = self.connection.recv()
+        if reply[0] == "error":
+            raise RuntimeError(f"Worker {self.index}: {reply[1]}")
+
+    def load(self, model_id: str):
+        self.call("load", model_id)
+
+    def predict(self, model_id: str, batch: list[np.ndarray], values_only: bool = False) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """
+        Predict a batch of inputs with the given model. The inputs are stacked straight into shared memory.
+        With values_only, the worker skips the policy head and the policies are None.
+        """
+        with self.lock:
+            if len(batch) == 1:
+                self.inputs[0] = batch[0]
+            else:
+                np.stack(batch, out=self.inputs[:len(batch)])
+            self.connection.send(("predict_values" if values_only else "predict", model_id, len(batch)))
+            reply = self.connection.recv()
+            if reply[0] == "error":
+                raise RuntimeError(f"Worker {self.index}: {reply[1]}")
+            # copy: the next batch overwrites the shared memory
+            if values_only:
+                return None, self.values[:len(batch)].copy()
+            return self.policies[:len(batch)].copy(), self.values[:len(batch)].copy()
+
+    def close(self):
+        self.connection.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        del self.inputs, self.policies, self.values
+        self.shm.close()
+        self.shm.unlink()
+
+
+def start_workers(count: int = config.INFERENCE_WORKERS, cpus: str = config.WORKER_CPUS, **kwargs) -> list[InferenceWorker]:
+    return [InferenceWorker(i, cpus=worker_cpus, **kwargs) for i, worker_cpus in enumerate(cpu_sets(count, cpus))]
@@ -1,9 +1,89 @@
 # This file is used to do local predictions, because the tf.function decorator
 # needs the tensorflow imported. Importing tensorflow reserves VRAM, which is
 # only needed for local predictions. That's why it's in a separate file.
+import bisect
+import logging
+import threading
+import time
+from typing import Tuple
 
+import numpy as np
 import tensorflow as tf
 
-@tf.function
-def predict_local(model, args):
-	return model(args)
\ No newline at end of file
+import config
+
+class BucketedPredictor:
+	def __init__(self, model, buckets: list[int] = config.BATCH_BUCKETS, dtype: tf.DType = tf.bool):
+		"""
+		Predicts with a fixed set of batch sizes (buckets), so the model's function never gets retraced.
+		Every bucket is traced with its own input signature, batches are padded to the nearest bucket
+		and batches larger than the largest bucket are split.
+		A bucket is traced when it is first used, or up front by warm_up (e.g. by the server).
+		"""
+		self.model = model
+		self.buckets = sorted(set(buckets))
+		self.dtype = dtype
+		# the trunk and the value head only: for predictions that don't need the policy
+		self.value_model = tf.keras.Model(model.inputs, model.outputs[1])
+		self.function = tf.function(lambda inputs: self.model(inputs, training=False))
+		self.value_function = tf.function(lambda inputs: self.value_model(inputs, training=False))
+		# bucket -> traced (concrete) function
+		self.functions, self.value_functions = {}, {}
+		self.lock = threading.Lock()
+
+	def traced(self, values: bool, bucket: int):
+		"""
+		The function of a bucket (of the value model if values is set), traced on first use.
+		"""
+		functions = self.value_functions if values else self.functions
+		if bucket not in functions:
+			with self.lock:
+				if bucket not in functions:
+					spec = tf.TensorSpec((bucket, *config.INPUT_SHAPE), self.dtype, name="main_input")
+					functions[bucket] = (self.value_function if values else self.function).get_concrete_function(spec)
+		return functions[bucket]
+
+	def warm_up(self):
+		"""
+		Trace and run every bucket once, so the first real predictions don't pay for the initialization.
+		"""
+		start_time = time.perf_counter()
+		for bucket in self.buckets:
+			inputs = tf.zeros((bucket, *config.INPUT_SHAPE), dtype=self.dtype)
+			self.traced(False, bucket)(inputs)
+			self.traced(True, bucket)(inputs)
+		logging.info(f"Warmed up batch buckets {self.buckets} in {time.perf_counter() - start_time:.2f}s")
+
+	def bucket_for(self, batch_size: int) -> int:
+		return self.buckets[bisect.bisect_left(self.buckets, batch_size)]
+
+	def run(self, values: bool, inputs: np.ndarray) -> list[np.ndarray]:
+		"""
+		Run the bucketed functions on a batch: pad it to the nearest bucket, or split it if it is too large.
+		"""
+		largest = self.buckets[-1]
+		if len(inputs) > largest:
+			chunks = [self.run(values, inputs[start:start + largest]) for start in range(0, len(inputs), largest)]
+			return [np.concatenate(outputs) for outputs in zip(*chunks)]
+		batch_size = len(inputs)
+		bucket = self.bucket_for(batch_size)
+		if bucket != batch_size:
+			padding = np.zeros((bucket - batch_size, *inputs.shape[1:]), dtype=inputs.dtype)
+			inputs = np.concatenate([inputs, padding])
+		outputs = self.traced(values, bucket)(tf.convert_to_tensor(inputs, dtype=self.dtype))
+		if not isinstance(outputs, (list, tuple)):
+			outputs = [outputs]
+		return [output.numpy()[:batch_size] for output in outputs]
+
+	def predict(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Predict a batch of inputs, shape (N, 8, 8, 19). Returns the policies (N, 4672) and values (N, 1).
+		"""
+		p, v = self.run(False, inputs)
+		return p, v
+
+	def predict_values(self, inputs: np.ndarray) -> np.ndarray:
+		"""
+		Only the values (N, 1) of a batch of inputs: the policy head isn't computed.
+		"""
+		return self.run(True, inputs)[0]
@@ -7,6 +7,7 @@ from chessEnv import ChessEnv
 from game import Game
 from agent import Agent
 import argparse
+import config
 import logging
 logging.basicConfig(level=logging.INFO, format=" %(message)s")
 logging.disable(logging.WARN)
@@ -14,11 +15,17 @@ logging.disable(logging.WARN)
 from GUI.display import GUI
 
 class Main:
-    def __init__(self, player: bool, local_predictions: bool = False, model_path: str = None):
+    def __init__(self, player: bool, local_predictions: bool = False, model_path: str = None, book: bool = False):
         self.player = player
         
         # create an agent for the opponent
-        self.opponent = Agent(local_predictions=local_predictions, model_path=model_path)
+        # a human is waiting for the moves: the server predicts these requests before self-play requests
+        self.opponent = Agent(local_predictions=local_predictions, model_path=model_path, priority="interactive")
+        if book:
+            # answer the cached opening positions without a search
+            from opening_cache import OpeningCache
+            from utils import model_version
+            self.opponent.opening_cache = OpeningCache(config.OPENING_CACHE_FILE, model_version(model_path), book=True)
 
         if self.player:
             self.game = Game(ChessEnv(), None, self.opponent)
@@ -87,6 +94,7 @@ if __name__ == "__main__":
     parser.add_argument("--player", type=str, default=None, choices=('white', 'black'), help="Whether to play as white or black. No argument means random.")
     parser.add_argument('--local-predictions', action='store_true', help='Use local predictions instead of the server')
     parser.add_argument("--model", type=str, default=None, help="For local predictions: specify the path to the model to use.")
+    parser.add_argument("--book", action="store_true", help="Use the opening cache as an opening book: reply instantly in cached positions.")
     args = parser.parse_args()
     args = vars(args)
 
@@ -103,5 +111,9 @@ if __name__ == "__main__":
     else:
         player = np.random.choice([True, False])
 
-    m = Main(player, local_predictions, model_path)
+    try:
+        m = Main(player, local_predictions, model_path, args["book"])
+    except ConnectionError as e:
+        print(e)
+        exit(1)
     
\ No newline at end of file
@@ -9,11 +9,10 @@ import time
 from tqdm import tqdm
 import utils
 import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 # import tensorflow as tf
 
-# graphing mcts
-from graphviz import Digraph
-
 import config
 # output vector mapping
 from mapper import Mapping
@@ -21,6 +20,51 @@ from mapper import Mapping
 import logging
 
 
+class EvaluationCache:
+    def __init__(self, size: int):
+        """
+        Predictions that were requested ahead of time (see MCTS.prefetch), by state.
+        Holds the futures of at most size states, the oldest are dropped.
+        Counts how many prefetched predictions were issued and how many were used by a simulation.
+        """
+        self.size = size
+        self.futures: OrderedDict[str, Future] = OrderedDict()
+        self.issued = 0
+        self.used = 0
+
+    def __contains__(self, state: str) -> bool:
+        return state in self.futures
+
+    def put(self, state: str, future: Future) -> None:
+        self.futures[state] = future
+        self.issued += 1
+        if len(self.futures) > self.size:
+            self.futures.popitem(last=False)
+
+    def take(self, state: str):
+        """
+        The prefetched prediction (policy and value) of the state, or None if there is none or it failed.
+        Waits if the prediction is still in flight.
+        """
+        future = self.futures.pop(state, None)
+        if future is None:
+            return None
+        try:
+            prediction = future.result()
+        except Exception as e:
+            logging.debug(f"Prefetched prediction failed: {e}")
+            return None
+        self.used += 1
+        return prediction
+
+    @property
+    def accuracy(self) -> float:
+        """
+        The fraction of the issued prefetches that were used.
+        """
+        return self.used / self.issued if self.issued else 0.0
+
+
 class MCTS:
     def __init__(self, agent: "Agent", state: str = chess.STARTING_FEN, stochastic=False):
         """
@@ -59,6 +103,11 @@ class MCTS:
             # backpropagate the result
             leaf = self.backpropagate(leaf, leaf.value)
 
+        if self.agent.prefetch_children:
+            evaluations = self.agent.evaluations
+            logging.debug(f"Prefetch (k={self.agent.prefetch_children}): {evaluations.used}/{evaluations.issued} used "
+                         f"({evaluations.accuracy:.0%})")
+
     def select_child(self, node: Node) -> Node:
         """
         Traverse the three from the given node, by selecting actions with the maximum Q+U.
@@ -205,8 +254,12 @@ class MCTS:
         # predict p and v
         # p = array of probabilities: [0, 1] for every move (including invalid moves)
         # v = [-1, 1]
-        input_state = ChessEnv.state_to_input(leaf.state)
-        p, v = self.agent.predict(input_state)
+        # use the prefetched prediction if there is one
+        prediction = self.agent.evaluations.take(leaf.state) if self.agent.prefetch_children else None
+        if prediction is None:
+            input_state = ChessEnv.state_to_input(leaf.state)
+            prediction = self.agent.predict(input_state)
+        p, v = prediction
 
         # map probabilities to moves, this also filters out invalid moves
         # returns a dictionary of moves and their probabilities
@@ -224,8 +277,24 @@ class MCTS:
             new_state = leaf.step(action)
             # add a new child node with the new board, the action taken and its prior probability
             leaf.add_child(Node(new_state), action, actions[action.uci()])
+
+        if self.agent.prefetch_children:
+            self.prefetch(leaf)
         return leaf
 
+    def prefetch(self, node: Node) -> None:
+        """
+        Request the predictions of the node's children with the highest priors, the most likely next leaves,
+        at a low priority. They are predicted while the search waits for other leaves.
+        """
+        edges = sorted(node.edges, key=lambda edge: edge.P, reverse=True)[:self.agent.prefetch_children]
+        for edge in edges:
+            state = edge.output_node.state
+            if state in self.agent.evaluations:
+                continue
+            future = self.agent.predict_async(ChessEnv.state_to_input(state), priority=config.PREFETCH_PRIORITY)
+            self.agent.evaluations.put(state, future)
+
     def backpropagate(self, end_node: Node, value: float) -> Node:
         """
         The backpropagation step will update the values of the nodes 
@@ -239,7 +308,7 @@ class MCTS:
             edge.W += value
         return end_node
 
-    def plot_node(self, dot: Digraph, node: Node):
+    def plot_node(self, dot: "Digraph", node: Node):
         """
         Recursive function to plot nodes.
         """
@@ -255,7 +324,8 @@ class MCTS:
         Plot the MCTS tree using graphviz.
         """
         logging.debug("Plotting tree...")
-        # tree plotting
+        # tree plotting (graphviz is only imported when plotting)
+        from graphviz import Digraph
         dot = Digraph(comment='Chess MCTS Tree')
         logging.info(f"# of nodes in tree: {len(self.root.get_all_children())}")
 
@@ -0,0 +1,258 @@
+# Live counters and histograms for the prediction server.
+# The stats are served on a local port (or unix socket) so a scraper can poll them:
+#   /stats   => JSON
+#   /metrics => plain text, one "name value" pair per line
+import bisect
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# bucket bounds for timings (seconds) and sizes
+TIME_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5]
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+
+
+class Histogram:
+    def __init__(self, bounds: list):
+        """
+        A histogram with fixed bucket bounds. The last bucket holds everything above the last bound.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, q: float) -> float:
+        """
+        Estimate a percentile: the upper bound of the bucket that contains it.
+        """
+        if self.count == 0:
+            return 0.0
+        target, seen = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.bounds[index] if index < len(self.bounds) else float("inf")
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99),
+                "buckets": {
+                    **{str(bound): count for bound, count in zip(self.bounds, self.counts)},
+                    "+Inf": self.counts[-1]
+                }
+            }
+
+
+class RateMeter:
+    def __init__(self, window: int = 10):
+        """
+        Counts events per second over a sliding window of the last `window` seconds.
+        """
+        self.window = window
+        self.buckets = [0] * window
+        self.seconds = [0] * window
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def mark(self, n: int = 1):
+        second = int(time.time())
+        index = second % self.window
+        with self.lock:
+            if self.seconds[index] != second:
+                self.seconds[index] = second
+                self.buckets[index] = 0
+            self.buckets[index] += n
+            self.total += n
+
+    def rate(self) -> float:
+        now = int(time.time())
+        with self.lock:
+            # don't count the current (incomplete) second
+            return sum(count for second, count in zip(self.seconds, self.buckets)
+                       if now - self.window <= second < now) / self.window
+
+
+class ServerMetrics:
+    def __init__(self):
+        """
+        All metrics of the prediction server. Every method is thread-safe.
+        """
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "responses": 0,
+            "errors": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "connections": 0,
+            # requests dropped because their deadline passed
+            "expired": 0,
+        }
+        self.request_rate = RateMeter()
+        self.batch_size = Histogram(SIZE_BUCKETS)
+        self.queue_wait = Histogram(TIME_BUCKETS)
+        # priority class => queue wait of the requests of that class
+        self.queue_wait_by_priority: dict[str, Histogram] = {}
+        self.inference_time = Histogram(TIME_BUCKETS)
+        self.serialization_time = Histogram(TIME_BUCKETS)
+        # client address => requests and request rate of that client
+        self.clients: dict[str, dict] = {}
+
+    def increment(self, counter: str, n: int = 1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def observe_queue_wait(self, priority: str, seconds: float):
+        self.queue_wait.observe(seconds)
+        with self.lock:
+            histogram = self.queue_wait_by_priority.get(priority)
+            if histogram is None:
+                histogram = self.queue_wait_by_priority[priority] = Histogram(TIME_BUCKETS)
+        histogram.observe(seconds)
+
+    def client_connected(self, client: str):
+        with self.lock:
+            self.counters["connections"] += 1
+            self.clients[client] = {"connected_since": time.time(), "requests": 0, "rate": RateMeter()}
+
+    def client_disconnected(self, client: str):
+        with self.lock:
+            self.counters["connections"] -= 1
+            self.clients.pop(client, None)
+
+    def record_request(self, client: str, bytes_in: int):
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["bytes_in"] += bytes_in
+            stats = self.clients.get(client)
+            if stats is not None:
+                stats["requests"] += 1
+                stats["rate"].mark()
+        self.request_rate.mark()
+
+    def record_response(self, bytes_out: int):
+        with self.lock:
+            self.counters["responses"] += 1
+            self.counters["bytes_out"] += bytes_out
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            counters = dict(self.counters)
+            queue_wait_by_priority = dict(self.queue_wait_by_priority)
+            clients = {
+                client: {
+                    "connected_since": stats["connected_since"],
+                    "requests": stats["requests"],
+                    "requests_per_second": stats["rate"].rate()
+                } for client, stats in self.clients.items()
+            }
+        return {
+            "uptime": time.time() - self.start_time,
+            "requests_per_second": self.request_rate.rate(),
+            **counters,
+            "batch_size": self.batch_size.to_dict(),
+            "queue_wait": self.queue_wait.to_dict(),
+            **{f"queue_wait_{priority}": histogram.to_dict() for priority, histogram in queue_wait_by_priority.items()},
+            "inference_time": self.inference_time.to_dict(),
+            "serialization_time": self.serialization_time.to_dict(),
+            "clients": clients,
+        }
+
+    def to_text(self) -> str:
+        """
+        Flatten the metrics to "name value" lines. Labels are added between braces.
+        """
+        stats = self.to_dict()
+        lines = []
+        for name, value in stats.items():
+            if name == "clients":
+                for client, client_stats in value.items():
+                    for key, client_value in client_stats.items():
+                        lines.append(f'client_{key}{{client="{client}"}} {client_value}')
+            elif isinstance(value, dict):
+                for key, hist_value in value.items():
+                    if key == "buckets":
+                        # cumulative counts, like the "le" label suggests
+                        total = 0
+                        for bound, count in hist_value.items():
+                            total += count
+                            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+                    else:
+                        lines.append(f"{name}_{key} {hist_value}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET /stats with JSON and GET /metrics with plain text.
+    """
+    metrics: ServerMetrics = None
+
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body, content_type = self.metrics.to_text(), "text/plain"
+        elif self.path == "/" or self.path.startswith("/stats"):
+            body, content_type = json.dumps(self.metrics.to_dict()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # unix socket clients don't have an address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logging.debug(f"Stats request: {format % args}")
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_stats_server(metrics: ServerMetrics, port: int = None, socket_path: str = None):
+    """
+    Start the stats server in a daemon thread. If a socket path is given, the stats are served
+    on that unix socket, otherwise on localhost:port.
+    """
+    handler = type("Handler", (StatsRequestHandler,), {"metrics": metrics})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = ThreadingUnixHTTPServer(socket_path, handler)
+        logging.info(f"Serving stats on unix socket {socket_path}")
+    else:
+        httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        logging.info(f"Serving stats on 127.0.0.1:{port}")
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
@@ -0,0 +1,129 @@
+# The models a prediction server (or an inference worker) serves, by model id.
+# No side effects on import: the inference workers import this module, not server.py.
+import logging
+import os
+import re
+import threading
+import time
+from typing import Tuple
+
+import numpy as np
+
+import config
+
+# model ids are file names in the model folder, don't allow anything that could escape it
+MODEL_ID_PATTERN = re.compile(r"^[\w.\-]+$")
+
+
+def batch_buckets(max_batch_size: int = config.MAX_BATCH_SIZE) -> list[int]:
+	"""
+	The batch sizes the models are traced for: the configured buckets up to the maximum batch size.
+	"""
+	return [size for size in config.BATCH_BUCKETS if size < max_batch_size] + [max_batch_size]
+
+
+class ServedModel:
+	def __init__(self, model_id: str, path: str):
+		"""
+		A model that is loaded from the model folder and can be used for predictions.
+		Every model gets its own functions, traced for every batch size bucket up to MAX_BATCH_SIZE,
+		so multiple models can be served at the same time and batches never cause a retrace.
+		"""
+		self.model_id = model_id
+		self.path = path
+		# the modification time of the loaded file, used to detect new versions
+		self.mtime = os.path.getmtime(path)
+		# tensorflow is only imported by the process that predicts
+		from tensorflow.keras.models import load_model
+		from local_prediction import BucketedPredictor
+		self.model = load_model(path)
+		self.predictor = BucketedPredictor(self.model, batch_buckets())
+
+	def predict(self, data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+		return self.predictor.predict(data)
+
+	def predict_values(self, data: np.ndarray) -> np.ndarray:
+		return self.predictor.predict_values(data)
+
+	def warm_up(self):
+		"""
+		Predict every bucket once before clients use the model.
+		"""
+		self.predictor.warm_up()
+
+
+class ModelRegistry:
+	def __init__(self, folder: str, model_class=ServedModel):
+		"""
+		The registry holds every model the server is serving, by model id.
+		A model with id <id> is loaded from <folder>/<id>.h5.
+
+		New versions of a model are loaded and warmed up in the background, and then swapped in.
+		Client handlers look up the model for every request, so a swap never interrupts a connection.
+		With inference workers, the model class is RemoteModel: the workers load the models.
+		"""
+		self.folder = folder
+		self.model_class = model_class
+		self.models: dict[str, ServedModel] = {}
+		# only one model gets loaded at a time, lookups don't need the lock
+		self.lock = threading.Lock()
+		# model id -> modification time seen in the previous check
+		self.pending: dict[str, float] = {}
+
+	def path_of(self, model_id: str) -> str:
+		if not MODEL_ID_PATTERN.match(model_id):
+			raise ValueError(f"Invalid model id: {model_id!r}")
+		return os.path.join(self.folder, f"{model_id}.h5")
+
+	def get(self, model_id: str) -> ServedModel:
+		"""
+		Get the model with the given id, load it if it isn't loaded yet.
+		"""
+		served = self.models.get(model_id)
+		if served is None:
+			with self.lock:
+				# another thread could have loaded it while waiting for the lock
+				served = self.models.get(model_id)
+				if served is None:
+					served = self.load(model_id)
+		return served
+
+	def load(self, model_id: str) -> ServedModel:
+		"""
+		Load, warm up and (atomically) swap in the model with the given id.
+		"""
+		path = self.path_of(model_id)
+		if not os.path.isfile(path):
+			raise ValueError(f"Model {model_id!r} does not exist in {self.folder}")
+		start_time = time.time()
+		served = self.model_class(model_id, path)
+		served.warm_up()
+		self.models[model_id] = served
+		logging.info(f"Loaded model {model_id!r} from {path} in {time.time() - start_time:.2f} seconds")
+		return served
+
+	def reload_changed(self):
+		"""
+		Reload every served model whose file has changed.
+		A model is only reloaded if its file did not change since the previous check,
+		to make sure the file isn't still being written.
+		"""
+		for model_id, served in list(self.models.items()):
+			try:
+				mtime = os.path.getmtime(served.path)
+			except FileNotFoundError:
+				continue
+			if mtime == served.mtime:
+				self.pending.pop(model_id, None)
+				continue
+			if self.pending.get(model_id) != mtime:
+				# file changed, wait for the next check
+				self.pending[model_id] = mtime
+				continue
+			del self.pending[model_id]
+			logging.info(f"New version of model {model_id!r} found, reloading...")
+			try:
+				with self.lock:
+					self.load(model_id)
+			except Exception as e:
+				logging.warning(f"Could not reload model {model_id!r}, keeping the old version: {e}")
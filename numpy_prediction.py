@@ -0,0 +1,98 @@
+# Predictions with a pure NumPy forward pass of the RLModelBuilder architecture.
+# Loading an .npz (exported with `python export_model.py model.h5 --format npz`)
+# takes milliseconds and doesn't import tensorflow, so processes that only need
+# a few evaluations (GUI, analysis) start quickly.
+#
+# The model's convolutions use data_format='channels_first' on (8, 8, 19) inputs:
+# the first axis (8) are the channels, the convolutions slide over the other two (8x19).
+# Internally the activations are kept as (N, H, W, C), so every convolution is a single GEMM.
+from typing import Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import config
+
+
+def conv3x3(x: np.ndarray, w: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    3x3 convolution with 'same' padding, as im2col + GEMM.
+    x: (N, H, W, C), w: (C*3*3, out) with BatchNorm folded in, b: (out,)
+    """
+    n, h, width, c = x.shape
+    padded = np.pad(x, ((0, 0), (1, 1), (1, 1), (0, 0)))
+    # (N, H, W, C, 3, 3) => one row of C*3*3 values per output pixel
+    patches = sliding_window_view(padded, (3, 3), axis=(1, 2)).reshape(n * h * width, c * 9)
+    return (patches @ w + b).reshape(n, h, width, -1)
+
+
+def relu(x: np.ndarray) -> np.ndarray:
+    return np.maximum(x, 0, out=x)
+
+
+class NumpyPredictor:
+    def __init__(self, model_path: str, max_batch_size: int = 32):
+        """
+        Load the folded weights from the .npz file.
+        Batches are split in chunks of max_batch_size positions to limit the size of the im2col buffers.
+        """
+        weights = np.load(model_path)
+        self.residual_blocks = int(weights["residual_blocks"])
+        # the first convolution, followed by two convolutions for every residual block
+        self.trunk = [(weights[f"trunk_w_{i}"], weights[f"trunk_b_{i}"]) for i in range(1 + 2 * self.residual_blocks)]
+        self.policy_conv = (weights["policy_conv_w"], weights["policy_conv_b"])
+        self.policy_dense = (weights["policy_dense_w"], weights["policy_dense_b"])
+        self.value_conv = (weights["value_conv_w"], weights["value_conv_b"])
+        self.value_dense_1 = (weights["value_dense_1_w"], weights["value_dense_1_b"])
+        self.value_dense_2 = (weights["value_dense_2_w"], weights["value_dense_2_b"])
+        self.max_batch_size = max_batch_size
+
+    def body(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        The convolutional layer and the residual blocks. Returns (N, H, W, filters).
+        """
+        # (N, C, H, W) => (N, H, W, C)
+        x = inputs.astype(np.float32).transpose(0, 2, 3, 1)
+        x = relu(conv3x3(x, *self.trunk[0]))
+        for i in range(self.residual_blocks):
+            y = relu(conv3x3(x, *self.trunk[1 + 2 * i]))
+            y = conv3x3(y, *self.trunk[2 + 2 * i])
+            x = relu(y + x)
+        return x
+
+    @staticmethod
+    def head_features(x: np.ndarray, conv: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+        """
+        1x1 convolution + BatchNorm + ReLU, flattened in channels_first order like Keras does.
+        """
+        y = relu(x @ conv[0] + conv[1])
+        return y.transpose(0, 3, 1, 2).reshape(len(y), -1)
+
+    def policy_head(self, x: np.ndarray) -> np.ndarray:
+        y = self.head_features(x, self.policy_conv) @ self.policy_dense[0] + self.policy_dense[1]
+        # sigmoid
+        return 1 / (1 + np.exp(-y))
+
+    def value_head(self, x: np.ndarray) -> np.ndarray:
+        y = relu(self.head_features(x, self.value_conv) @ self.value_dense_1[0] + self.value_dense_1[1])
+        return np.tanh(y @ self.value_dense_2[0] + self.value_dense_2[1])
+
+    def predict_values(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        Only the values of a batch of inputs (N, 1): the policy head is skipped.
+        """
+        inputs = inputs.reshape(-1, *config.INPUT_SHAPE)
+        return np.concatenate([self.value_head(self.body(inputs[start:start + self.max_batch_size]))
+                               for start in range(0, len(inputs), self.max_batch_size)])
+
+    def predict(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Predict a batch of inputs, shape (N, 8, 8, 19). Returns the policies (N, 4672) and values (N, 1).
+        """
+        inputs = inputs.reshape(-1, *config.INPUT_SHAPE)
+        policies, values = [], []
+        for start in range(0, len(inputs), self.max_batch_size):
+            x = self.body(inputs[start:start + self.max_batch_size])
+            policies.append(self.policy_head(x))
+            values.append(self.value_head(x))
+        return np.concatenate(policies), np.concatenate(values)
@@ -0,0 +1,129 @@
+# Persistent cache of the root searches of opening positions (OPENING_CACHE=true).
+# Every self-play game starts from the same position, so the first plies are searched over and over:
+# the root's visit counts, values and priors are stored in an SQLite database, by the position's
+# Zobrist hash and the model version, and shared by all processes that use the same file.
+# A cached search is restored as the root of the tree and topped up with more simulations:
+# every game that uses an entry adds OPENING_CACHE_TOP_UP simulations, up to OPENING_CACHE_MAX_SIMULATIONS,
+# so the cached searches get better instead of being repeated from zero.
+# main.py can use the cache as an opening book (--book): cached positions are answered without a search.
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+import chess
+import chess.polyglot
+
+import config
+from node import Node
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS searches (
+    hash INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    fen TEXT NOT NULL,
+    simulations INTEGER NOT NULL,
+    value REAL NOT NULL,
+    edges TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (hash, model)
+)
+"""
+
+
+def position_key(board: chess.Board) -> int:
+    """
+    The Zobrist hash of the position, as a signed 64-bit integer (an SQLite INTEGER).
+    """
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+class CachedSearch(NamedTuple):
+    fen: str
+    simulations: int
+    value: float
+    # move (uci) -> (N, W, P) of the root's edges
+    edges: dict
+
+    def to_node(self) -> Node:
+        """
+        A root node with the cached statistics. The children are not expanded yet:
+        new simulations expand them, and add to the cached visits.
+        """
+        root = Node(self.fen)
+        root.N = self.simulations
+        root.value = self.value
+        for move, (n, w, p) in self.edges.items():
+            action = chess.Move.from_uci(move)
+            edge = root.add_child(Node(root.step(action)), action, p)
+            edge.N, edge.W = n, w
+        return root
+
+
+class OpeningCache:
+    def __init__(self, path: str, model: str, book: bool = False, top_up: int = config.OPENING_CACHE_TOP_UP,
+                 max_simulations: int = config.OPENING_CACHE_MAX_SIMULATIONS):
+        """
+        The cached searches of one model version in the database at path.
+        As a book, cached searches are used as they are (without new simulations) and nothing is written.
+        """
+        self.path = path
+        self.model = model
+        self.book = book
+        self.top_up = top_up
+        self.max_simulations = max_simulations
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # WAL: the workers read while another one writes
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, board: chess.Board) -> CachedSearch:
+        """
+        The cached search of the position, or None. The FEN is compared as well, in case of a hash collision.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT fen, simulations, value, edges FROM searches WHERE hash = ? AND model = ?",
+                                          (position_key(board), self.model)).fetchone()
+        if row is None or row[0].split()[:4] != board.fen().split()[:4]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        fen, simulations, value, edges = row
+        # the cached search is restored for this position (with its move counters)
+        return CachedSearch(board.fen(), simulations, value, {move: tuple(stats) for move, stats in json.loads(edges).items()})
+
+    def simulations(self, entry: CachedSearch, target: int) -> int:
+        """
+        The amount of simulations to run on top of a cached search, for a search of target simulations.
+        """
+        if self.book:
+            return 0
+        if entry.simulations < target:
+            return target - entry.simulations
+        return max(min(self.top_up, self.max_simulations - entry.simulations), 0)
+
+    def put(self, board: chess.Board, root: Node) -> None:
+        """
+        Store the search of the root, unless the cache has a search with more simulations.
+        """
+        if self.book or not sum(edge.N for edge in root.edges):
+            return
+        edges = {edge.action.uci(): (int(edge.N), float(edge.W), float(edge.P)) for edge in root.edges}
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO searches VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (hash, model) DO UPDATE SET "
+                "fen = excluded.fen, simulations = excluded.simulations, value = excluded.value, edges = excluded.edges, "
+                "updated = excluded.updated WHERE excluded.simulations > searches.simulations",
+                (position_key(board), self.model, board.fen(), int(root.N), float(root.value), json.dumps(edges), time.time()))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
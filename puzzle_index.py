@@ -0,0 +1,255 @@
+# Lichess puzzles (https://database.lichess.org/#puzzles) without loading the whole CSV:
+#   * read_puzzles streams the CSV in chunks, and only keeps the puzzles that match
+#   * build_index converts the CSV (once) to a folder of memory-mapped arrays,
+#     sorted by rating and indexed by theme, that PuzzleIndex opens in milliseconds
+#
+# Index layout (every array is an .npy file):
+#   rating.npy                          int16, the ratings of the puzzles (ascending)
+#   fen.npy, fen_offsets.npy            the FENs: ASCII bytes, and the start of every FEN (N + 1)
+#   moves.npy, moves_offsets.npy        the solutions (UCI moves separated by spaces), likewise
+#   theme_rows.npy, theme_offsets.npy   for every theme, the (ascending) rows with that theme
+#   meta.json                           the amount of puzzles and the theme names
+#
+# Usage: python puzzle_index.py lichess_db_puzzle.csv puzzles/index
+import argparse
+import csv
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+# the columns of the Lichess puzzle CSV are PuzzleId, FEN, Moves, Rating, RatingDeviation, Popularity,
+# NbPlays, Themes, GameUrl (and OpeningTags in newer exports, which also have a header)
+CHUNK_SIZE = 65536
+
+
+class Puzzle(NamedTuple):
+    fen: str
+    moves: str
+    rating: int
+    themes: str
+
+
+def read_chunks(filename: str, chunk_size: int = CHUNK_SIZE) -> Iterator[list[Puzzle]]:
+    """
+    Stream the puzzles of a CSV file, chunk_size puzzles at a time.
+    """
+    with open(filename, newline="") as f:
+        reader = csv.reader(f)
+        chunk = []
+        for row in reader:
+            if len(row) < 8 or row[0] == "PuzzleId":
+                # blank or truncated lines, and the header
+                continue
+            chunk.append(Puzzle(row[1], row[2], int(row[3]), row[7]))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def matches(puzzle: Puzzle, theme: str = None, min_rating: int = None, max_rating: int = None) -> bool:
+    """
+    Like the index, a puzzle matches a theme if one of its themes contains it (e.g. 'mate' matches 'mateIn2').
+    """
+    if theme is not None and not any(theme in t for t in puzzle.themes.split()):
+        return False
+    if min_rating is not None and puzzle.rating < min_rating:
+        return False
+    return max_rating is None or puzzle.rating <= max_rating
+
+
+def read_puzzles(filename: str, theme: str = None, min_rating: int = None, max_rating: int = None) -> list[Puzzle]:
+    """
+    The matching puzzles of a CSV file. Only the matches are kept in memory.
+    """
+    start_time = time.time()
+    puzzles, total = [], 0
+    for chunk in read_chunks(filename):
+        total += len(chunk)
+        puzzles.extend(puzzle for puzzle in chunk if matches(puzzle, theme, min_rating, max_rating))
+    logging.info(f"Read {len(puzzles)} of {total} puzzles from {filename} in {time.time() - start_time:.1f} seconds")
+    return puzzles
+
+
+def gather(blob: np.ndarray, offsets: np.ndarray, order: np.ndarray, path: str, chunk_size: int = CHUNK_SIZE) -> np.ndarray:
+    """
+    Write the strings of a blob to a new .npy file in the given order. Returns the new offsets.
+    """
+    lengths = np.diff(offsets)[order]
+    new_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(int(new_offsets[-1]),))
+    for start in range(0, len(order), chunk_size):
+        rows = order[start:start + chunk_size]
+        chunk_lengths = lengths[start:start + chunk_size]
+        # the byte positions of the strings of these rows in the blob
+        first = new_offsets[start]
+        positions = np.arange(new_offsets[start + len(rows)] - first)
+        positions += np.repeat(offsets[rows] - (new_offsets[start:start + len(rows)] - first), chunk_lengths)
+        out[first:first + len(positions)] = blob[positions]
+    out.flush()
+    return new_offsets
+
+
+def build_index(filename: str, folder: str):
+    """
+    Convert a puzzle CSV to an index folder. The CSV is streamed: the FENs and moves are appended
+    to temporary files, and afterwards copied in the order of the ratings.
+    """
+    start_time = time.time()
+    os.makedirs(folder, exist_ok=True)
+    temp = os.path.join(folder, "tmp")
+    os.makedirs(temp, exist_ok=True)
+    ratings, fen_lengths, moves_lengths = [], [], []
+    theme_names: dict[str, int] = {}
+    theme_rows, theme_ids = [], []
+    count = 0
+    with open(os.path.join(temp, "fen"), "wb") as fens, open(os.path.join(temp, "moves"), "wb") as moves:
+        for chunk in read_chunks(filename):
+            fen_bytes = [puzzle.fen.encode() for puzzle in chunk]
+            moves_bytes = [puzzle.moves.encode() for puzzle in chunk]
+            fens.write(b"".join(fen_bytes))
+            moves.write(b"".join(moves_bytes))
+            fen_lengths.append(np.array([len(b) for b in fen_bytes], dtype=np.int64))
+            moves_lengths.append(np.array([len(b) for b in moves_bytes], dtype=np.int64))
+            ratings.append(np.array([puzzle.rating for puzzle in chunk], dtype=np.int16))
+            rows, ids = [], []
+            for row, puzzle in enumerate(chunk, start=count):
+                for theme in puzzle.themes.split():
+                    rows.append(row)
+                    ids.append(theme_names.setdefault(theme, len(theme_names)))
+            theme_rows.append(np.array(rows, dtype=np.int32))
+            theme_ids.append(np.array(ids, dtype=np.int32))
+            count += len(chunk)
+            logging.info(f"Read {count} puzzles")
+    if not count:
+        shutil.rmtree(temp)
+        raise ValueError(f"No puzzles found in {filename}")
+
+    ratings = np.concatenate(ratings)
+    order = np.argsort(ratings, kind="stable")
+    np.save(os.path.join(folder, "rating.npy"), ratings[order])
+    for name, lengths in (("fen", fen_lengths), ("moves", moves_lengths)):
+        offsets = np.concatenate([[0], np.cumsum(np.concatenate(lengths))]).astype(np.int64)
+        blob = np.memmap(os.path.join(temp, name), dtype=np.uint8, mode="r")
+        np.save(os.path.join(folder, f"{name}_offsets.npy"),
+                gather(blob, offsets, order, os.path.join(folder, f"{name}.npy")))
+        del blob
+    shutil.rmtree(temp)
+
+    # the rows of every theme, in the new (rating) order
+    new_rows = np.empty(count, dtype=np.int32)
+    new_rows[order] = np.arange(count, dtype=np.int32)
+    theme_rows, theme_ids = new_rows[np.concatenate(theme_rows)], np.concatenate(theme_ids)
+    by_theme = np.lexsort((theme_rows, theme_ids))
+    np.save(os.path.join(folder, "theme_rows.npy"), theme_rows[by_theme])
+    np.save(os.path.join(folder, "theme_offsets.npy"),
+            np.concatenate([[0], np.cumsum(np.bincount(theme_ids, minlength=len(theme_names)))]).astype(np.int64))
+    with open(os.path.join(folder, "meta.json"), "w") as f:
+        json.dump({"count": count, "themes": list(theme_names)}, f)
+    logging.info(f"Indexed {count} puzzles ({len(theme_names)} themes) in {folder} in {time.time() - start_time:.1f} seconds")
+
+
+class PuzzleIndex:
+    def __init__(self, folder: str):
+        """
+        Open an index folder (see build_index). The arrays are memory-mapped:
+        only the pages of the puzzles that are used are read.
+        """
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        self.count = meta["count"]
+        self.themes = meta["themes"]
+        load = lambda name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r")
+        self.ratings = load("rating")
+        self.fens, self.fen_offsets = load("fen"), load("fen_offsets")
+        self.moves, self.moves_offsets = load("moves"), load("moves_offsets")
+        self.theme_rows, self.theme_offsets = load("theme_rows"), load("theme_offsets")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, row: int) -> Puzzle:
+        row = int(row)
+        fen = self.fens[self.fen_offsets[row]:self.fen_offsets[row + 1]].tobytes().decode()
+        moves = self.moves[self.moves_offsets[row]:self.moves_offsets[row + 1]].tobytes().decode()
+        themes = " ".join(self.themes[i] for i in range(len(self.themes)) if self.has_theme(row, i))
+        return Puzzle(fen, moves, int(self.ratings[row]), themes)
+
+    def has_theme(self, row: int, theme: int) -> bool:
+        rows = self.theme_rows[self.theme_offsets[theme]:self.theme_offsets[theme + 1]]
+        index = np.searchsorted(rows, row)
+        return index < len(rows) and rows[index] == row
+
+    def select(self, theme: str = None, min_rating: int = None, max_rating: int = None) -> np.ndarray:
+        """
+        The rows of the matching puzzles, ascending. A puzzle matches a theme if one of its themes
+        contains it (e.g. 'mate' matches 'mateIn2'). The ratings are sorted, so a rating band
+        is a range of rows.
+        """
+        first = 0 if min_rating is None else int(np.searchsorted(self.ratings, min_rating, side="left"))
+        last = self.count if max_rating is None else int(np.searchsorted(self.ratings, max_rating, side="right"))
+        if theme is None:
+            return np.arange(first, last, dtype=np.int32)
+        selected = []
+        for i, name in enumerate(self.themes):
+            if theme not in name:
+                continue
+            rows = self.theme_rows[self.theme_offsets[i]:self.theme_offsets[i + 1]]
+            selected.append(rows[np.searchsorted(rows, first):np.searchsorted(rows, last)])
+        if not selected:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(selected))
+
+
+class PuzzleSelection:
+    def __init__(self, index: PuzzleIndex, rows: np.ndarray):
+        """
+        A lazy list of puzzles of an index: a puzzle is only read when it is used.
+        """
+        self.index = index
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> Puzzle:
+        return self.index[self.rows[i]]
+
+    def __iter__(self) -> Iterator[Puzzle]:
+        return (self.index[row] for row in self.rows)
+
+    def shuffle(self, rng: np.random.Generator = None):
+        self.rows = (rng or np.random.default_rng()).permutation(self.rows)
+
+    def sample(self, n: int, rng: np.random.Generator = None) -> list[Puzzle]:
+        """
+        n random puzzles (without replacement, if there are enough).
+        """
+        rng = rng or np.random.default_rng()
+        return [self.index[row] for row in rng.choice(self.rows, size=n, replace=n > len(self.rows))]
+
+
+def load_puzzles(path: str, theme: str = None, min_rating: int = None, max_rating: int = None):
+    """
+    The matching puzzles of an index folder (as a PuzzleSelection) or of a CSV file (as a list).
+    """
+    if os.path.isdir(path):
+        index = PuzzleIndex(path)
+        return PuzzleSelection(index, index.select(theme, min_rating, max_rating))
+    return read_puzzles(path, theme, min_rating, max_rating)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format=' %(message)s')
+    parser = argparse.ArgumentParser(description="Index a Lichess puzzle CSV")
+    parser.add_argument("csv", type=str, help="The puzzle CSV (lichess_db_puzzle.csv)")
+    parser.add_argument("folder", type=str, help="The index folder to create")
+    args = parser.parse_args()
+    args = vars(args)
+    build_index(args["csv"], args["folder"])
@@ -0,0 +1,288 @@
+# Binary replay format (.rpl) for self-play games, instead of pickled .npy arrays of
+# (FEN, {uci move: probability}, winner) tuples.
+#
+# A replay file is a sequence of blocks, one per game, so games are appended without rewriting the file:
+#   header      BLOCK_HEADER: magic, format version, flags, metadata length, amount of positions,
+#               amount of policy entries, payload length and the CRC32 of the (stored) payload
+#   metadata    JSON: game id, model version, result, ...
+#   payload     the positions (POSITION_DTYPE) followed by the policy entries (POLICY_DTYPE),
+#               zlib-compressed if the block has FLAG_ZLIB
+# Uncompressed payloads are read from a memory map without copying.
+#
+# Positions are stored as bitboards, and decoded to model inputs (like ChessEnv.state_to_input)
+# with NumPy, without parsing FENs. Policies are sparse: the output vector index and the probability
+# of every legal move, policy_length entries per position, in the order of the positions.
+#
+# Usage:
+#   python replay.py convert memory/ memory/converted.rpl     convert the .npy games of a folder
+#   python replay.py info memory/*.rpl                        check the blocks and count the positions
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+from typing import Iterator, NamedTuple, Tuple
+
+import chess
+import numpy as np
+
+import config
+import utils
+
+MAGIC = b"RPLB"
+FORMAT_VERSION = 1
+BLOCK_HEADER = struct.Struct("<4sBBHIIII")
+FLAG_ZLIB = 1
+
+POSITION_DTYPE = np.dtype([
+    # for white and then black: pawns, knights, bishops, rooks, queens, kings
+    ("pieces", "<u8", (12,)),
+    # FLAG_* bits
+    ("flags", "u1"),
+    # the square of a legal en passant capture, or -1
+    ("en_passant", "i1"),
+    ("ply", "<u2"),
+    # the result for white, times VALUE_SCALE
+    ("value", "i1"),
+    # the policy comes from a full search (see PLAYOUT_CAP_RANDOMIZATION)
+    ("full_search", "u1"),
+    ("policy_length", "<u2"),
+])
+POLICY_DTYPE = np.dtype([("index", "<u2"), ("prob", "<f2")])
+# adjudicated games are scored as 0.25
+VALUE_SCALE = 100
+
+FLAG_WHITE_TURN = 1
+FLAG_CASTLING = (2, 4, 8, 16)
+FLAG_FIFTY_MOVES = 32
+
+
+class Block(NamedTuple):
+    meta: dict
+    positions: np.ndarray
+    policy: np.ndarray
+
+
+def encode_position(board: chess.Board) -> tuple:
+    """
+    The pieces, flags and en passant square of a position, the fields that state_to_input uses.
+    """
+    pieces = [board.pieces_mask(piece_type, color) for color in chess.COLORS for piece_type in chess.PIECE_TYPES]
+    flags = FLAG_WHITE_TURN if board.turn else 0
+    castling = (board.has_queenside_castling_rights(chess.WHITE), board.has_kingside_castling_rights(chess.WHITE),
+                board.has_queenside_castling_rights(chess.BLACK), board.has_kingside_castling_rights(chess.BLACK))
+    for flag, rights in zip(FLAG_CASTLING, castling):
+        if rights:
+            flags |= flag
+    if board.can_claim_fifty_moves():
+        flags |= FLAG_FIFTY_MOVES
+    en_passant = board.ep_square if board.has_legal_en_passant() else -1
+    return pieces, flags, en_passant
+
+
+def encode_policy(probabilities: dict, board: chess.Board) -> np.ndarray:
+    """
+    The sparse policy of a {uci move: probability} dictionary, sorted by output vector index.
+    """
+    policy = np.empty(len(probabilities), dtype=POLICY_DTYPE)
+    for i, (move, prob) in enumerate(probabilities.items()):
+        plane_index, row, col = utils.move_to_plane_index(move, board)
+        policy[i] = (plane_index * 64 + row * 8 + col, prob)
+    return np.sort(policy, order="index")
+
+
+def encode_game(memory: list) -> Block:
+    """
+    Encode the positions of a game in memory: (FEN, {uci move: probability}, winner[, full search]) tuples.
+    """
+    positions = np.zeros(len(memory), dtype=POSITION_DTYPE)
+    policies = []
+    for i, position in enumerate(memory):
+        board = chess.Board(position[0])
+        pieces, flags, en_passant = encode_position(board)
+        policy = encode_policy(position[1], board)
+        full_search = position[3] if len(position) > 3 else True
+        positions[i] = (pieces, flags, en_passant, board.ply(), round(position[2] * VALUE_SCALE), full_search, len(policy))
+        policies.append(policy)
+    policy = np.concatenate(policies) if policies else np.empty(0, dtype=POLICY_DTYPE)
+    return Block({}, positions, policy)
+
+
+def pack_block(block: Block, compress: bool = False) -> bytes:
+    meta = json.dumps(block.meta).encode()
+    payload = block.positions.tobytes() + block.policy.tobytes()
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+    header = BLOCK_HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(meta), len(block.positions), len(block.policy),
+                               len(payload), zlib.crc32(payload))
+    return header + meta + payload
+
+
+def append_block(path: str, block: Block, compress: bool = config.REPLAY_COMPRESSION):
+    """
+    Append a block to a replay file (created if it doesn't exist), in a single write.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, pack_block(block, compress))
+    finally:
+        os.close(fd)
+
+
+def block_at(buffer, offset: int, verify: bool = True) -> Tuple[Block, int]:
+    """
+    The block at the offset of a buffer (e.g. a memory-mapped replay file), and the offset of the next block.
+    The block is None if its checksum is wrong. Raises ValueError if there is no complete block at the offset.
+    """
+    if offset + BLOCK_HEADER.size > len(buffer):
+        raise ValueError(f"incomplete block header at byte {offset}")
+    magic, version, flags, meta_length, count, policy_count, length, crc = BLOCK_HEADER.unpack_from(buffer, offset)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"no replay block at byte {offset}")
+    start = offset + BLOCK_HEADER.size + meta_length
+    end = start + length
+    if end > len(buffer):
+        raise ValueError(f"incomplete block at byte {offset}")
+    payload = memoryview(buffer)[start:end]
+    if verify and zlib.crc32(payload) != crc:
+        return None, end
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    meta = json.loads(bytes(buffer[start - meta_length:start]))
+    positions = np.frombuffer(payload, dtype=POSITION_DTYPE, count=count)
+    policy = np.frombuffer(payload, dtype=POLICY_DTYPE, count=policy_count, offset=count * POSITION_DTYPE.itemsize)
+    return Block(meta, positions, policy), end
+
+
+def open_replay(path: str):
+    """
+    A read-only memory map of a replay file, or None if the file is empty.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_blocks(path: str, verify: bool = True, offsets: bool = False) -> Iterator[Block]:
+    """
+    The blocks of a replay file (with offsets: (offset, block) pairs). Blocks with a wrong checksum
+    are skipped, an incomplete last block (an interrupted write) ends the file.
+    """
+    buffer = open_replay(path)
+    offset = 0
+    while buffer is not None and offset < len(buffer):
+        try:
+            block, next_offset = block_at(buffer, offset, verify)
+        except ValueError as e:
+            logging.warning(f"{path}: {e}")
+            return
+        if block is None:
+            logging.warning(f"{path}: wrong checksum of the block at byte {offset}, skipped")
+        else:
+            yield (offset, block) if offsets else block
+        offset = next_offset
+
+
+def read_replay(path: str, verify: bool = True) -> Block:
+    """
+    All positions and policy entries of a replay file. The metadata is a list with the metadata of every block.
+    """
+    blocks = list(read_blocks(path, verify))
+    if not blocks:
+        return Block([], np.empty(0, dtype=POSITION_DTYPE), np.empty(0, dtype=POLICY_DTYPE))
+    return Block([block.meta for block in blocks], np.concatenate([block.positions for block in blocks]),
+                 np.concatenate([block.policy for block in blocks]))
+
+
+def policy_offsets(positions: np.ndarray) -> np.ndarray:
+    """
+    The start of the policy entries of every position (and the end of the last one).
+    """
+    return np.concatenate([[0], np.cumsum(positions["policy_length"], dtype=np.int64)])
+
+
+def decode_inputs(positions: np.ndarray) -> np.ndarray:
+    """
+    The model inputs (N, 8, 8, 19) of the positions, equal to ChessEnv.state_to_input of their FENs.
+    """
+    n = len(positions)
+    planes = np.zeros((n, 19, 8, 8), dtype=bool)
+    flags = positions["flags"]
+    planes[:, 0] = (flags & FLAG_WHITE_TURN).astype(bool)[:, None, None]
+    for i, flag in enumerate(FLAG_CASTLING):
+        planes[:, 1 + i] = (flags & flag).astype(bool)[:, None, None]
+    planes[:, 5] = (flags & FLAG_FIFTY_MOVES).astype(bool)[:, None, None]
+    # bit k of byte j of a bitboard is square 8 * j + k: rank j, file k. The planes have rank 8 at the top
+    bits = np.unpackbits(np.ascontiguousarray(positions["pieces"]).view(np.uint8).reshape(n, 12, 8), axis=2, bitorder="little")
+    planes[:, 6:18] = bits.reshape(n, 12, 8, 8)[:, :, ::-1, :].astype(bool)
+    en_passant = positions["en_passant"].astype(np.int64)
+    has_en_passant = en_passant >= 0
+    planes[np.nonzero(has_en_passant)[0], 18, 7 - en_passant[has_en_passant] // 8, en_passant[has_en_passant] % 8] = True
+    return planes.reshape(n, *config.INPUT_SHAPE)
+
+
+def decode_policies(positions: np.ndarray, policy: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """
+    The dense policy vectors (N, 4672) of the positions, from the policy entries at their starts (see policy_offsets).
+    """
+    n = len(positions)
+    policies = np.zeros((n, config.OUTPUT_SHAPE[0]), dtype=np.float32)
+    lengths = positions["policy_length"].astype(np.int64)
+    # the index of every policy entry of the positions, and the position it belongs to
+    entries = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    rows = np.repeat(np.arange(n), lengths)
+    policies[rows, policy["index"][entries]] = policy["prob"][entries]
+    return policies
+
+
+def decode_values(positions: np.ndarray) -> np.ndarray:
+    return positions["value"].astype(np.float32) / VALUE_SCALE
+
+
+def convert_folder(folder: str, path: str, compress: bool = config.REPLAY_COMPRESSION) -> int:
+    """
+    Append the pickled .npy games of a folder to a replay file. Returns the amount of converted games.
+    """
+    files = sorted(f for f in os.listdir(folder) if f.endswith(".npy"))
+    converted = 0
+    for file in files:
+        try:
+            game = np.load(os.path.join(folder, file), allow_pickle=True)
+            block = encode_game(list(game))
+        except Exception as e:
+            logging.warning(f"Could not convert {file}: {e}")
+            continue
+        result = float(block.positions["value"][0]) / VALUE_SCALE if len(block.positions) else None
+        append_block(path, block._replace(meta={"game_id": os.path.splitext(file)[0], "result": result}), compress)
+        converted += 1
+    logging.info(f"Converted {converted} of {len(files)} games from {folder} to {path}")
+    return converted
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format=' %(message)s')
+    parser = argparse.ArgumentParser(description="Replay files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser("convert", help="Convert the .npy games of a folder to a replay file")
+    convert.add_argument("folder", type=str)
+    convert.add_argument("path", type=str)
+    convert.add_argument("--compress", action="store_true", help="Compress the blocks (zlib)")
+    info = subparsers.add_parser("info", help="Check replay files and count their games and positions")
+    info.add_argument("paths", type=str, nargs="+")
+    args = parser.parse_args()
+    args = vars(args)
+
+    if args["command"] == "convert":
+        convert_folder(args["folder"], args["path"], args["compress"] or config.REPLAY_COMPRESSION)
+    else:
+        for path in args["paths"]:
+            replay = read_replay(path)
+            positions = replay.positions
+            print(f"{path}: {len(replay.meta)} games, {len(positions)} positions "
+                  f"({int(positions['full_search'].sum())} full searches), {len(replay.policy)} policy entries, "
+                  f"{os.path.getsize(path) / max(len(positions), 1):.0f} bytes per position")
@@ -0,0 +1,229 @@
+# Sharded replay buffer: the games of all self-play processes, in a sliding window of the latest
+# MAX_REPLAY_MEMORY positions. Layout of the folder (MEMORY_DIR):
+#   shard-00000042.rpl   replay files (see replay.py), appended until they hold REPLAY_SHARD_SIZE positions
+#   shard-00000042.idx   the offset and amount of positions of every game in the shard (GAME_DTYPE records, appended)
+#   replay_index.json    the shards, oldest first, with their amount of games and positions
+#   replay.lock          writers append a game and update the index under an exclusive lock of this file
+# When the shards hold more positions than the window, the oldest shards are deleted (FIFO),
+# as long as the other shards still fill the window.
+# Games are written by a background thread (see ReplayWriter), so self-play doesn't wait for the disk.
+#
+# Usage:
+#   python replay_buffer.py info                       the shards and positions in the buffer
+#   python replay_buffer.py import memory/*.npy ...    add games of .npy or .rpl files to the buffer
+import argparse
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from queue import Queue
+
+import numpy as np
+
+import config
+import replay
+
+INDEX_FILE = "replay_index.json"
+LOCK_FILE = "replay.lock"
+# a game in a shard's .idx file: the offset of its block and its amount of positions
+GAME_DTYPE = np.dtype([("offset", "<u8"), ("count", "<u4")])
+
+
+class ReplayBuffer:
+    def __init__(self, folder: str = config.MEMORY_DIR, window: int = config.MAX_REPLAY_MEMORY,
+                 shard_size: int = config.REPLAY_SHARD_SIZE, compress: bool = config.REPLAY_COMPRESSION):
+        """
+        The replay buffer in the folder. Every process (and thread) can append to it at the same time.
+        """
+        self.folder = folder
+        self.window = window
+        self.shard_size = shard_size
+        self.compress = compress
+        os.makedirs(folder, exist_ok=True)
+        self.index_path = os.path.join(folder, INDEX_FILE)
+
+    @contextmanager
+    def lock(self, exclusive: bool = True):
+        """
+        Lock the buffer for all processes. Every call opens the lock file, so threads exclude each other too.
+        """
+        with open(os.path.join(self.folder, LOCK_FILE), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_index(self) -> dict:
+        """
+        {"next_shard": n, "shards": [{"name": ..., "positions": ..., "games": ...}, ...]}
+        """
+        if not os.path.exists(self.index_path):
+            return {"next_shard": 0, "shards": []}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def write_index(self, index: dict):
+        # readers never see a partially written index
+        temp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp, "w") as f:
+            json.dump(index, f)
+        os.replace(temp, self.index_path)
+
+    def games_path(self, shard: dict) -> str:
+        return os.path.join(self.folder, f"{os.path.splitext(shard['name'])[0]}.idx")
+
+    def append(self, block: replay.Block) -> str:
+        """
+        Append a game to the newest shard (or a new one if it is full), and evict the oldest shards
+        that fall out of the window. Returns the name of the shard.
+        The game is appended to the shard's .idx file: the index only has totals, so an append
+        doesn't depend on the amount of games in the window.
+        """
+        with self.lock():
+            index = self.read_index()
+            shards = index["shards"]
+            if not shards or shards[-1]["positions"] >= self.shard_size:
+                shards.append({"name": f"shard-{index['next_shard']:08d}.rpl", "positions": 0, "games": 0})
+                index["next_shard"] += 1
+            shard = shards[-1]
+            path = os.path.join(self.folder, shard["name"])
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            replay.append_block(path, block, self.compress)
+            with open(self.games_path(shard), "ab") as f:
+                # drop the record of a game whose index update was interrupted
+                f.truncate(shard["games"] * GAME_DTYPE.itemsize)
+                f.write(np.array([(offset, len(block.positions))], dtype=GAME_DTYPE).tobytes())
+            shard["games"] += 1
+            shard["positions"] += len(block.positions)
+            self.evict(index)
+            self.write_index(index)
+        return shard["name"]
+
+    def evict(self, index: dict):
+        shards = index["shards"]
+        total = sum(shard["positions"] for shard in shards)
+        while len(shards) > 1 and total - shards[0]["positions"] >= self.window:
+            shard = shards.pop(0)
+            total -= shard["positions"]
+            for path in (os.path.join(self.folder, shard["name"]), self.games_path(shard)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            logging.info(f"Replay buffer: evicted {shard['name']} ({shard['positions']} positions)")
+
+    def shards(self) -> list[dict]:
+        with self.lock(exclusive=False):
+            return self.read_index()["shards"]
+
+    def games(self, shard: dict) -> np.ndarray:
+        """
+        The offsets and amounts of positions (GAME_DTYPE) of the games of a shard (of shards()).
+        Raises FileNotFoundError if the shard was evicted.
+        """
+        return np.fromfile(self.games_path(shard), dtype=GAME_DTYPE, count=shard["games"])
+
+    def __len__(self) -> int:
+        return sum(shard["positions"] for shard in self.shards())
+
+    def load(self) -> replay.Block:
+        """
+        All positions in the buffer, oldest first (like read_replay). A shard that is evicted
+        while it is read is skipped.
+        """
+        blocks = []
+        for shard in self.shards():
+            try:
+                data = replay.read_replay(os.path.join(self.folder, shard["name"]))
+            except FileNotFoundError:
+                continue
+            blocks.append(data)
+        if not blocks:
+            return replay.Block([], np.empty(0, dtype=replay.POSITION_DTYPE), np.empty(0, dtype=replay.POLICY_DTYPE))
+        return replay.Block([meta for block in blocks for meta in block.meta],
+                            np.concatenate([block.positions for block in blocks]),
+                            np.concatenate([block.policy for block in blocks]))
+
+
+class ReplayWriter:
+    def __init__(self, buffer: ReplayBuffer):
+        """
+        Encodes and appends games to the buffer in a background thread. The queued games are written
+        when the writer is closed, also at exit.
+        """
+        self.buffer = buffer
+        # (memory of a game, metadata), None stops the thread
+        self.queue: Queue = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, memory: list, meta: dict):
+        self.queue.put((list(memory), meta))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                memory, meta = item
+                block = replay.encode_game(memory)._replace(meta=meta)
+                shard = self.buffer.append(block)
+                logging.info(f"Game {meta.get('game_id')} saved to {os.path.join(self.buffer.folder, shard)}")
+            except Exception as e:
+                logging.error(f"Could not save game to the replay buffer: {e}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Wait until the queued games are written.
+        """
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+def import_files(buffer: ReplayBuffer, paths: list[str]) -> int:
+    """
+    Add the games of .npy files (one game each) and replay files to the buffer. Returns the amount of games.
+    """
+    games = 0
+    for path in paths:
+        if path.endswith(".npy"):
+            block = replay.encode_game(list(np.load(path, allow_pickle=True)))
+            blocks = [block._replace(meta={"game_id": os.path.splitext(os.path.basename(path))[0]})]
+        else:
+            blocks = list(replay.read_blocks(path))
+        for block in blocks:
+            buffer.append(block)
+        games += len(blocks)
+    return games
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format=' %(message)s')
+    parser = argparse.ArgumentParser(description="Replay buffer")
+    parser.add_argument("--folder", type=str, default=config.MEMORY_DIR, help="The replay buffer folder")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("info", help="The shards and positions in the buffer")
+    add = subparsers.add_parser("import", help="Add the games of .npy or .rpl files to the buffer")
+    add.add_argument("paths", type=str, nargs="+")
+    args = parser.parse_args()
+    args = vars(args)
+
+    buffer = ReplayBuffer(args["folder"])
+    if args["command"] == "import":
+        print(f"Imported {import_files(buffer, args['paths'])} games")
+    shards = buffer.shards()
+    for shard in shards:
+        print(f"{shard['name']}: {shard['games']} games, {shard['positions']} positions")
+    print(f"{sum(shard['positions'] for shard in shards)} positions in {len(shards)} shards (window: {buffer.window})")
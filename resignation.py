@@ -0,0 +1,126 @@
+# Value-based resignation for self-play (RESIGNATION=true).
+# A side resigns when the value of its search stays below the threshold for RESIGN_CONSECUTIVE of its moves.
+# A random fraction of the games is played out anyway: for both sides of these games, the highest threshold
+# at which the side would have resigned is stored with the outcome. The threshold is calibrated on these
+# records, so that at most RESIGN_FALSE_RATE of the resignations would have been wrong (a draw or a win).
+import json
+import logging
+import os
+
+import chess
+import numpy as np
+
+import config
+
+
+def search_value(mcts) -> float:
+    """
+    The value of the root after the search, from white's perspective: the mean of the values
+    backed up through the root, or the network's value if no simulation went through it.
+    """
+    visits = sum(edge.N for edge in mcts.root.edges)
+    if not visits:
+        return float(mcts.root.value)
+    return sum(edge.W for edge in mcts.root.edges) / visits
+
+
+class Resignation:
+    def __init__(self, threshold: float = config.RESIGN_THRESHOLD, consecutive: int = config.RESIGN_CONSECUTIVE,
+                 playout_fraction: float = config.RESIGN_PLAYOUT_FRACTION, false_rate: float = config.RESIGN_FALSE_RATE,
+                 path: str = config.RESIGN_PLAYOUTS_FILE):
+        """
+        Decides when a side resigns, and calibrates the threshold on the played out games in the file at path.
+        """
+        self.initial_threshold = threshold
+        self.threshold = threshold
+        self.consecutive = consecutive
+        self.playout_fraction = playout_fraction
+        self.false_rate = false_rate
+        self.path = path
+        self.calibrate()
+        self.new_game()
+
+    def new_game(self):
+        """
+        Reset for a new game, and decide if it is played out.
+        """
+        self.playout = np.random.random() < self.playout_fraction
+        # the values of every side's searches, from its own perspective
+        self.values = {chess.WHITE: [], chess.BLACK: []}
+
+    def update(self, color: bool, value: float) -> bool:
+        """
+        Add the value of a search of the given side (from white's perspective).
+        Returns True if the side resigns.
+        """
+        values = self.values[color]
+        values.append(value if color == chess.WHITE else -value)
+        recent = values[-self.consecutive:]
+        return not self.playout and len(recent) == self.consecutive and max(recent) < self.threshold
+
+    def resign_value(self, color: bool):
+        """
+        The highest threshold at which the side would have resigned: the lowest maximum value
+        over RESIGN_CONSECUTIVE consecutive moves. None if the side played fewer moves.
+        """
+        values = self.values[color]
+        if len(values) < self.consecutive:
+            return None
+        return min(max(values[i:i + self.consecutive]) for i in range(len(values) - self.consecutive + 1))
+
+    def finish(self, winner: float, full_game: bool = True):
+        """
+        After a played out game: store the resign values of both sides with their outcome, and recalibrate.
+        Adjudicated games (move limit, repetition or adjourned) have no real outcome, and are not stored.
+        """
+        if not self.playout or not full_game:
+            return
+        records = []
+        for color in (chess.WHITE, chess.BLACK):
+            value = self.resign_value(color)
+            if value is not None:
+                lost = winner < 0 if color == chess.WHITE else winner > 0
+                records.append(json.dumps({"resign_value": value, "lost": lost}) + "\n")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # one short write per game: lines of different processes don't interleave
+        with open(self.path, "a") as f:
+            f.write("".join(records))
+        self.calibrate()
+
+    def load(self) -> list[tuple[float, bool]]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [(record["resign_value"], record["lost"]) for record in map(json.loads, f) if record]
+
+    def calibrate(self):
+        """
+        Set the threshold to the highest value at which at most RESIGN_FALSE_RATE of the played out sides
+        that would have resigned did not lose. Never above 0: a side doesn't resign in an equal position.
+        """
+        records = sorted(self.load())
+        threshold, resignations, false_resignations = None, 0, 0
+        for value, lost in records:
+            # a threshold just above this value: every side up to here would have resigned
+            resignations += 1
+            false_resignations += not lost
+            if resignations >= config.RESIGN_MIN_PLAYOUTS and false_resignations / resignations <= self.false_rate:
+                threshold = value
+        if threshold is None:
+            if len(records) < config.RESIGN_MIN_PLAYOUTS:
+                logging.debug(f"Not enough played out games to calibrate the resign threshold ({len(records)} sides)")
+                return
+            # every threshold resigns too many games that weren't lost: none of the played out sides would resign
+            self.threshold = min(records[0][0], 0.0)
+        else:
+            self.threshold = min(float(np.nextafter(threshold, np.inf)), 0.0)
+        logging.info(f"Resign threshold calibrated to {self.threshold:.3f} on {len(records)} played out sides "
+                     f"(false resignation rate {self.false_resignation_rate(records):.1%})")
+
+    def false_resignation_rate(self, records: list = None) -> float:
+        """
+        The fraction of the played out sides that would have resigned at the current threshold, but did not lose.
+        """
+        records = self.load() if records is None else records
+        resigned = [lost for value, lost in records if value < self.threshold]
+        return resigned.count(False) / len(resigned) if resigned else 0.0
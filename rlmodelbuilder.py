@@ -139,6 +139,18 @@ class RLModelBuilder:
                   activation='tanh', name='value_head'))
         return model
 
+    @staticmethod
+    def freeze_model(model: Model) -> ConcreteFunction:
+        """
+        Freeze the model: convert its variables to constants, so the graph can be
+        exported and optimized (e.g. for CPU inference) without the Keras layers.
+        Returns the frozen concrete function, its graph can be saved with tf.io.write_graph.
+        """
+        function = tf.function(lambda x: model(x, training=False))
+        concrete_function = function.get_concrete_function(
+            tf.TensorSpec((None, *model.input_shape[1:]), model.inputs[0].dtype, name="main_input"))
+        return convert_variables_to_constants_v2(concrete_function)
+
 
 if __name__ == "__main__":
     # parse arguments
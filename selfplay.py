@@ -1,38 +1,50 @@
 import argparse
 import logging
-from multiprocessing import Pool
+import multiprocessing
 # disable tensorflow info messages
 import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
 from random import choice, choices
 from re import I
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import socket
 import time
+from queue import Empty
 from agent import Agent
 from chessEnv import ChessEnv
 from game import Game
 import config
 import numpy as np
 import chess
-import pandas as pd
-from GUI.display import GUI
+import transport
+from typing import Tuple
 
 
 # set logging config
 logging.basicConfig(level=logging.INFO, format=' %(message)s')
 
-def setup(starting_position: str = chess.STARTING_FEN, local_predictions=False) -> Game:
+def setup(starting_position: str = chess.STARTING_FEN, local_predictions=False, seed: int = None,
+          shared_tree: bool = config.SELFPLAY_SHARED_TREE) -> Game:
     """
     Setup function to set up a game. 
     This can be used in both the self-play and puzzle solving function
+    With shared_tree, both colors are played by the same agent (see SELFPLAY_SHARED_TREE).
     """
-    # set different random seeds for each process
-    number = int.from_bytes(socket.gethostname().encode(), 'little')
-    number *= os.getpid() if os.getpid() != 0 else 1
-    number *= int(time.time())
-    number %= 123456789
-    
+    if seed is None:
+        # set different random seeds for each process
+        number = int.from_bytes(socket.gethostname().encode(), 'little')
+        number *= os.getpid() if os.getpid() != 0 else 1
+        number *= int(time.time())
+        number %= 123456789
+    else:
+        number = seed
+
     np.random.seed(number)
+    random.seed(number)
     print(f"========== > Setup. Test Random number: {np.random.randint(0, 123456789)}")
 
 
@@ -42,7 +54,7 @@ def setup(starting_position: str = chess.STARTING_FEN, local_predictions=False)
     # create agents
     model_path = os.path.join(config.MODEL_FOLDER, "model.h5")
     white = Agent(local_predictions, model_path, env.board.fen())
-    black = Agent(local_predictions, model_path, env.board.fen())
+    black = white if shared_tree else Agent(local_predictions, model_path, env.board.fen())
 
     return Game(env=env, white=white, black=black)
 
@@ -56,6 +68,8 @@ def self_play(local_predictions=False):
 
     # play games continuously
     if show_board:
+        # pygame is only needed to show the board
+        from GUI.display import GUI
         gui = GUI(400, 400, game.env.board.turn)
         game.GUI = gui
     while True:
@@ -64,6 +78,178 @@ def self_play(local_predictions=False):
             game.GUI.draw()
         game.play_one_game(stochastic=True)
 
+def worker_seed(base_seed: int, index: int, generation: int) -> int:
+    """
+    A distinct seed for every worker, and for every restart of a worker.
+    """
+    return int(np.random.SeedSequence(base_seed, spawn_key=(index, generation)).generate_state(1)[0])
+
+
+# exit code of a worker that couldn't reach the prediction server: it is restarted after HEALTH_CHECK_INTERVAL
+CONNECTION_ERROR_EXIT = 3
+
+
+def self_play_worker(index: int, seed: int, stop, results):
+    """
+    A self-play worker process (see Orchestrator). Plays games until stop is set.
+    SIGINT is ignored, so the current game is finished when the orchestrator stops.
+    On SIGTERM, the current game is ended after the current move: adjudicated and saved like a game
+    that reached the move limit.
+    """
+    logging.basicConfig(level=logging.INFO, format=f' [worker {index}] %(message)s')
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        game = setup(seed=seed)
+    except ConnectionError as e:
+        logging.error(str(e))
+        sys.exit(CONNECTION_ERROR_EXIT)
+    signal.signal(signal.SIGTERM, lambda *_: setattr(game, "adjourn", True))
+    try:
+        while not stop.is_set() and not game.adjourn:
+            start_time = time.perf_counter()
+            game.play_one_game(stochastic=True)
+            results.put((index, len(game.env.board.move_stack), time.perf_counter() - start_time))
+    except ConnectionError as e:
+        logging.error(f"Lost the connection to the prediction server: {e}")
+        sys.exit(CONNECTION_ERROR_EXIT)
+    finally:
+        # worker processes don't run exit handlers: write the last games now
+        game.close()
+
+
+def start_local_server(folder: str) -> Tuple[subprocess.Popen, str]:
+    """
+    Start a prediction server for the models in the given folder, only reachable through a unix socket
+    in a temporary directory. The workers share it, so their positions are predicted in batches.
+    """
+    directory = tempfile.mkdtemp(prefix="selfplay-")
+    path = os.path.join(directory, "server.sock")
+    env = dict(os.environ, MODEL_FOLDER=folder, SOCKET_PATH=path, SOCKET_HOST="127.0.0.1", SOCKET_PORT="0",
+               STATS_SOCKET=os.path.join(directory, "stats.sock"))
+    # a new session: an interrupt in the terminal must not stop the server before the workers are done
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")],
+                              env=env, start_new_session=True)
+    while not transport.is_server_up("unix", path):
+        if server.poll() is not None:
+            raise RuntimeError(f"The local prediction server exited with code {server.returncode}")
+        time.sleep(0.5)
+    logging.info(f"Local prediction server started on {path}")
+    return server, path
+
+
+class Orchestrator:
+    def __init__(self, workers: int, seed: int, report_interval: float, shutdown_timeout: float):
+        """
+        Runs self-play in multiple worker processes. All workers use the same inference backend:
+        the prediction server (remote, or a local one started for the workers, see start_local_server).
+        Crashed workers are restarted with a new seed (workers that couldn't reach the server after
+        HEALTH_CHECK_INTERVAL seconds). The throughput of all workers is reported
+        every report_interval seconds.
+
+        Shutting down (SIGINT or SIGTERM): the workers finish their current game.
+        A second signal, or shutdown_timeout seconds later, the workers end their current game after
+        the current move and save it. After a third signal, they are killed.
+        """
+        self.count = workers
+        self.seed = seed
+        self.report_interval = report_interval
+        self.shutdown_timeout = shutdown_timeout
+        # spawn: the workers don't inherit the orchestrator's state
+        self.context = multiprocessing.get_context("spawn")
+        self.stop = self.context.Event()
+        self.results = self.context.Queue()
+        self.processes: list = [None] * workers
+        self.generations = [0] * workers
+        # when a stopped worker is restarted (None: it is running)
+        self.restart_at: list = [None] * workers
+        self.restarts = 0
+        self.signals = 0
+        self.stop_time = None
+        self.games, self.positions = 0, 0
+
+    def start_worker(self, index: int):
+        seed = worker_seed(self.seed, index, self.generations[index])
+        process = self.context.Process(target=self_play_worker, args=(index, seed, self.stop, self.results),
+                                       name=f"selfplay-worker-{index}")
+        process.start()
+        self.processes[index] = process
+        logging.info(f"Started self-play worker {index} (pid {process.pid}, seed {seed})")
+
+    def handle_signal(self, signum, frame):
+        self.signals += 1
+        if self.signals == 1:
+            logging.info("Stopping: the workers finish their current game (interrupt again to end the games now)")
+            self.stop.set()
+            self.stop_time = time.time()
+        elif self.signals == 2:
+            self.end_games()
+        else:
+            logging.info("Killing the workers")
+            for process in self.processes:
+                if process.is_alive():
+                    process.kill()
+
+    def end_games(self):
+        logging.info("Ending and saving the current games")
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+    def collect(self, timeout: float):
+        """
+        Collect the results of finished games, for at most timeout seconds.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                _, moves, _ = self.results.get(timeout=max(0.0, deadline - time.time()))
+            except Empty:
+                return
+            self.games += 1
+            self.positions += moves
+
+    def report(self, start_time: float, interval_start: tuple):
+        elapsed = time.time() - start_time
+        interval = time.time() - interval_start[0]
+        games, positions = self.games - interval_start[1], self.positions - interval_start[2]
+        logging.info(f"Self-play: {self.games} games, {self.positions} positions in {elapsed / 60:.1f} min | "
+                     f"{self.games / elapsed * 3600:.1f} games/hour, {self.positions / elapsed:.2f} positions/s "
+                     f"(last {interval:.0f}s: {games / interval * 3600:.1f} games/hour, {positions / interval:.2f} positions/s) | "
+                     f"{sum(p.is_alive() for p in self.processes)}/{self.count} workers alive, {self.restarts} restarts")
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        for index in range(self.count):
+            self.start_worker(index)
+        start_time = time.time()
+        interval_start = (start_time, 0, 0)
+        while any(process.is_alive() for process in self.processes) or not self.stop.is_set():
+            self.collect(timeout=1)
+            if not self.stop.is_set():
+                for index, process in enumerate(self.processes):
+                    if process.is_alive():
+                        continue
+                    if self.restart_at[index] is None:
+                        delay = config.HEALTH_CHECK_INTERVAL if process.exitcode == CONNECTION_ERROR_EXIT else 0
+                        logging.warning(f"Self-play worker {index} exited with code {process.exitcode}, restarting it"
+                                        + (f" in {delay:.0f}s" if delay else ""))
+                        self.restart_at[index] = time.time() + delay
+                    if time.time() >= self.restart_at[index]:
+                        self.restart_at[index] = None
+                        self.restarts += 1
+                        self.generations[index] += 1
+                        self.start_worker(index)
+            elif self.signals == 1 and self.shutdown_timeout and time.time() - self.stop_time > self.shutdown_timeout:
+                self.signals += 1
+                self.end_games()
+            if time.time() - interval_start[0] >= self.report_interval:
+                self.report(start_time, interval_start)
+                interval_start = (time.time(), self.games, self.positions)
+        self.collect(timeout=0)
+        self.report(start_time, interval_start)
+
+
 def puzzle_solver(puzzles, local_predictions=False):
     """
     Continuously solve puzzles 
@@ -72,57 +258,71 @@ def puzzle_solver(puzzles, local_predictions=False):
 
     # solve puzzles continuously
     while True:
-        # shuffle pandas rows
-        puzzles = puzzles.sample(frac=1).reset_index(drop=True)
+        # shuffle the puzzles (of an index, only the rows are shuffled)
+        if isinstance(puzzles, list):
+            random.shuffle(puzzles)
+        else:
+            puzzles.shuffle()
         game.train_puzzles(puzzles)
 
 if __name__ == "__main__":
     # argparse
     parser = argparse.ArgumentParser(description='Run self-play or puzzle solver')
     parser.add_argument('--type', type=str, default='selfplay', choices=('selfplay', 'puzzles') ,help='selfplay or puzzles')
-    parser.add_argument('--puzzle-file', type=str, default=None, help='File to load puzzles from (csv)')
+    parser.add_argument('--puzzle-file', type=str, default=None, help='File to load puzzles from (csv, or an index folder created by puzzle_index.py)')
     parser.add_argument('--puzzle-type', type=str, default='mateIn1', help='Type of puzzles to solve. Make sure to set a puzzle move limit in config.py if necessary')
+    parser.add_argument('--min-rating', type=int, default=None, help='Minimum rating of the puzzles')
+    parser.add_argument('--max-rating', type=int, default=None, help='Maximum rating of the puzzles')
     parser.add_argument('--local-predictions', action='store_true', help='Use local predictions instead of the server')
+    parser.add_argument('--shared-tree', action='store_true', help='Play both colors with one agent and one search tree')
+    parser.add_argument('--workers', type=int, default=0, help='Play self-play games in this many worker processes (0: in this process)')
+    parser.add_argument('--seed', type=int, default=None, help='Base seed of the workers (default: random)')
+    parser.add_argument('--report-interval', type=float, default=60, help='Seconds between throughput reports of the workers')
+    parser.add_argument('--shutdown-timeout', type=float, default=600, help='Seconds the workers get to finish their game when stopping (0: no limit)')
     args = parser.parse_args()
     args = vars(args)
 
     if args['type'] == 'puzzles' and args['puzzle_file'] is None:
         raise argparse.ArgumentError('puzzle-file must be specified when type is puzzles')
 
+    if args['shared_tree']:
+        # also for the worker processes
+        os.environ["SELFPLAY_SHARED_TREE"] = "true"
+        config.SELFPLAY_SHARED_TREE = True
+
+    if args['workers']:
+        if args['type'] != 'selfplay':
+            raise SystemExit('--workers is only supported for selfplay')
+        server = None
+        if args['local_predictions']:
+            # the workers share one local model: a prediction server that only they use
+            server, path = start_local_server(config.MODEL_FOLDER)
+            os.environ.update(SOCKET_PATH=path, SOCKET_TRANSPORT="unix")
+        else:
+            transport.wait_for_server()
+        # the workers read their config from the environment
+        os.environ.update(INFERENCE_BACKEND="server", SELFPLAY_SHOW_BOARD="false")
+        seed = args['seed'] if args['seed'] is not None else int(time.time())
+        try:
+            Orchestrator(args['workers'], seed, args['report_interval'], args['shutdown_timeout']).run()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        sys.exit(0)
+
     local_predictions = False
     if args['local_predictions']:
         local_predictions = True
-    else:
+    elif config.INFERENCE_BACKEND in ("auto", "server"):
         # wait until server is ready
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        server = os.environ.get("SOCKET_HOST", "localhost")
-        port = int(os.environ.get("SOCKET_PORT", 5000))
-
-        print("Checking if server is ready...")
-        while s.connect_ex((server, port)) != 0:
-            print(f"Waiting for server at {server}:{port}")
-            time.sleep(1)
-        print(f"Server is ready on {s.getsockname()}!")
-        s.close()
+        transport.wait_for_server()
     
     if args['type'] == 'selfplay':
         self_play(local_predictions)
     else:
-        puzzles = Game.create_puzzle_set(filename=args['puzzle_file'], type=args['puzzle_type'])
+        puzzles = Game.create_puzzle_set(filename=args['puzzle_file'], type=args['puzzle_type'],
+                                         min_rating=args['min_rating'], max_rating=args['max_rating'])
         puzzle_solver(puzzles, local_predictions)
-
-
-    # ======== if not in docker, run multiple processes here: ========
-    # the amount of games to play simultaneously
-    # p_count = 1
-
-    # with Pool(processes=p_count) as pool:
-    #     pool.map(self_play, [None for _ in range(p_count)])
-
-    # multiprocessed puzzle solver
-    # with Pool(processes=p_count) as pool:
-    #     puzzles = Game.create_puzzle_set(filename="puzzles/lichess_db_puzzle.csv", type="mateIn1")
-    #     pool.map(puzzle_solver, [puzzles for _ in range(p_count)])
     
     
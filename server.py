@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 import socket
@@ -7,22 +6,294 @@ from tracemalloc import start
 from typing import Tuple
 import config
 import numpy as np
+import struct
 import threading
-import utils
+import framing
+import transport
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from metrics import ServerMetrics, start_stats_server
+from inference_worker import InferenceWorker, configure_threads, start_workers
+from model_registry import ModelRegistry, batch_buckets
 
 from dotenv import load_dotenv
 load_dotenv()
 
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-
 logging.basicConfig(level=logging.INFO, format=' %(message)s')
 
-model = load_model(config.MODEL_FOLDER + "/model.h5")
+# priority class number => name
+PRIORITY_NAMES = {number: name for name, number in framing.PRIORITIES.items()}
+
+
+class RemoteModel:
+	def __init__(self, model_id: str, path: str):
+		"""
+		A model that is predicted by the inference workers: the server process only tracks its version.
+		"""
+		self.model_id = model_id
+		self.path = path
+		self.mtime = os.path.getmtime(path)
+
+	def warm_up(self):
+		"""
+		Let every worker load (and warm up) this version of the model, in parallel.
+		"""
+		with ThreadPoolExecutor(max(1, len(workers))) as executor:
+			list(executor.map(lambda worker: worker.load(self.model_id), workers))
+
+
+class PredictionCache:
+	def __init__(self, size: int):
+		"""
+		LRU cache of encoded responses, keyed by model and input.
+		Many clients search the same positions (e.g. both players in self-play), so they can share predictions.
+		A size of 0 disables the cache.
+		"""
+		self.size = size
+		self.entries: OrderedDict = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		if not self.size:
+			return None
+		with self.lock:
+			response = self.entries.get(key)
+			if response is not None:
+				self.entries.move_to_end(key)
+			return response
+
+	def put(self, key, response):
+		if not self.size:
+			return
+		with self.lock:
+			self.entries[key] = response
+			if len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+
+
+class ModelWatcher(threading.Thread):
+	def __init__(self, registry: ModelRegistry, interval: float):
+		"""
+		Thread that periodically checks the model folder for new versions of the served models.
+		"""
+		super().__init__(daemon=True)
+		self.registry = registry
+		self.interval = interval
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			self.registry.reload_changed()
+
+
+class PredictionRequest:
+	def __init__(self, model_id: str, served, data: np.ndarray, callback, key=None,
+				 priority: int = framing.DEFAULT_PRIORITY, deadline: int = 0, values_only: bool = False):
+		"""
+		A single input waiting to be predicted. When the prediction is done, callback(p, v) is called,
+		or callback(None, v) if only the value was requested.
+		If the prediction fails, callback(None, error) is called.
+		A request with a deadline (in milliseconds) is dropped if it is still queued after the deadline.
+		"""
+		self.model_id = model_id
+		self.served = served
+		self.data = data
+		self.callback = callback
+		# the key in the prediction cache
+		self.key = key
+		self.priority = priority
+		self.values_only = values_only
+		self.received_time = time.perf_counter()
+		self.deadline = self.received_time + deadline / 1000 if deadline else None
+
+
+class BatchQueue:
+	def __init__(self, max_batch_size: int, timeout: float):
+		"""
+		Queue of requests from all clients, with a queue per priority class.
+		The inference thread takes batches from the queue, starting from the oldest request
+		of the highest priority class that is waiting:
+		* interactive requests are predicted right away
+		* other requests wait until max_batch_size requests are waiting, or until the oldest
+		  request has waited for timeout seconds. If a request of a higher priority comes in
+		  while waiting, the batch is formed for that request instead.
+		A batch only contains requests for the same model (and of the same kind: full or value-only predictions),
+		the highest priorities are taken first.
+		Lower priority requests only fill up a batch with interactive requests to the bucket size
+		it is padded to anyway, so they don't slow it down.
+		"""
+		self.max_batch_size = max_batch_size
+		self.timeout = timeout
+		self.buckets = batch_buckets(max_batch_size)
+		self.queues: list[deque[PredictionRequest]] = [deque() for _ in framing.PRIORITIES]
+		# amount of queued requests with a deadline, the queues are only searched for expired requests if there are any
+		self.deadlines = 0
+		self.condition = threading.Condition()
 
-@tf.function(experimental_follow_type_hints=True)
-def predict(args: tf.Tensor) -> Tuple[list[tf.float32], list[list[tf.float32]]]:
-	return model(args)
+	def __len__(self) -> int:
+		return sum(len(queue) for queue in self.queues)
+
+	def put(self, request: PredictionRequest):
+		with self.condition:
+			self.queues[request.priority].append(request)
+			if request.deadline is not None:
+				self.deadlines += 1
+			self.condition.notify()
+
+	def head(self) -> PredictionRequest:
+		"""
+		The oldest request of the highest priority class, or None if the queue is empty.
+		"""
+		for queue in self.queues:
+			if queue:
+				return queue[0]
+		return None
+
+	def remove_expired(self) -> list[PredictionRequest]:
+		"""
+		Remove the requests whose deadline passed from all queues, also the ones that are never reached
+		because higher priority requests keep coming in.
+		"""
+		now = time.perf_counter()
+		expired = []
+		for i, queue in enumerate(self.queues):
+			if any(request.deadline is not None and request.deadline < now for request in queue):
+				expired.extend(request for request in queue if request.deadline is not None and request.deadline < now)
+				self.queues[i] = deque(request for request in queue if request.deadline is None or request.deadline >= now)
+		self.deadlines -= len(expired)
+		return expired
+
+	def get_batch(self) -> Tuple[list[PredictionRequest], list[PredictionRequest]]:
+		"""
+		Wait for the next batch. Returns the batch and the requests whose deadline passed.
+		"""
+		interactive = framing.PRIORITIES["interactive"]
+		with self.condition:
+			expired = self.remove_expired() if self.deadlines else []
+			while True:
+				head = self.head()
+				if head is None:
+					if expired:
+						return [], expired
+					self.condition.wait()
+					continue
+				if head.priority == interactive or len(self) >= self.max_batch_size:
+					break
+				remaining = head.received_time + self.timeout - time.perf_counter()
+				if remaining <= 0:
+					break
+				self.condition.wait(remaining)
+			def matches(request: PredictionRequest) -> bool:
+				return request.served is head.served and request.values_only == head.values_only
+			limit = self.max_batch_size
+			if head.priority == interactive:
+				count = sum(1 for request in self.queues[interactive] if matches(request))
+				limit = next(size for size in self.buckets if size >= min(count, self.max_batch_size))
+			batch = []
+			for queue in self.queues:
+				# requests for other models keep their place
+				others = []
+				while queue and len(batch) < limit:
+					request = queue.popleft()
+					(batch if matches(request) else others).append(request)
+				queue.extendleft(reversed(others))
+			self.deadlines -= sum(1 for request in batch if request.deadline is not None)
+		return batch, expired
+
+
+class InferenceThread(threading.Thread):
+	def __init__(self, queue: BatchQueue, worker: InferenceWorker = None):
+		"""
+		Thread that takes batches from the queue, predicts them and hands every result to its request.
+		With a worker, the batches are predicted by the worker process: every worker has its own thread,
+		so a worker takes the next batch as soon as it is done with the previous one.
+		"""
+		super().__init__(daemon=True)
+		self.queue = queue
+		self.worker = worker
+
+	def run(self):
+		while True:
+			batch, expired = self.queue.get_batch()
+			for request in expired:
+				metrics.increment("expired")
+				request.callback(None, TimeoutError("Deadline exceeded before the request was predicted"))
+			if not batch:
+				continue
+			try:
+				policies, values = self.predict(batch)
+			except Exception as e:
+				logging.warning(f"Could not predict batch with model {batch[0].model_id!r}: {e}")
+				metrics.increment("errors", len(batch))
+				for request in batch:
+					request.callback(None, e)
+				if self.worker is not None and not self.worker.alive:
+					self.worker.restart()
+				continue
+			if batch[0].values_only:
+				# there's no policy to cache
+				for request, v in zip(batch, values):
+					request.callback(None, float(v[0]))
+				continue
+			for request, p, v in zip(batch, policies, values):
+				cache.put(request.key, (p, float(v[0])))
+				request.callback(p, float(v[0]))
+
+	def predict(self, batch: list[PredictionRequest]) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Predict the batch. For value-only requests, only the trunk and the value head are run: the policies are None.
+		"""
+		start_time = time.perf_counter()
+		for request in batch:
+			metrics.observe_queue_wait(PRIORITY_NAMES[request.priority], start_time - request.received_time)
+		metrics.batch_size.observe(len(batch))
+		values_only = batch[0].values_only
+		if self.worker is not None:
+			p, v = self.worker.predict(batch[0].model_id, [request.data for request in batch], values_only)
+		else:
+			# a single request is predicted straight from its receive buffer
+			data = batch[0].data[np.newaxis] if len(batch) == 1 else np.stack([request.data for request in batch])
+			if values_only:
+				p, v = None, batch[0].served.predict_values(data)
+			else:
+				p, v = batch[0].served.predict(data)
+		metrics.inference_time.observe(time.perf_counter() - start_time)
+		return p, v
+
+
+registry = ModelRegistry(config.MODEL_FOLDER)
+cache = PredictionCache(config.PREDICTION_CACHE_SIZE)
+metrics = ServerMetrics()
+batch_queue = BatchQueue(config.MAX_BATCH_SIZE, config.BATCH_TIMEOUT)
+workers: list[InferenceWorker] = []
+
+
+def submit(model_id: str, data, callback, priority: int = framing.DEFAULT_PRIORITY, deadline: int = 0, values_only: bool = False):
+	"""
+	Submit an input (1216 bytes of booleans) for prediction with the given model.
+	The callback is called with the policy and the value, immediately if the prediction is cached.
+	Value-only requests get None instead of the policy: they use cached predictions, but don't add to the cache.
+	Returns False if the model can't be loaded.
+	"""
+	try:
+		served = registry.get(model_id)
+	except Exception as e:
+		logging.warning(f"Could not get model {model_id!r}: {e}")
+		metrics.increment("errors")
+		callback(None, e)
+		return False
+	# the model's modification time is part of the key, so a reloaded model doesn't use old entries
+	key = (model_id, served.mtime, bytes(data)) if cache.size else None
+	prediction = cache.get(key)
+	if prediction is not None:
+		metrics.increment("cache_hits")
+		callback(None if values_only else prediction[0], prediction[1])
+		return True
+	metrics.increment("cache_misses")
+	data = np.frombuffer(data, dtype=bool).reshape(config.INPUT_SHAPE)
+	batch_queue.put(PredictionRequest(model_id, served, data, callback, key, priority, deadline, values_only))
+	return True
 
 
 class ServerSocket:
@@ -35,43 +306,70 @@ class ServerSocket:
 		"""
 		self.host = host
 		self.port = port
-		# first prediction
-		test_data = np.random.choice(a=[False, True], size=(1, *config.INPUT_SHAPE), p=[0, 1])
-		tf.convert_to_tensor(test_data, dtype=tf.bool)
-		p, v = predict(test_data)
-		del test_data, p, v
+		if config.INFERENCE_WORKERS:
+			workers.extend(start_workers())
+			registry.model_class = RemoteModel
+			self.inference_threads = [InferenceThread(batch_queue, worker) for worker in workers]
+		else:
+			configure_threads(config.INTRA_OP_THREADS, config.INTER_OP_THREADS)
+			self.inference_threads = [InferenceThread(batch_queue)]
+		# load and warm up the models that should be available immediately
+		for model_id in config.SERVED_MODELS:
+			registry.get(model_id.strip())
+		self.watcher = ModelWatcher(registry, config.MODEL_RELOAD_INTERVAL)
+		self.watcher.start()
+		for thread in self.inference_threads:
+			thread.start()
 
 
 	def start(self):
 		"""
 		Start the server and listen for connections.
+		Besides TCP, the server listens on a unix socket for clients on the same host,
+		and on a second unix socket for clients that use shared memory.
 		"""
 		logging.info(f"Starting server on {self.host}:{self.port}...")
-		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-		self.sock.bind((self.host, self.port))
-		# listen for incoming connections, queue up to 24 requests
-		self.sock.listen(24)
+		self.sock = self.listen(socket.AF_INET, (self.host, self.port))
 		logging.info(f"Server started on {self.sock.getsockname()}")
+		start_stats_server(metrics, port=config.STATS_PORT, socket_path=config.STATS_SOCKET)
+		if config.SOCKET_PATH:
+			for path, handler in ((config.SOCKET_PATH, ClientHandler), (config.SOCKET_PATH + ".shm", SharedMemoryHandler)):
+				if os.path.exists(path):
+					os.remove(path)
+				unix_sock = self.listen(socket.AF_UNIX, path)
+				logging.info(f"Server listening on unix socket {path}")
+				threading.Thread(target=self.accept_loop, args=(unix_sock, handler), daemon=True).start()
 		try:
-			while True:
-				self.accept()
-				logging.info(f"Current thread count: {threading.active_count()}.")
+			self.accept_loop(self.sock, ClientHandler)
 		except KeyboardInterrupt:
 			self.stop()
 		except Exception as e:
 			logging.debug(f"Error: {e}")
 			self.sock.close()
 
-	def accept(self):
+	def listen(self, family: int, address) -> socket.socket:
+		sock = socket.socket(family, socket.SOCK_STREAM)
+		if family == socket.AF_INET:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		sock.bind(address)
+		# listen for incoming connections, queue up to 24 requests
+		sock.listen(24)
+		return sock
+
+	def accept_loop(self, sock: socket.socket, handler: type):
+		while True:
+			self.accept(sock, handler)
+			logging.info(f"Current thread count: {threading.active_count()}.")
+
+	def accept(self, sock: socket.socket, handler: type):
 		"""
 		Accept a connection and create a client handler for it.	
 		"""
 		logging.info("Waiting for client...")
-		self.client, address = self.sock.accept()
-		logging.info(f"Client connected from {address}")
-		clh = ClientHandler(self.client, address)
+		client, address = sock.accept()
+		logging.info(f"Client connected from {address or sock.getsockname()}")
+		clh = handler(client, address)
 		# start new thread to handle client
 		clh.start()
 
@@ -86,67 +384,233 @@ class ClientHandler(threading.Thread):
 		"""
 		The ClientHandler object handles a single client connection, and sends
 		inputs to the server, and returns the server's predictions to the client.
+
+		A client can have many requests in flight: every request carries an id, and the
+		response is sent with the same id as soon as its batch is predicted, so responses
+		can arrive out of order. Responses are sent by a separate writer thread.
+
+		Inputs are received straight into reusable buffers, which are handed to the model
+		without copying. They go back to the pool when their prediction is done.
 		"""
 		super().__init__()
-		self.BUFFER_SIZE = config.SOCKET_BUFFER_SIZE
 		self.sock = sock
 		self.address = address
+		if isinstance(address, tuple):
+			self.client = f"{address[0]}:{address[1]}"
+		else:
+			# unix socket clients don't have an address
+			self.client = f"unix:{sock.fileno()}"
+		self.buffers = framing.BufferPool(framing.INPUT_SIZE)
+		# (request id, policy, value) tuples waiting to be sent, None stops the writer.
+		# The value is an exception if the prediction failed, the policy is None for value requests.
+		self.responses: Queue = Queue()
 
 	def run(self):
 		"""Create a new thread"""
 		print(f"ClientHandler started.")
+		metrics.client_connected(self.client)
+		writer = threading.Thread(target=self.write_responses, daemon=True)
+		writer.start()
+		reader = framing.FrameReader(self.sock, framing.REQUEST_HEADER)
 		while True:
-			data = self.receive()
-			if data is None or len(data) == 0:
-				self.close()
+			request_id, kind, model_id, priority, deadline, buffer = self.receive(reader)
+			if buffer is None:
 				break
-			data = np.array(np.frombuffer(data, dtype=bool))
-			data = data.reshape(1, *config.INPUT_SHAPE)
-			data = tf.convert_to_tensor(data, dtype=tf.bool)
-			# make prediction
-			p, v = predict(data)
-			p, v = p[0].numpy().tolist(), float(v[0][0])
-			response = json.dumps({"prediction": p, "value": v})
-			self.send(f"{len(response):010d}".encode('ascii'))
-			self.send(response.encode('ascii'))
-
-	def receive(self):
+			metrics.record_request(self.client, framing.REQUEST_HEADER.size + len(buffer))
+			if kind == framing.KIND_VALUES:
+				self.submit_values(request_id, model_id, priority, deadline, buffer)
+				continue
+			submit(model_id, buffer, lambda p, v, request_id=request_id, buffer=buffer: self.respond(request_id, buffer, p, v),
+				   priority, deadline)
+		self.responses.put(None)
+		writer.join()
+		self.close()
+
+	def respond(self, request_id: int, buffer: bytearray, p: np.ndarray, v):
+		"""
+		Called when the prediction is done: recycle the input buffer and queue the response.
+		"""
+		self.buffers.put(buffer)
+		self.responses.put((request_id, p, v))
+
+	def submit_values(self, request_id: int, model_id: str, priority: int, deadline: int, buffer: bytearray):
+		"""
+		Submit every input of a value request separately, so they are batched with the other requests.
+		The response is queued when all values are in, or when the first one fails.
+		"""
+		count = len(buffer) // framing.INPUT_SIZE
+		values = np.empty(count, dtype=framing.OUTPUT_DTYPE)
+		remaining = [count]
+		lock = threading.Lock()
+		def done(index: int, _, v):
+			with lock:
+				if not remaining[0]:
+					# an other input failed already
+					return
+				if isinstance(v, Exception):
+					remaining[0] = 0
+					self.responses.put((request_id, None, v))
+					return
+				values[index] = v
+				remaining[0] -= 1
+				if not remaining[0]:
+					self.responses.put((request_id, None, values))
+		view = memoryview(buffer)
+		for index in range(count):
+			submit(model_id, view[index * framing.INPUT_SIZE:(index + 1) * framing.INPUT_SIZE],
+				   lambda p, v, index=index: done(index, p, v), priority, deadline, values_only=True)
+
+	def write_responses(self):
+		"""
+		Send the responses, in the order their predictions finish.
+		"""
+		while True:
+			response = self.responses.get()
+			if response is None:
+				break
+			request_id, p, v = response
+			start_time = time.perf_counter()
+			try:
+				size = framing.OUTPUT_SIZE
+				if isinstance(v, Exception):
+					framing.send_error(self.sock, request_id, str(v))
+				elif p is None:
+					framing.send_values(self.sock, request_id, v)
+					size = v.nbytes
+				else:
+					framing.send_response(self.sock, request_id, p, v)
+			except OSError as e:
+				logging.warning(f"Could not send response to {self.client}: {e}")
+				break
+			metrics.serialization_time.observe(time.perf_counter() - start_time)
+			metrics.record_response(framing.RESPONSE_HEADER.size + size)
+
+	def receive(self, reader: framing.FrameReader):
 		"""
 		Receive data from the client.
+		Every message starts with the length of the data, the request id, the kind of request, the priority,
+		the deadline and the id of the model to use. A value request can have multiple inputs.
 		"""
-		data = None
 		try:
-			data_length = self.sock.recv(10)
-			if data_length == b'':
-				# this happens if the socket connects and then closes without sending data
-				return data
-			data_length = int(data_length.decode("ascii"))
-			data = utils.recvall(self.sock, data_length)
-			if len(data) != 1216:
-				data = None
-				raise ValueError("Invalid data length, closing socket")
+			header = reader.read_header()
+			if header is None:
+				# the client closed the connection
+				return None, None, None, None, None, None
+			data_length, request_id, kind, priority, deadline, model_id = header
+			if kind == framing.KIND_VALUES:
+				if data_length % framing.INPUT_SIZE or not 0 < data_length <= framing.MAX_VALUE_POSITIONS * framing.INPUT_SIZE:
+					raise ValueError("Invalid data length, closing socket")
+				# value requests are rare and vary in size: not pooled
+				buffer = bytearray(data_length)
+			elif kind == framing.KIND_PREDICT:
+				if data_length != framing.INPUT_SIZE:
+					raise ValueError("Invalid data length, closing socket")
+				buffer = self.buffers.get()
+			else:
+				raise ValueError(f"Invalid request kind {kind}, closing socket")
+			if priority not in PRIORITY_NAMES:
+				raise ValueError(f"Invalid priority {priority}, closing socket")
+			if not reader.read_payload(buffer):
+				return None, None, None, None, None, None
+			return request_id, kind, model_id.rstrip(b"\x00").decode("ascii"), priority, deadline, buffer
 		except ConnectionResetError:
-			logging.warning(f"Connection reset by peer. Client IP: {str(self.address[0])}:{str(self.address[1])}")
+			logging.warning(f"Connection reset by peer. Client: {self.client}")
 		except ValueError as e:
 			logging.warning(e)
-		return data
-
-	def send(self, data):
-		"""
-		Send data to the client.
-		"""
-		logging.debug("Sending data...")
-		self.sock.send(data)
-		logging.debug("Data sent.")
+		return None, None, None, None, None, None
 
 	def close(self):
 		"""
 		Close the client connection.
 		"""
 		logging.info("Closing connection...")
+		metrics.client_disconnected(self.client)
 		self.sock.close()
 		logging.info("Connection closed.")
-	
+
+
+class SharedMemoryHandler(ClientHandler):
+	def __init__(self, sock: socket.socket, address):
+		"""
+		Handles a client that uses the shared memory transport.
+		The handler creates a ring buffer for the client. The client writes its input
+		in a free slot and rings the doorbell (a small message on the unix socket), the
+		prediction is written in the same slot and the handler rings back with the slot index.
+		Every slot can have a request in flight.
+		"""
+		super().__init__(sock, address)
+		self.ring = None
+		self.send_lock = threading.Lock()
+		# the ring can only be closed when no requests are in flight anymore
+		self.in_flight = 0
+		self.closed = False
+
+	def run(self):
+		logging.debug("SharedMemoryHandler started.")
+		metrics.client_connected(self.client)
+		try:
+			header = framing.recv_exact(self.sock, 2)
+			if not header:
+				return
+			slots = struct.unpack("!H", header)[0]
+			if not 1 <= slots <= config.SHM_MAX_SLOTS:
+				logging.warning(f"Invalid amount of shared memory slots {slots} (1 to {config.SHM_MAX_SLOTS}), closing socket")
+				return
+			self.ring = transport.SharedMemoryRing(slots)
+			name = self.ring.name.encode("ascii")
+			self.sock.sendall(struct.pack("!H", len(name)) + name)
+			while True:
+				doorbell = framing.recv_exact(self.sock, transport.REQUEST_DOORBELL.size)
+				if not doorbell:
+					break
+				slot, kind, priority, deadline, model_id = transport.REQUEST_DOORBELL.unpack(doorbell)
+				model_id = model_id.rstrip(b"\x00").decode("ascii")
+				if priority not in PRIORITY_NAMES or kind not in (framing.KIND_PREDICT, framing.KIND_VALUES):
+					logging.warning(f"Invalid priority {priority} or request kind {kind}, closing socket")
+					break
+				if slot >= self.ring.slots:
+					logging.warning(f"Invalid slot {slot} (the ring has {self.ring.slots} slots), closing socket")
+					break
+				metrics.record_request(self.client, len(doorbell) + framing.INPUT_SIZE)
+				with self.send_lock:
+					self.in_flight += 1
+				submit(model_id, self.ring.input(slot).data, lambda p, v, slot=slot: self.respond(slot, p, v), priority, deadline,
+					   values_only=kind == framing.KIND_VALUES)
+		except (ConnectionResetError, BrokenPipeError):
+			logging.warning(f"Connection reset by peer. Client: {self.client}")
+		finally:
+			self.close()
+			with self.send_lock:
+				self.closed = True
+				if self.ring is not None and self.in_flight == 0:
+					self.ring.close()
+
+	def respond(self, slot: int, p: np.ndarray, v):
+		"""
+		Write the prediction (or error) in the slot and ring the client's doorbell.
+		A value request only gets the value, in the last element of the output.
+		"""
+		status, error_length = 0, 0
+		if isinstance(v, Exception):
+			status, error_length = 1, self.ring.write_error(slot, str(v))
+		else:
+			output = self.ring.output(slot)
+			if p is not None:
+				output[:-1] = p
+			output[-1] = v
+		with self.send_lock:
+			self.in_flight -= 1
+			if self.closed:
+				if self.in_flight == 0:
+					self.ring.close()
+				return
+			try:
+				self.sock.sendall(transport.RESPONSE_DOORBELL.pack(slot, status, error_length))
+			except OSError as e:
+				logging.warning(f"Could not send response to {self.client}: {e}")
+				return
+		metrics.record_response(transport.RESPONSE_DOORBELL.size + framing.OUTPUT_SIZE)
+
 
 if __name__ == "__main__":
 	# create the server socket and start the server
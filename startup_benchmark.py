@@ -0,0 +1,95 @@
+# Startup benchmark for the headless self-play client.
+#   * the import profile of `import selfplay` (python -X importtime): the slowest imports,
+#     and the heavy modules that should not be loaded by a client using server predictions
+#   * the time to the first move: a new process that imports selfplay, connects to the
+#     prediction server and plays one move, compared against a budget
+# Exits with status 1 if a heavy module is imported or the budget is exceeded.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# modules that are only needed for local predictions, the GUI, plotting or puzzles
+HEAVY_MODULES = ("tensorflow", "keras", "pygame", "pygamepopup", "graphviz", "pandas", "PIL", "matplotlib")
+
+FIRST_MOVE_SCRIPT = """
+import json, time
+start_time = time.perf_counter()
+import selfplay
+imported = time.perf_counter()
+game = selfplay.setup(local_predictions=False)
+connected = time.perf_counter()
+game.play_move(stochastic=True, save_moves=False)
+done = time.perf_counter()
+print(json.dumps({"import": imported - start_time, "setup": connected - imported, "first_move": done - connected}))
+"""
+
+
+def import_profile(module: str = "selfplay") -> list:
+    """
+    Import the module in a new interpreter with -X importtime.
+    Returns (cumulative seconds, self seconds, module name) for every imported module.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    lines = result.stderr.splitlines()
+    if result.returncode != 0:
+        errors = [line for line in lines if not line.startswith("import time:")]
+        raise RuntimeError(f"Importing {module} failed:\n" + "\n".join(errors))
+    imports = []
+    for line in lines:
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative_us) / 1e6, int(self_us) / 1e6, name.rstrip()))
+    return imports
+
+
+def time_to_first_move(simulations: int) -> dict:
+    """
+    Start a headless self-play client and play one move with the given amount of simulations.
+    """
+    env = dict(os.environ, SIMULATIONS_PER_MOVE=str(simulations), SELFPLAY_SHOW_BOARD="false")
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", FIRST_MOVE_SCRIPT], capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    total = time.perf_counter() - start_time
+    if result.returncode != 0:
+        raise RuntimeError(f"The self-play client failed:\n{result.stderr}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings["total"] = total
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the startup time of the self-play client")
+    parser.add_argument("--budget", type=float, default=float(os.environ.get("STARTUP_BUDGET", 5.0)), help="Maximum time to the first move (seconds)")
+    parser.add_argument("--simulations", type=int, default=50, help="Simulations for the first move")
+    parser.add_argument("--top", type=int, default=15, help="Amount of slowest imports to show")
+    parser.add_argument("--imports-only", action="store_true", help="Only profile the imports (no server needed)")
+    args = parser.parse_args()
+    args = vars(args)
+
+    failed = False
+    imports = import_profile()
+    print(f"import selfplay: {max(imports)[0]:.3f}s, {len(imports)} modules")
+    for cumulative, own, name in sorted(imports, reverse=True)[:args["top"]]:
+        print(f"  {cumulative:8.3f}s {own:8.3f}s  {name}")
+    heavy = sorted({name.strip() for _, _, name in imports if name.strip().split(".")[0] in HEAVY_MODULES})
+    if heavy:
+        failed = True
+        print(f"Heavy modules imported: {', '.join(heavy)}")
+
+    if not args["imports_only"]:
+        timings = time_to_first_move(args["simulations"])
+        print(f"Time to first move ({args['simulations']} simulations): {timings['total']:.3f}s "
+              f"(import {timings['import']:.3f}s, setup {timings['setup']:.3f}s, first move {timings['first_move']:.3f}s), "
+              f"budget {args['budget']:.3f}s")
+        if timings["total"] > args["budget"]:
+            failed = True
+            print("Over budget")
+
+    sys.exit(1 if failed else 0)
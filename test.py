@@ -76,42 +76,64 @@ class Test:
         for action in sorted(agent.mcts.root.edges, key=lambda edge: (edge.W/(edge.N if edge.N != 0 else 1))+edge.upper_confidence_bound(), reverse=True):
             print(action)
 
-import tensorflow as tf
-
-@tf.function
-def predict(model, inputs):
-    return model(inputs)
-
-def test_predict_vs_predict_batch():
+def test_predict_vs_predict_batch(model_path: str = "models/model-2022-04-14_20:31:55.h5"):
     import time
+    import backends
 
     fen = "7r/bpkR4/p6n/P3N3/QPB1P3/2P4b/4KPq1/8 b - - 1 32"
 
-    from tensorflow.keras.models import load_model
-    from keras.models import Model
-    nn: Model = load_model("models/model-2022-04-14_20:31:55.h5")
+    backend = backends.create_backend(model_path=model_path)
     # warm up
     input_state = ChessEnv.state_to_input(fen)
-    _, _ = predict(nn, input_state)
+    _, _ = backend.predict(input_state)
     
     start_time = time.time()
     for _ in range(10):
-        p, v = predict(nn, input_state)
+        p, v = backend.predict(input_state)
     print(f"Time taken for 10 single predictions: {time.time() - start_time}")
 
     
-    input_tensor = np.array([])
-    for i in range(10):
-        input_tensor = np.append(input_tensor, input_state, axis=0)
-    # array to tensor
-    # input_tensor = np.array(input_tensor).reshape(10, 8, 8, 19)
+    input_tensor = np.repeat(input_state, 10, axis=0)
     print(input_tensor.shape)
     start_time = time.time()
-    p, v = predict(nn, input_tensor)
+    p, v = backend.predict_batch(input_tensor)
     print(f"Time taken for batch prediction: {time.time() - start_time}")
 
     
 
+def test_mock_backend():
+    import backends
+
+    backend = backends.create_backend("mock")
+    boards = [chess.Board()]
+    for move in ["e2e4", "e7e5", "g1f3"]:
+        boards.append(boards[-1].copy())
+        boards[-1].push_uci(move)
+    inputs = np.concatenate([ChessEnv.state_to_input(board.fen()) for board in boards])
+
+    policies, values = backend.predict_batch(inputs)
+    assert policies.shape == (len(boards), 4672) and values.shape == (len(boards),)
+    assert np.all(np.abs(values) <= 1)
+    # deterministic: the prediction of a position doesn't depend on its batch
+    for i in range(len(boards)):
+        p, v = backend.predict_async(inputs[i]).result()
+        assert np.array_equal(p, policies[i]) and v == values[i]
+    assert np.array_equal(backend.predict_values(inputs), values)
+    assert np.array_equal(backends.create_backend("mock").predict_batch(inputs[::-1])[0], policies[::-1])
+
+    # concurrent single predictions are batched, with the same results
+    batching = backends.BatchingBackend(backend, max_batch_size=len(boards))
+    futures = [batching.predict_async(inputs[i]) for i in range(len(boards))]
+    assert all(np.array_equal(future.result()[0], policies[i]) for i, future in enumerate(futures))
+    batching.close()
+
+    try:
+        backend.save("model.h5")
+        assert False, "the mock backend has no model to save"
+    except NotImplementedError:
+        pass
+
+
 if __name__ == "__main__":
     # test = Test()
     # test.run_state_to_input_test()
@@ -125,4 +147,5 @@ if __name__ == "__main__":
 
     # test.test_position_outputs("1k6/1pp5/p3B2p/3Pq3/2P1p3/PP3r2/4Q3/5RK1 b - - 0 36", 400)
     test_predict_vs_predict_batch()
+    # test_mock_backend()
 
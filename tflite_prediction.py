@@ -0,0 +1,46 @@
+# Predictions with a TFLite model (see export_model.py), for CPU-only hosts.
+# The small tflite_runtime package is used if it is installed, so the full
+# tensorflow package doesn't have to be imported.
+from typing import Tuple
+
+import numpy as np
+
+import config
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+
+
+class TFLitePredictor:
+    def __init__(self, model_path: str, num_threads: int = config.TFLITE_THREADS):
+        """
+        Runs a TFLite model (float32 or quantized) with the same inputs and outputs as the Keras model.
+        """
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        # the policy has 4672 outputs per position, the value has 1
+        outputs = self.interpreter.get_output_details()
+        self.policy_output = next(o for o in outputs if o["shape"][-1] == config.OUTPUT_SHAPE[0])
+        self.value_output = next(o for o in outputs if o["shape"][-1] == config.OUTPUT_SHAPE[1])
+        self.batch_size = self.input["shape"][0]
+
+    def resize(self, batch_size: int):
+        self.interpreter.resize_tensor_input(self.input["index"], [batch_size, *config.INPUT_SHAPE])
+        self.interpreter.allocate_tensors()
+        self.batch_size = batch_size
+
+    def predict(self, inputs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Predict a batch of inputs, shape (N, 8, 8, 19). Returns the policies (N, 4672) and values (N, 1).
+        """
+        if inputs.shape[0] != self.batch_size:
+            self.resize(inputs.shape[0])
+        self.interpreter.set_tensor(self.input["index"], inputs.astype(self.input["dtype"]))
+        self.interpreter.invoke()
+        # copy the outputs: the interpreter reuses its buffers
+        return (self.interpreter.get_tensor(self.policy_output["index"]).copy(),
+                self.interpreter.get_tensor(self.value_output["index"]).copy())
@@ -1,23 +1,24 @@
 import argparse
 import os
 import time
-from typing import Tuple
+from typing import TYPE_CHECKING, Iterator, Tuple
 import chess
 import numpy as np
 from chessEnv import ChessEnv
 import config
-import tensorflow as tf
-from keras.models import Model
-from keras.models import load_model, save_model
-from matplotlib import pyplot as plt
-import pandas as pd
+import replay
+from replay_buffer import INDEX_FILE, ReplayBuffer
 import uuid
 import utils
 from tqdm import tqdm
 from datetime import datetime
+# keras, matplotlib and pandas are imported when they are used:
+# the workers of the training pipeline import this module again (spawn), and only need NumPy
+if TYPE_CHECKING:
+    from keras.models import Model
 
 class Trainer:
-    def __init__(self, model: Model):
+    def __init__(self, model: "Model"):
         self.model = model
         self.batch_size = config.BATCH_SIZE
 
@@ -28,64 +29,119 @@ class Trainer:
             np.random.shuffle(data)
             return data[:self.batch_size]
 
-    def split_Xy(self, data) -> Tuple[np.ndarray, np.ndarray]:
+    def split_Xy(self, data) -> Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
         # board to input format (19x8x8)
         X = np.array([ChessEnv.state_to_input(i[0])[0] for i in data])
         # moves to output format (73x8x8)
         y_probs = []
         # values = winner
         y_value = []
+        # 1 if the policy is a training target (a full search, see PLAYOUT_CAP_RANDOMIZATION), else 0
+        policy_weights = []
         for position in data:
             # for every position in the batch, get the output probablity vector and value of the state
             board = chess.Board(position[0])
             moves = utils.moves_to_output_vector(position[1], board)
             y_probs.append(moves)
             y_value.append(position[2])
-        return X, (np.array(y_probs).reshape(len(y_probs), 4672), np.array(y_value))
+            policy_weights.append(1.0 if len(position) < 4 or position[3] else 0.0)
+        return X, (np.array(y_probs).reshape(len(y_probs), 4672), np.array(y_value, dtype=np.float32), np.array(policy_weights))
 
-    def train_batch(self, X, y_probs, y_value):
+    def train_batch(self, X, y_probs, y_value, policy_weights=None):
+        """
+        Positions with a policy weight of 0 (fast searches) only train the value head.
+        """
+        sample_weight = None
+        if policy_weights is not None:
+            # in the order of the model's outputs
+            sample_weight = [policy_weights, np.ones(len(y_value))]
         return self.model.train_on_batch(x=X, y={
                 "policy_head": y_probs,
                 "value_head": y_value
-            }, return_dict=True)
+            }, sample_weight=sample_weight, return_dict=True)
+
+    def load_data(self, folder: str) -> Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Load the positions of the replay buffer (only its window), the other replay files (.rpl)
+        and the pickled games (.npy) in the folder.
+        Returns the inputs, and the policies, values and policy weights (like split_Xy).
+        """
+        parts, games, buffer = [], [], False
+        def decode(block: replay.Block):
+            # no FENs or moves to parse: the positions and sparse policies are decoded with NumPy
+            positions = block.positions
+            parts.append((replay.decode_inputs(positions),
+                          (replay.decode_policies(positions, block.policy, replay.policy_offsets(positions)[:-1]),
+                           replay.decode_values(positions), positions["full_search"].astype(np.float32))))
+        if os.path.exists(os.path.join(folder, INDEX_FILE)):
+            buffer = True
+            decode(ReplayBuffer(folder).load())
+        for file in sorted(os.listdir(folder)):
+            if file.endswith(".rpl") and not (buffer and file.startswith("shard-")):
+                decode(replay.read_replay(os.path.join(folder, file)))
+            elif file.endswith(".npy"):
+                game = np.load(os.path.join(folder, file), allow_pickle=True)
+                if game.ndim == 2 and game.shape[1] == 3:
+                    # games saved before the full search flag: every policy is a full search
+                    game = np.concatenate([game, np.full((len(game), 1), True, dtype=object)], axis=1)
+                games.append(game)
+        if games:
+            print("Splitting data into labels and target...")
+            parts.append(self.split_Xy(np.concatenate(games)))
+        if not parts:
+            raise ValueError(f"No games found in {folder}")
+        X = np.concatenate([part[0] for part in parts])
+        return X, tuple(np.concatenate([part[1][i] for part in parts]) for i in range(3))
 
-    def train_all_data(self, data):
+    def train_all_data(self, X, y):
         """
         Train the model on all given data.
         """
         history = []
-        np.random.shuffle(data)
-        print("Splitting data into labels and target...")
-        X, y = self.split_Xy(data)
+        order = np.random.permutation(len(X))
+        X, y = X[order], tuple(part[order] for part in y)
         print("Training batches...")
         for part in tqdm(range(len(X)//self.batch_size)):
             start = part * self.batch_size
             end = start + self.batch_size
-            losses = self.train_batch(X[start:end], y[0][start:end], y[1][start:end])
+            losses = self.train_batch(X[start:end], y[0][start:end], y[1][start:end], y[2][start:end])
             history.append(losses)
         return history
 
-    def train_random_batches(self, data):
+    def train_random_batches(self, X, y):
         """
         Train the model on batches of data
 
-        X = the state of the board (a fen string)
-        y = the search probs by MCTS (array of dicts), and the winner (-1, 0, 1)
+        X = the model inputs of the positions
+        y = the search probs by MCTS, the winner (-1, 0, 1) and the policy weights (see load_data)
         """
         history = []
-        X, (y_probs, y_value) = self.split_Xy(data)
-        for _ in tqdm(range(2*max(5, len(data) // self.batch_size))):
-            indexes = np.random.choice(len(data), size=self.batch_size, replace=True)
+        y_probs, y_value, policy_weights = y
+        for _ in tqdm(range(2*max(5, len(X) // self.batch_size))):
+            indexes = np.random.choice(len(X), size=self.batch_size, replace=True)
             # only select X values with these indexes
             X_batch = X[indexes]
             y_probs_batch = y_probs[indexes]
             y_value_batch = y_value[indexes]
             
-            losses = self.train_batch(X_batch, y_probs_batch, y_value_batch)
+            losses = self.train_batch(X_batch, y_probs_batch, y_value_batch, policy_weights[indexes])
+            history.append(losses)
+        return history
+
+    def train_batches(self, batches: Iterator, steps: int = None):
+        """
+        Train the model on batches of (X, (y_probs, y_value, policy_weights)),
+        e.g. of a TrainingPipeline (see training_pipeline.py).
+        """
+        history = []
+        for X, (y_probs, y_value, policy_weights) in tqdm(batches, total=steps):
+            losses = self.train_batch(X, y_probs, y_value, policy_weights)
             history.append(losses)
         return history
 
     def plot_loss(self, history):
+        from matplotlib import pyplot as plt
+        import pandas as pd
         df = pd.DataFrame(history)
         df[['loss', 'policy_head_loss', 'value_head_loss']] = df[['loss', 'policy_head_loss', 'value_head_loss']].apply(pd.to_numeric, errors='coerce')
         total_loss = df[['loss']].values
@@ -99,6 +155,7 @@ class Trainer:
         plt.savefig(f"{config.LOSS_PLOTS_FOLDER}/loss-{datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.png")
 
     def save_model(self):
+        from keras.models import save_model
         os.makedirs(config.MODEL_FOLDER, exist_ok=True)
         path = f"{config.MODEL_FOLDER}/model-{datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.h5"
         save_model(self.model, path)
@@ -109,30 +166,42 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Train the model')
     parser.add_argument('--model', type=str, help='The model to train')
     parser.add_argument('--data-folder', type=str, help='The data folder to train on')
+    parser.add_argument('--steps', type=int, help='The amount of batches to train on (default: twice the positions in batches)')
+    parser.add_argument('--workers', type=int, default=config.TRAINING_WORKERS, help='The processes that decode batches (0: none)')
+    parser.add_argument('--in-memory', action='store_true', help='Load all positions (also of .npy games) in memory instead of streaming batches')
     args = parser.parse_args()
     args = vars(args)
 
+    from keras.models import load_model
+    from training_pipeline import TrainingPipeline
+
     # use the last model
     model = load_model(args["model"])
     trainer = Trainer(model=model)
 
     folder = args['data_folder']
-    files = os.listdir(folder + "/")
-    data = []
-    print(f"Loading all games in {folder}...")
-    for file in files:
-        if file.endswith('.npy'):
-            data.append(np.load(f"{folder}/{file}", allow_pickle=True))
-    data = np.concatenate(data)
-    # count where third field is 0
-    print(f"{len(data[data[:,2] > 0])} positions won by white")
-    print(f"{len(data[data[:,2] < 0])} positions won by black")
-    print(f"{len(data[data[:,2] == 0])} positions drawn")
-    # delete drawn games
-    # data = data[data[:,2] != 0]
-    print(f"Training with {len(data)} positions")
-    history = trainer.train_random_batches(data)
-    # history = trainer.train_all_data(data)
+    if args["in_memory"]:
+        print(f"Loading all games in {folder}...")
+        X, y = trainer.load_data(folder)
+        y_value = y[1]
+        print(f"{np.sum(y_value > 0)} positions won by white")
+        print(f"{np.sum(y_value < 0)} positions won by black")
+        print(f"{np.sum(y_value == 0)} positions drawn")
+        print(f"{int(np.sum(y[2]))} positions with a full search policy")
+        print(f"Training with {len(X)} positions")
+        history = trainer.train_random_batches(X, y)
+        # history = trainer.train_all_data(X, y)
+    else:
+        # batches are sampled from the replay files and decoded while the model trains: the memory use doesn't grow with the data
+        if any(file.endswith(".npy") for file in os.listdir(folder)):
+            print(f"Skipping the .npy games in {folder}: add them to the replay buffer (python replay_buffer.py import) or use --in-memory")
+        pipeline = TrainingPipeline(folder, trainer.batch_size, workers=args["workers"])
+        try:
+            steps = args["steps"] or 2*max(5, len(pipeline) // trainer.batch_size)
+            print(f"Training {steps} batches of the {len(pipeline)} positions in {folder}")
+            history = trainer.train_batches(pipeline.batches(steps), steps)
+        finally:
+            pipeline.close()
     # plot history
     trainer.plot_loss(history)
     # save the new model
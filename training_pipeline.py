@@ -0,0 +1,158 @@
+# Streaming training input (see train.py): batches of positions are sampled uniformly from the replay store
+# (the window of the replay buffer and the other replay files in the folder), decoded to dense tensors
+# by worker processes, and prefetched while the model trains on the previous batches.
+# Only an index of the games (three numbers per game) and the batches in flight are kept in memory,
+# no matter how many positions the replay store has.
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict, deque
+from typing import Iterator, Tuple
+
+import numpy as np
+
+import config
+import replay
+from replay_buffer import INDEX_FILE, ReplayBuffer
+
+# the inputs, and the policies, values and policy weights (like Trainer.split_Xy)
+Batch = Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+# the memory-mapped replay files of a worker process, by path (least recently used first)
+_replays: OrderedDict = OrderedDict()
+MAX_OPEN_REPLAYS = 64
+
+
+def game_index(folder: str) -> Tuple[list[str], np.ndarray]:
+    """
+    The games of the replay store in the folder: the replay files, and for every game the file
+    (its index in the list), the offset of its block and its amount of positions.
+    """
+    paths, games = [], []
+    buffer = os.path.exists(os.path.join(folder, INDEX_FILE))
+    if buffer:
+        store = ReplayBuffer(folder)
+        for shard in store.shards():
+            try:
+                shard_games = store.games(shard)
+            except FileNotFoundError:
+                # evicted
+                continue
+            paths.append(os.path.join(folder, shard["name"]))
+            games.extend((len(paths) - 1, int(offset), int(count)) for offset, count in shard_games)
+    for file in sorted(os.listdir(folder)):
+        if not file.endswith(".rpl") or (buffer and file.startswith("shard-")):
+            continue
+        paths.append(os.path.join(folder, file))
+        games.extend((len(paths) - 1, offset, len(block.positions))
+                     for offset, block in replay.read_blocks(paths[-1], offsets=True))
+    return paths, np.array(games, dtype=np.int64).reshape(-1, 3)
+
+
+def read_block(path: str, offset: int) -> replay.Block:
+    """
+    A block of a replay file, or None if the file was evicted or the block is damaged.
+    The files stay mapped: a file that grew since it was mapped is mapped again.
+    """
+    for attempt in range(2):
+        buffer = _replays.pop(path, None)
+        try:
+            if buffer is None or attempt:
+                buffer = replay.open_replay(path)
+            block = replay.block_at(buffer, offset)[0] if buffer is not None else None
+        except (OSError, ValueError) as e:
+            if attempt:
+                logging.debug(f"Could not read the block at byte {offset} of {path}: {e}")
+            continue
+        _replays[path] = buffer
+        if len(_replays) > MAX_OPEN_REPLAYS:
+            _replays.popitem(last=False)
+        return block
+    return None
+
+
+def decode_batch(paths: list[str], samples: np.ndarray) -> Batch:
+    """
+    Decode the sampled positions: (file index, block offset, position in the game) rows.
+    Positions of evicted files are skipped, so the batch can be smaller.
+    """
+    blocks = {}
+    positions, policies = [], []
+    for path_index, offset, i in samples:
+        key = (path_index, offset)
+        if key not in blocks:
+            block = read_block(paths[path_index], offset)
+            blocks[key] = (block, replay.policy_offsets(block.positions)) if block is not None else None
+        if blocks[key] is None:
+            continue
+        block, offsets = blocks[key]
+        positions.append(block.positions[i])
+        policies.append(block.policy[offsets[i]:offsets[i + 1]])
+    positions = np.array(positions, dtype=replay.POSITION_DTYPE)
+    policy = np.concatenate(policies) if policies else np.empty(0, dtype=replay.POLICY_DTYPE)
+    return replay.decode_inputs(positions), (replay.decode_policies(positions, policy, replay.policy_offsets(positions)[:-1]),
+                                             replay.decode_values(positions), positions["full_search"].astype(np.float32))
+
+
+class TrainingPipeline:
+    def __init__(self, folder: str, batch_size: int = config.BATCH_SIZE, workers: int = config.TRAINING_WORKERS,
+                 prefetch: int = config.TRAINING_PREFETCH, refresh: int = config.TRAINING_INDEX_REFRESH, seed: int = None):
+        """
+        Sample batches from the replay store in the folder. The games are indexed again every refresh batches,
+        so games that self-play adds while training are used too. Without workers, the batches are decoded
+        in this process, when they are needed.
+        """
+        self.folder = folder
+        self.batch_size = batch_size
+        self.prefetch = max(prefetch, 1)
+        self.refresh = refresh
+        self.rng = np.random.default_rng(seed)
+        # spawn: the workers don't inherit the trainer's (tensorflow) threads
+        self.pool = multiprocessing.get_context("spawn").Pool(workers) if workers else None
+        self.refresh_index()
+
+    def refresh_index(self):
+        self.paths, self.games = game_index(self.folder)
+        # the first position of every game, in the order of the index
+        self.cumulative = np.concatenate([[0], np.cumsum(self.games[:, 2])])
+        if not len(self):
+            raise ValueError(f"No replay games found in {self.folder}")
+        logging.info(f"Training pipeline: {len(self)} positions in {len(self.games)} games ({len(self.paths)} files)")
+
+    def __len__(self) -> int:
+        return int(self.cumulative[-1])
+
+    def sample(self) -> np.ndarray:
+        """
+        batch_size random positions (uniformly, with replacement), as rows for decode_batch.
+        """
+        ids = self.rng.integers(len(self), size=self.batch_size)
+        games = np.searchsorted(self.cumulative, ids, side="right") - 1
+        return np.stack([self.games[games, 0], self.games[games, 1], ids - self.cumulative[games]], axis=1)
+
+    def batches(self, steps: int) -> Iterator[Batch]:
+        """
+        Yield steps batches. prefetch batches are decoded ahead by the workers.
+        """
+        pending, submitted = deque(), 0
+        def submit():
+            nonlocal submitted
+            if submitted and self.refresh and submitted % self.refresh == 0:
+                self.refresh_index()
+            args = (self.paths, self.sample())
+            pending.append(self.pool.apply_async(decode_batch, args) if self.pool is not None else args)
+            submitted += 1
+        while submitted < min(steps, self.prefetch):
+            submit()
+        for _ in range(steps):
+            item = pending.popleft()
+            batch = item.get() if self.pool is not None else decode_batch(*item)
+            if submitted < steps:
+                submit()
+            if len(batch[0]):
+                yield batch
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
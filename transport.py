@@ -0,0 +1,593 @@
+# Transports between the agents and the prediction server.
+#   tcp:  a TCP connection to SOCKET_HOST:SOCKET_PORT
+#   unix: a unix domain socket at SOCKET_PATH (client and server on the same host)
+#   shm:  a shared memory ring buffer, with a unix domain socket at SOCKET_PATH.shm
+#         that only carries small "doorbell" messages. Inputs and outputs are written
+#         straight into shared memory, so they are never copied through the kernel.
+import bisect
+import hashlib
+import itertools
+import logging
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue
+from typing import Tuple
+
+import numpy as np
+
+import config
+from framing import (DEFAULT_PRIORITY, INPUT_SIZE, KIND_PREDICT, KIND_VALUES, MAX_VALUE_POSITIONS, OUTPUT_SIZE,
+                     FrameReader, RESPONSE_HEADER, read_response, recv_exact, send_request)
+
+# every slot starts on a cache line
+SLOT_SIZE = (INPUT_SIZE + OUTPUT_SIZE + 63) // 64 * 64
+
+# client -> server: slot index, kind, priority, deadline (see framing.py), model id
+REQUEST_DOORBELL = struct.Struct(f"!HBBI{config.MODEL_ID_LENGTH}s")
+# server -> client: slot index, status (0 = ok), length of the error message in the slot's output
+RESPONSE_DOORBELL = struct.Struct("!HBI")
+
+
+def server_address(transport: str = config.SOCKET_TRANSPORT, address: Tuple[str, int] = None):
+    """
+    Get the socket family and the address of the server for the given transport.
+    For tcp, a specific server can be given, otherwise the first of SOCKET_HOSTS is used.
+    For unix, a specific socket path can be given, otherwise SOCKET_PATH is used.
+    """
+    if transport == "tcp":
+        return socket.AF_INET, address or config.SOCKET_HOSTS[0]
+    if transport == "unix":
+        return socket.AF_UNIX, address or config.SOCKET_PATH
+    if transport == "shm":
+        return socket.AF_UNIX, config.SOCKET_PATH + ".shm"
+    raise ValueError(f"Unknown transport: {transport}")
+
+
+def connect(transport: str = config.SOCKET_TRANSPORT, address: Tuple[str, int] = None) -> socket.socket:
+    """
+    Connect to the server with the given transport.
+    """
+    family, address = server_address(transport, address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect(address)
+    return sock
+
+
+def is_server_up(transport: str = config.SOCKET_TRANSPORT, address: Tuple[str, int] = None) -> bool:
+    """
+    Check if the server accepts connections.
+    """
+    family, address = server_address(transport, address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        return sock.connect_ex(address) == 0
+    except (FileNotFoundError, socket.gaierror):
+        # the unix socket doesn't exist yet, or the host can't be resolved (yet)
+        return False
+    finally:
+        sock.close()
+
+
+def wait_for_server(transport: str = config.SOCKET_TRANSPORT):
+    """
+    Block until a server accepts connections. With multiple tcp servers, one is enough.
+    """
+    addresses = config.SOCKET_HOSTS if transport == "tcp" else [None]
+    print("Checking if server is ready...")
+    while True:
+        for address in addresses:
+            if is_server_up(transport, address):
+                print(f"Server is ready on {server_address(transport, address)[1]}!")
+                return
+        print(f"Waiting for server at {', '.join(str(server_address(transport, address)[1]) for address in addresses)}")
+        time.sleep(1)
+
+
+def gather_values(futures: list[Future]) -> Future:
+    """
+    A future for the concatenated values of the given futures (value requests of parts of a bulk).
+    """
+    future = Future()
+    if not futures:
+        future.set_result(np.empty(0, dtype=np.float32))
+    def collect(_):
+        if future.done() or not all(f.done() for f in futures):
+            return
+        try:
+            future.set_result(np.concatenate([np.atleast_1d(f.result()) for f in futures]).astype(np.float32))
+        except Exception as e:
+            future.set_exception(e)
+    for f in futures:
+        f.add_done_callback(collect)
+    return future
+
+
+class SharedMemoryRing:
+    def __init__(self, slots: int, name: str = None):
+        """
+        A ring of slots in shared memory. Every slot holds one input and its output.
+        The server creates the ring (name is None) and the client attaches to it by name.
+        """
+        self.slots = slots
+        self.owner = name is None
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=slots * SLOT_SIZE)
+        else:
+            self.shm = SharedMemory(name=name)
+            # the server owns the memory: don't let this process' resource tracker unlink it on exit
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.name = self.shm.name
+        self.buffer = np.ndarray((slots, SLOT_SIZE), dtype=np.uint8, buffer=self.shm.buf)
+
+    def input(self, slot: int) -> np.ndarray:
+        return self.buffer[slot, :INPUT_SIZE].view(bool).reshape(1, *config.INPUT_SHAPE)
+
+    def output(self, slot: int) -> np.ndarray:
+        return self.buffer[slot, INPUT_SIZE:INPUT_SIZE + OUTPUT_SIZE].view(np.float32)
+
+    def write_error(self, slot: int, message: str) -> int:
+        message = message.encode("utf-8")[:OUTPUT_SIZE]
+        self.buffer[slot, INPUT_SIZE:INPUT_SIZE + len(message)] = np.frombuffer(message, dtype=np.uint8)
+        return len(message)
+
+    def read_error(self, slot: int, length: int) -> str:
+        return self.buffer[slot, INPUT_SIZE:INPUT_SIZE + length].tobytes().decode("utf-8")
+
+    def close(self):
+        # drop the numpy view first, the memory can't be closed while it is exported
+        del self.buffer
+        try:
+            self.shm.close()
+        except BufferError:
+            # a finished request still holds a view, the mapping is closed when it is collected
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+class PipelinedClient:
+    def __init__(self):
+        """
+        Base class of the clients. A client can have many requests in flight:
+        predict_async() returns a future, and a receiver thread resolves the futures
+        as the responses come in (in any order).
+        """
+        self.pending: dict[int, Future] = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        # set by the receiver thread when the connection is gone, no new requests are accepted after that
+        self.disconnected = False
+        self.receiver = threading.Thread(target=self.receive_loop, daemon=True)
+
+    @property
+    def outstanding(self) -> int:
+        """
+        Amount of requests in flight.
+        """
+        return len(self.pending)
+
+    @property
+    def connected(self) -> bool:
+        """
+        The connection is alive as long as the receiver thread runs.
+        """
+        return not self.closed and not self.disconnected
+
+    def predict(self, data: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Tuple[np.ndarray, float]:
+        return self.predict_async(data, model_id, priority, deadline).result()
+
+    def predict_async(self, data: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        raise NotImplementedError
+
+    def predict_values_async(self, inputs: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        """
+        Only the values of a batch of inputs (N, 8, 8, 19): the server skips the policy head
+        and sends one float per position. Returns a future for the values (N,).
+        """
+        raise NotImplementedError
+
+    def receive_loop(self):
+        try:
+            self.receive_responses()
+        except OSError as e:
+            if not self.closed:
+                logging.warning(f"Connection to the server lost: {e}")
+        # the connection is closed: fail everything that is still in flight
+        with self.lock:
+            self.disconnected = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("Connection to the server closed"))
+
+    def receive_responses(self):
+        raise NotImplementedError
+
+    def add_pending(self, request_id: int, future: Future):
+        with self.lock:
+            if self.disconnected:
+                raise ConnectionError("Connection to the server closed")
+            self.pending[request_id] = future
+
+    def resolve(self, request_id: int, result=None, error: Exception = None):
+        with self.lock:
+            future = self.pending.pop(request_id, None)
+        if future is None:
+            logging.warning(f"Received a response for unknown request {request_id}")
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def close(self):
+        raise NotImplementedError
+
+
+class SocketClient(PipelinedClient):
+    def __init__(self, transport: str = config.SOCKET_TRANSPORT, address: Tuple[str, int] = None):
+        """
+        Client for the tcp and unix transports.
+        Every request is sent with a request id, the server sends its response with the same id.
+        """
+        super().__init__()
+        self.sock = connect(transport, address)
+        self.send_lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.receiver.start()
+
+    def predict_async(self, data: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        return self.send(data, model_id, priority, deadline, KIND_PREDICT)
+
+    def predict_values_async(self, inputs: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        inputs = np.ascontiguousarray(inputs, dtype=bool).reshape(-1, *config.INPUT_SHAPE)
+        # large bulks are sent as multiple requests, the server predicts them in parallel batches
+        return gather_values([self.send(inputs[start:start + MAX_VALUE_POSITIONS], model_id, priority, deadline, KIND_VALUES)
+                              for start in range(0, len(inputs), MAX_VALUE_POSITIONS)])
+
+    def send(self, data: np.ndarray, model_id: str, priority: int, deadline: int, kind: int) -> Future:
+        future = Future()
+        request_id = next(self.request_ids) % 2**32
+        self.add_pending(request_id, future)
+        try:
+            with self.send_lock:
+                send_request(self.sock, request_id, model_id, data, priority, deadline, kind)
+        except OSError as e:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise ConnectionError(f"Could not send request to the server: {e}")
+        return future
+
+    def receive_responses(self):
+        reader = FrameReader(self.sock, RESPONSE_HEADER)
+        while True:
+            response = read_response(reader)
+            if response is None:
+                break
+            request_id, result = response
+            if isinstance(result, str):
+                self.resolve(request_id, error=RuntimeError(f"Server could not predict: {result}"))
+            else:
+                self.resolve(request_id, result)
+
+    def close(self):
+        self.closed = True
+        try:
+            # shutdown wakes up the receiver thread
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # the connection is already gone
+            pass
+        self.sock.close()
+
+
+class SharedMemoryClient(PipelinedClient):
+    def __init__(self, slots: int = config.SHM_SLOTS):
+        """
+        Client side of the shared memory transport.
+        After connecting, the server creates a ring buffer and sends its name.
+        Every slot can hold a request in flight, the slot index is the request id.
+        """
+        super().__init__()
+        self.sock = connect("shm")
+        self.sock.send(struct.pack("!H", slots))
+        header = recv_exact(self.sock, 2)
+        if not header:
+            # e.g. more slots than the server allows (SHM_MAX_SLOTS)
+            self.sock.close()
+            raise ConnectionError(f"The server refused a shared memory ring of {slots} slots")
+        name_length = struct.unpack("!H", header)[0]
+        self.ring = SharedMemoryRing(slots, recv_exact(self.sock, name_length).decode("ascii"))
+        self.free_slots: Queue = Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        # the kind of the request in every slot: a value request only reads the value from the output
+        self.kinds = [KIND_PREDICT] * slots
+        self.send_lock = threading.Lock()
+        self.receiver.start()
+        logging.info(f"Attached to shared memory {self.ring.name} ({slots} slots)")
+
+    def predict_async(self, data: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        return self.send(data, model_id, priority, deadline, KIND_PREDICT)
+
+    def predict_values_async(self, inputs: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        # a slot holds one input: every position is a separate request
+        inputs = np.asarray(inputs, dtype=bool).reshape(-1, *config.INPUT_SHAPE)
+        return gather_values([self.send(position, model_id, priority, deadline, KIND_VALUES) for position in inputs])
+
+    def send(self, data: np.ndarray, model_id: str, priority: int, deadline: int, kind: int) -> Future:
+        future = Future()
+        # blocks if all slots are in flight
+        slot = self.free_slots.get()
+        self.ring.input(slot)[:] = data
+        self.kinds[slot] = kind
+        try:
+            self.add_pending(slot, future)
+        except ConnectionError:
+            self.free_slots.put(slot)
+            raise
+        try:
+            with self.send_lock:
+                self.sock.sendall(REQUEST_DOORBELL.pack(slot, kind, priority, deadline, model_id.encode("ascii")))
+        except OSError as e:
+            # the server never saw the request: free its slot (unless the receiver already failed it)
+            with self.lock:
+                pending = self.pending.pop(slot, None)
+            self.free_slots.put(slot)
+            if pending is not None:
+                future.set_exception(ConnectionError(f"Could not send request to the server: {e}"))
+        return future
+
+    def receive_responses(self):
+        while True:
+            response = recv_exact(self.sock, RESPONSE_DOORBELL.size)
+            if not response:
+                break
+            slot, status, error_length = RESPONSE_DOORBELL.unpack(response)
+            if status != 0:
+                self.resolve(slot, error=RuntimeError(f"Server could not predict: {self.ring.read_error(slot, error_length)}"))
+            elif self.kinds[slot] == KIND_VALUES:
+                self.resolve(slot, float(self.ring.output(slot)[-1]))
+            else:
+                output = self.ring.output(slot)
+                self.resolve(slot, (output[:-1].copy(), float(output[-1])))
+            self.free_slots.put(slot)
+
+    def close(self):
+        self.closed = True
+        try:
+            # shutdown wakes up the receiver thread
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # the connection is already gone
+            pass
+        self.sock.close()
+        self.receiver.join()
+        self.ring.close()
+
+
+class ClientPool:
+    def __init__(self, clients: list[PipelinedClient], create=None, retry_interval: float = 1.0):
+        """
+        A small pool of connections to the same server.
+        Every request goes to the live connection with the fewest requests in flight.
+        Connections that are gone are replaced with create() (at most every retry_interval seconds).
+        """
+        self.clients = clients
+        self.create = create
+        self.retry_interval = retry_interval
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def outstanding(self) -> int:
+        return sum(client.outstanding for client in self.clients)
+
+    @property
+    def connected(self) -> bool:
+        # one live connection is enough: the server is still reachable
+        return any(client.connected for client in self.clients)
+
+    def live_clients(self) -> list[PipelinedClient]:
+        with self.lock:
+            if self.create is not None and time.monotonic() >= self.retry_at:
+                for i, client in enumerate(self.clients):
+                    if client.connected:
+                        continue
+                    try:
+                        self.clients[i] = self.create()
+                    except OSError as e:
+                        logging.debug(f"Could not reconnect a pooled connection: {e}")
+                        self.retry_at = time.monotonic() + self.retry_interval
+                        break
+                    client.close()
+            live = [client for client in self.clients if client.connected]
+        if not live:
+            raise ConnectionError("Connection to the server closed")
+        return live
+
+    def predict(self, data: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Tuple[np.ndarray, float]:
+        return self.predict_async(data, model_id, priority, deadline).result()
+
+    def predict_async(self, data: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        client = min(self.live_clients(), key=lambda client: client.outstanding)
+        return client.predict_async(data, model_id, priority, deadline)
+
+    def predict_values_async(self, inputs: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        client = min(self.live_clients(), key=lambda client: client.outstanding)
+        return client.predict_values_async(inputs, model_id, priority, deadline)
+
+    def close(self):
+        # no reconnecting after this
+        self.create = None
+        for client in self.clients:
+            client.close()
+
+
+class ShardedClient:
+    def __init__(self, addresses: list[Tuple[str, int]], connections: int = config.SERVER_CONNECTIONS,
+                 sharding: str = config.SHARDING, health_check_interval: float = config.HEALTH_CHECK_INTERVAL):
+        """
+        Distributes requests over multiple prediction servers (tcp).
+
+        * least-loaded: every request goes to the server with the fewest requests in flight.
+        * hash: requests are assigned with consistent hashing on the position, so the same
+                position always goes to the same server (and hits that server's cache).
+                If a server goes down, only its positions move to other servers.
+
+        A failed request is retried on another server. A health check thread
+        reconnects to servers that are down.
+        """
+        self.addresses = addresses
+        self.connections = connections
+        self.sharding = sharding
+        # address => client, None if the server is down
+        self.clients: dict[Tuple[str, int], object] = {address: None for address in addresses}
+        self.lock = threading.Lock()
+        # consistent hashing ring: sorted (hash, address) pairs, with virtual nodes for every server
+        self.ring = sorted(
+            (self.hash(f"{host}:{port}#{i}".encode()), (host, port))
+            for host, port in addresses for i in range(64)
+        )
+        for address in addresses:
+            self.reconnect(address)
+        if not self.live_addresses():
+            raise ConnectionError(f"Could not connect to any of the servers: {addresses}")
+        self.health_check_interval = health_check_interval
+        self.closed = False
+        threading.Thread(target=self.health_check_loop, daemon=True).start()
+
+    @staticmethod
+    def hash(data: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+    def reconnect(self, address: Tuple[str, int]) -> bool:
+        try:
+            client = create_client("tcp", self.connections, address)
+        except OSError as e:
+            logging.debug(f"Server {address} is down: {e}")
+            return False
+        with self.lock:
+            self.clients[address] = client
+        logging.info(f"Connected to server {address[0]}:{address[1]}")
+        return True
+
+    def mark_down(self, address: Tuple[str, int], client):
+        with self.lock:
+            if self.clients.get(address) is not client:
+                # already marked down (or reconnected)
+                return
+            self.clients[address] = None
+        logging.warning(f"Server {address[0]}:{address[1]} is down, failing over to the other servers")
+        client.close()
+
+    def live_addresses(self) -> list[Tuple[str, int]]:
+        with self.lock:
+            return [address for address, client in self.clients.items() if client is not None]
+
+    def health_check_loop(self):
+        while not self.closed:
+            time.sleep(self.health_check_interval)
+            for address in self.addresses:
+                client = self.clients[address]
+                if client is None:
+                    self.reconnect(address)
+                elif not client.connected:
+                    self.mark_down(address, client)
+
+    @property
+    def outstanding(self) -> int:
+        with self.lock:
+            return sum(client.outstanding for client in self.clients.values() if client is not None)
+
+    @property
+    def connected(self) -> bool:
+        return len(self.live_addresses()) > 0
+
+    def choose(self, data: np.ndarray, exclude: set) -> Tuple[Tuple[str, int], object]:
+        """
+        Choose the server for the given input.
+        """
+        with self.lock:
+            live = {address: client for address, client in self.clients.items()
+                    if client is not None and address not in exclude}
+        if not live:
+            raise ConnectionError("No prediction server available")
+        if self.sharding == "hash":
+            # walk the ring clockwise from the position's hash to the first live server
+            start = bisect.bisect(self.ring, (self.hash(data.tobytes()),))
+            for i in range(len(self.ring)):
+                address = self.ring[(start + i) % len(self.ring)][1]
+                if address in live:
+                    return address, live[address]
+        address = min(live, key=lambda address: live[address].outstanding)
+        return address, live[address]
+
+    def predict(self, data: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Tuple[np.ndarray, float]:
+        return self.predict_async(data, model_id, priority, deadline).result()
+
+    def predict_async(self, data: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        future = Future()
+        self.submit(future, data, lambda client: client.predict_async(data, model_id, priority, deadline), set())
+        return future
+
+    def predict_values_async(self, inputs: np.ndarray, model_id: str, priority: int = DEFAULT_PRIORITY, deadline: int = config.REQUEST_DEADLINE) -> Future:
+        future = Future()
+        self.submit(future, inputs, lambda client: client.predict_values_async(inputs, model_id, priority, deadline), set())
+        return future
+
+    def submit(self, future: Future, data: np.ndarray, send, tried: set):
+        """
+        Send the request to a server with send(client). If the connection to that server fails, try the next one.
+        """
+        while True:
+            try:
+                address, client = self.choose(data, tried)
+            except ConnectionError as e:
+                future.set_exception(e)
+                return
+            try:
+                inner = send(client)
+                break
+            except OSError:
+                tried.add(address)
+                self.mark_down(address, client)
+
+        def done(inner: Future):
+            error = inner.exception()
+            if isinstance(error, ConnectionError):
+                tried.add(address)
+                self.mark_down(address, client)
+                self.submit(future, data, send, tried)
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(inner.result())
+        inner.add_done_callback(done)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            clients = [client for client in self.clients.values() if client is not None]
+        for client in clients:
+            client.close()
+
+
+def create_client(transport: str = config.SOCKET_TRANSPORT, connections: int = config.SERVER_CONNECTIONS,
+                  address: Tuple[str, int] = None):
+    """
+    Connect to the server with the given transport, using one or more connections.
+    With multiple tcp servers in SOCKET_HOSTS (and no specific address), requests are sharded over them.
+    """
+    if transport == "tcp" and address is None and len(config.SOCKET_HOSTS) > 1:
+        return ShardedClient(config.SOCKET_HOSTS, connections)
+    def create():
+        return SharedMemoryClient() if transport == "shm" else SocketClient(transport, address)
+    if connections <= 1:
+        return create()
+    return ClientPool([create() for _ in range(connections)], create)
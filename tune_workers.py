@@ -0,0 +1,101 @@
+# Find the throughput-optimal inference worker configuration for this host:
+# sweeps the amount of workers x intra-op threads per worker x batch size,
+# and reports the positions per second (and the batch latency) of every configuration.
+# Every worker is fed batches by its own thread, like the server's inference threads do.
+import argparse
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+import config
+from inference_worker import start_workers
+
+logging.basicConfig(level=logging.INFO, format=' %(message)s')
+
+
+def measure(workers, model_id: str, batch_size: int, duration: float) -> dict:
+    """
+    Let every worker predict random batches for the given duration.
+    """
+    batch = list(np.random.random((batch_size, *config.INPUT_SHAPE)) > 0.5)
+    for worker in workers:
+        # warm up
+        worker.predict(model_id, batch)
+    counts, latencies = [0] * len(workers), [[] for _ in workers]
+    deadline = time.perf_counter() + duration
+    def run(index: int):
+        while time.perf_counter() < deadline:
+            start_time = time.perf_counter()
+            workers[index].predict(model_id, batch)
+            latencies[index].append(time.perf_counter() - start_time)
+            counts[index] += batch_size
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(workers))]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    latencies = np.concatenate([np.array(l) for l in latencies])
+    return {
+        "positions_per_second": sum(counts) / elapsed,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+    }
+
+
+def parse_list(values: str) -> list[int]:
+    return [int(value) for value in values.split(",")]
+
+
+if __name__ == "__main__":
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    parser = argparse.ArgumentParser(description="Sweep inference worker configurations")
+    parser.add_argument("--model", type=str, default=config.SERVED_MODELS[0], help="Model id (in the model folder)")
+    parser.add_argument("--workers", type=str, default=",".join(str(n) for n in (1, 2, 4, 8) if n <= cores) or "1", help="Worker counts to try")
+    parser.add_argument("--threads", type=str, default="0,1,2,4", help="Intra-op threads per worker to try (0: one per pinned core)")
+    parser.add_argument("--inter-op-threads", type=int, default=config.INTER_OP_THREADS, help="Inter-op threads per worker")
+    parser.add_argument("--batch-sizes", type=str, default="1,8,32,64", help="Batch sizes to try")
+    parser.add_argument("--cpus", type=str, default="auto", help="Core assignment (see WORKER_CPUS)")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds per configuration")
+    parser.add_argument("--oversubscribe", action="store_true", help="Also try configurations with more threads than cores")
+    args = parser.parse_args()
+    args = vars(args)
+
+    batch_sizes = parse_list(args["batch_sizes"])
+    # the workers read their config from the environment: trace buckets up to the largest batch size
+    os.environ["MAX_BATCH_SIZE"] = str(max(batch_sizes))
+    results = []
+    for count in parse_list(args["workers"]):
+        for threads in parse_list(args["threads"]):
+            if not args["oversubscribe"] and count * max(threads, 1) > cores:
+                continue
+            workers = start_workers(count, args["cpus"], max_batch_size=max(batch_sizes),
+                                    intra_op_threads=threads, inter_op_threads=args["inter_op_threads"])
+            try:
+                for worker in workers:
+                    worker.load(args["model"])
+                for batch_size in batch_sizes:
+                    result = measure(workers, args["model"], batch_size, args["duration"])
+                    result.update(workers=count, threads=workers[0].intra_op_threads, batch_size=batch_size)
+                    results.append(result)
+                    logging.info(f"{count} workers x {result['threads'] or 'default'} threads, batch {batch_size}: "
+                                 f"{result['positions_per_second']:.0f} positions/s, "
+                                 f"p50 {result['latency_p50'] * 1000:.1f}ms, p99 {result['latency_p99'] * 1000:.1f}ms")
+            finally:
+                for worker in workers:
+                    worker.close()
+
+    if not results:
+        raise SystemExit("No configurations to try (use --oversubscribe?)")
+    print(f"\n{'workers':>8} {'threads':>8} {'batch':>6} {'pos/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for result in sorted(results, key=lambda r: r["positions_per_second"], reverse=True):
+        print(f"{result['workers']:>8} {result['threads'] or 'default':>8} {result['batch_size']:>6} "
+              f"{result['positions_per_second']:>10.0f} {result['latency_p50'] * 1000:>8.1f} {result['latency_p99'] * 1000:>8.1f}")
+    best = max(results, key=lambda r: r["positions_per_second"])
+    print(f"\nBest configuration for this host ({cores} cores):")
+    print(f"INFERENCE_WORKERS={best['workers']} INTRA_OP_THREADS={best['threads']} "
+          f"INTER_OP_THREADS={args['inter_op_threads']} WORKER_CPUS={args['cpus']} MAX_BATCH_SIZE={best['batch_size']}")
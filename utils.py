@@ -1,8 +1,9 @@
-import socket
 import chess
 from chess import Move, PieceType
+import hashlib
+import logging
 import numpy as np
-from PIL import Image
+import os
 import time
 from mapper import Mapping
 import config
@@ -24,6 +25,7 @@ def save_input_state_to_imgs(input_state: np.ndarray, path: str):
     # more padding
     full_array = np.pad(full_array, ((4, 4), (5, 5)),
                         'constant', constant_values=128)
+    from PIL import Image
     img = Image.fromarray(full_array)
     img.save(f"{path}/full.png")
     print(
@@ -40,6 +42,7 @@ def save_output_state_to_imgs(output_state: np.ndarray, path: str, name: str = "
     full_array = np.concatenate(output_state, axis=1)
     # more padding
     full_array = np.pad(full_array, ((4, 4), (5, 5)), 'constant', constant_values=128)
+    from PIL import Image
     img = Image.fromarray(full_array.astype(np.uint8))
     if img.mode != 'RGB':
         img = img.convert('RGB')
@@ -47,6 +50,33 @@ def save_output_state_to_imgs(output_state: np.ndarray, path: str, name: str = "
     print(
         f"*** Saving to images: {(time.time() - start_time):.6f} seconds ***")
 
+# model file -> (modification time, hash)
+_model_hashes = {}
+
+def model_version(model_path: str = None, model_id: str = config.MODEL_ID) -> str:
+    """
+    The version of a model: MODEL_VERSION if it is set, otherwise a hash of the model file
+    (for the server, the file of the model id in the model folder). The hash is computed again
+    when the file changes, so a retrained model gets a new version.
+    """
+    if config.MODEL_VERSION:
+        return config.MODEL_VERSION
+    path = model_path or os.path.join(config.MODEL_FOLDER, f"{model_id}.h5")
+    if not os.path.isfile(path):
+        if path not in _model_hashes:
+            logging.warning(f"Model file {path} not found, using the model id {model_id!r} as version: "
+                            f"set MODEL_VERSION when the model changes")
+            _model_hashes[path] = (None, model_id)
+        return model_id
+    mtime = os.path.getmtime(path)
+    if _model_hashes.get(path, (None,))[0] != mtime:
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        _model_hashes[path] = (mtime, digest.hexdigest()[:16])
+    return _model_hashes[path][1]
+
 def time_function(func):
     """
     Decorator to time a function
@@ -104,24 +134,6 @@ def move_to_plane_index(move: str, board: chess.Board):
     col = 7 - (from_square // 8)
     return (plane_index, row, col)
 
-def recvall(sock: socket.socket, count: int = 0) -> bytes:
-    """
-    Function to continuously receive data from a socket
-    """
-    buffer = b''
-    if count == 0:
-        while True:
-            part = sock.recv(config.SOCKET_BUFFER_SIZE)
-            buffer += part
-            if len(part) < config.SOCKET_BUFFER_SIZE:
-                break
-    else:
-        while count > 0:
-            part = sock.recv(config.SOCKET_BUFFER_SIZE)
-            buffer += part
-            count -= len(part)
-    return buffer
-    
 def get_height_of_tree(node: Node):
     if node is None:
         return 0